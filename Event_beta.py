@@ -241,9 +241,7 @@ class Example(Frame):
             print("Action Track: rightClick")
         try:
             firstSelection_index = self.text.index(SEL_FIRST)
-            cursor_index = self.text.index(SEL_LAST)
-            content = self.text.get('1.0', "end-1c")
-            self.writeFile(self.fileName, content, cursor_index)
+            self.saveFile()
         except TclError:
             pass
 
@@ -361,36 +359,31 @@ class Example(Frame):
     def executeCursorCommand(self, command):
         if self.debug:
             print("Action Track: executeCursorCommand")
-        content = self.getText()
         print("Command:" + command)
         try:
             firstSelection_index = self.text.index(SEL_FIRST)
             cursor_index = self.text.index(SEL_LAST)
-            aboveHalf_content = self.text.get('1.0', firstSelection_index)
-            followHalf_content = self.text.get(firstSelection_index, "end-1c")
             selected_string = self.text.selection_get()
             if re.match(self.entityRe, selected_string) != None:
                 ## if have selected entity
                 new_string_list = selected_string.strip('[@]').rsplit('#', 1)
                 new_string = new_string_list[0]
-                followHalf_content = followHalf_content.replace(selected_string, new_string, 1)
+                self.text.delete(firstSelection_index, cursor_index)
+                self.text.insert(firstSelection_index, new_string)
                 selected_string = new_string
                 cursor_index = "%s - %sc" % (cursor_index, str(len(new_string_list[1]) + 4))
             if command == "q":
                 print('q: remove entity label')
             else:
                 if len(selected_string) > 0:
-                    followHalf_content, cursor_index = self.replaceString(followHalf_content, selected_string, command,
-                                                                          cursor_index)
-            content = aboveHalf_content + followHalf_content
-            content = content
-            self.writeFile(self.fileName, content, cursor_index)
+                    selection_end = "%s + %sc" % (firstSelection_index, len(selected_string))
+                    cursor_index = self.replaceString(firstSelection_index, selection_end, command, cursor_index)
+            self.showEdit(cursor_index)
+            self.saveFile()
         except TclError:
             ## not select text
             cursor_index = self.text.index(INSERT)
             [line_id, column_id] = cursor_index.split('.')
-            aboveLine_content = self.text.get('1.0', str(int(line_id) - 1) + '.end')
-            belowLine_content = self.text.get(str(int(line_id) + 1) + '.0', "end-1c")
             line = self.text.get(line_id + '.0', line_id + '.end')
             matched_span = (-1, -1)
             for match in re.finditer(self.entityRe, line):
@@ -401,27 +394,22 @@ class Example(Frame):
                 selected_string = line[matched_span[0]:matched_span[1]]
                 new_string_list = selected_string.strip('[@]').rsplit('#', 1)
                 new_string = new_string_list[0]
-                line_before_entity = line[:matched_span[0]]
-                line_after_entity = new_string + line[matched_span[1]:]
+                if command != "q" and len(new_string) > 0 and command not in self.pressCommand:
+                    return
+                ## edit the entity in place at its exact position in the line
+                entity_start = line_id + '.' + str(matched_span[0])
+                self.text.delete(entity_start, line_id + '.' + str(matched_span[1]))
+                self.text.insert(entity_start, new_string)
                 selected_string = new_string
                 cursor_index = line_id + '.' + str(int(matched_span[1]) - (len(new_string_list[1]) + 4))
                 if command == "q":
                     print('q: remove entity label')
                 else:
                     if len(selected_string) > 0:
-                        if command in self.pressCommand:
-                            line_after_entity, cursor_index = self.replaceString(line_after_entity, selected_string,
-                                                                                 command, cursor_index)
-                        else:
-                            return
-                line = line_before_entity + line_after_entity
-            if aboveLine_content != '':
-                aboveLine_content = aboveLine_content + '\n'
-            if belowLine_content != '':
-                belowLine_content = '\n' + belowLine_content
-            content = aboveLine_content + line + belowLine_content
-            content = content
-            self.writeFile(self.fileName, content, cursor_index)
+                        entity_end = "%s + %sc" % (entity_start, len(selected_string))
+                        cursor_index = self.replaceString(entity_start, entity_end, command, cursor_index)
+            self.showEdit(cursor_index)
+            self.saveFile()
 
     def executeEntryCommand(self, command):
         if self.debug:
@@ -433,27 +421,26 @@ class Example(Frame):
             self.setCursorLabel(newCurrentCursor)
         else:
             command_list = decompositCommand(command)
-            for idx in range(0, len(command_list)):
-                command = command_list[idx]
+            newcursor_index = self.text.index(INSERT)
+            for command in command_list:
                 if len(command) == 2:
                     select_num = int(command[0])
                     command = command[1]
-                    content = self.getText()
                     cursor_index = self.text.index(INSERT)
                     newcursor_index = cursor_index.split('.')[0] + "." + str(
                         int(cursor_index.split('.')[1]) + select_num)
                     # print("new cursor position: ", select_num, " with ", newcursor_index, "with ", newcursor_index)
                     selected_string = self.text.get(cursor_index, newcursor_index)
-                    aboveHalf_content = self.text.get('1.0', cursor_index)
-                    followHalf_content = self.text.get(cursor_index, "end-1c")
                     if command in self.pressCommand:
                         if len(selected_string) > 0:
-                            # print "insert index: ", self.text.index(INSERT) 
-                            followHalf_content, newcursor_index = self.replaceString(followHalf_content,
-                                                                                     selected_string, command,
-                                                                                     newcursor_index)
-                            content = aboveHalf_content + followHalf_content
-                    self.writeFile(self.fileName, content, newcursor_index)
+                            # print "insert index: ", self.text.index(INSERT)
+                            newcursor_index = self.replaceString(cursor_index, newcursor_index, command,
+                                                                 newcursor_index)
+                    ## labeled in place, the next command starts after this one
+                    self.text.mark_set(INSERT, newcursor_index)
+            ## one redraw and one save for the whole command string
+            self.showEdit(newcursor_index)
+            self.saveFile()
 
     def deleteTextInput(self, event):
         if self.debug:
@@ -464,31 +451,53 @@ class Example(Frame):
         last_insert = insert_list[0] + "." + str(int(insert_list[1]) - 1)
         get_input = self.text.get(last_insert, get_insert)
         # print("get_input: ", get_input)
-        aboveHalf_content = self.text.get('1.0', last_insert)
-        followHalf_content = self.text.get(last_insert, "end-1c")
         if len(get_input) > 0:
-            followHalf_content = followHalf_content.replace(get_input, '', 1)
-        content = aboveHalf_content + followHalf_content
-        self.writeFile(self.fileName, content, last_insert)
-
-    def replaceString(self, content, string, replaceType, cursor_index):
+            ## the key was typed after its command saved the file, which is already up to date
+            self.text.delete(last_insert, get_insert)
+        self.setCursorLabel(self.text.index(INSERT))
+
+    def replaceString(self, start_index, end_index, replaceType, cursor_index):
+        """
+        Label the text between two indices in place, only the span itself is rewritten
+        :return: new cursor index
+        """
         if replaceType in self.pressCommand:
+            start_index = self.text.index(start_index)
+            end_index = self.text.index(end_index)
+            string = self.text.get(start_index, end_index)
             new_string = "[@" + string + "#" + self.currentEventId + self.pressCommand[replaceType] + "*]"
-            cursor_indexList = cursor_index.split('.')
             newcursor_index = "%s + %sc" % (cursor_index, str(len(self.pressCommand[replaceType]) + 5))
             # newcursor_index = cursor_indexList[0] + "." + str(int(cursor_indexList[1])+ len(new_string))
         else:
             print("Invaild command!")
             print("cursor index: ", self.text.index(INSERT))
-            return content, cursor_index
-        # print "new string: ", new_string
-        # print "find: ", content.find(string)
-        content = content.replace(string, new_string, 1)
-        # print "content: ", content
+            return cursor_index
+        self.text.delete(start_index, end_index)
+        self.text.insert(start_index, new_string)
         # self.currentEventId = ""
         eventIds = ("MaxId: %s\nCurId: %s" % (self.maxEventId, self.currentEventId))
         self.EventId.config(text=eventIds)
-        return content, newcursor_index
+        return newcursor_index
+
+    def showEdit(self, newcursor_index):
+        """Move the cursor after an edit applied in place and highlight again, the text is never reloaded"""
+        newcursor_index = self.text.index(newcursor_index)
+        self.text.mark_set(INSERT, newcursor_index)
+        self.text.see(newcursor_index)
+        self.setCursorLabel(newcursor_index)
+        self.setColorDisplay()
+
+    def saveFile(self):
+        """Write the text to the .ann file, once per command"""
+        if len(self.fileName) == 0:
+            print("Don't write to empty file!")
+            return
+        new_name = self.fileName if ".ann" in self.fileName else self.fileName + '.ann'
+        with open(new_name, 'w', encoding=self.file_encoding) as ann_file:
+            ann_file.write(self.getText())
+        if new_name != self.fileName:
+            self.fileName = new_name
+            self.setNameLabel("File: " + new_name)
 
     def writeFile(self, fileName, content, newcursor_index):
         if len(fileName) > 0:
@@ -540,6 +549,9 @@ class Example(Frame):
             self.text.mark_set("matchStart", lineStart)
             self.text.mark_set("matchEnd", lineStart)
             self.text.mark_set("searchLimit", lineEnd)
+        ## entities edited in place are tagged again from scratch
+        for tag in ("catagory", "edge", "insideEntityColor"):
+            self.text.tag_remove(tag, "matchStart", "searchLimit")
         while True:
             self.text.tag_configure("catagory", background=self.entityColor)
             self.text.tag_configure("edge", background=self.entityColor)
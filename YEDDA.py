@@ -7,10 +7,11 @@
 # -*- coding: utf-8 -*-
 import os.path
 import platform
+import re
+import time
 from tkinter import filedialog
 from tkinter import font
 from tkinter import messagebox
-from collections import deque
 from tkinter import *
 from tkinter.ttk import Frame, Button, Radiobutton, Label, Combobox
 from tkinter.simpledialog import Dialog
@@ -19,10 +20,22 @@ from dataclasses import dataclass
 from typing import List, Optional, Tuple
 import json
 
+from utils.autosave import AutoSaver
+from utils.export import *
+from utils.markup import render_markup
+from utils.document import Document, EditHistory, EntityIndex, RowSet, common_affix_length, python_text, tcl_text
 from utils.recommend import *
+from utils.standoff import StandoffDocument, parse_rows, remove_kind
+
+
+## index already in `row.col` form, converted without calling Tk
+ROW_COL_INDEX = re.compile(r'(\d+)\.(\d+)$')
 
 
 class Editor(ScrolledText):
+    # rows above and below the visible window highlighted in viewport_only mode
+    VIEW_MARGIN = 50
+
     def __init__(self, parent, entity_pattern, recommend_pattern):
         super().__init__(parent, selectbackground='light salmon')
         self.entity_pattern = entity_pattern
@@ -38,6 +51,99 @@ class Editor(ScrolledText):
         self.bind('<Button-3>', _ignore)
         self.set_colors(None)
 
+        # The standoff model (plain text plus entity spans) is the source of truth: annotation, undo,
+        # recommendation and export edit or read it, and its rows are rendered into the widget.
+        # Every Tk insert/delete (including user typing) is routed through Python and parsed back into the model,
+        # the rendered markup is mirrored in self.document for highlighting and saving.
+        self.standoff = StandoffDocument()
+        self.standoff.on_change = self._model_changed
+        self._rendering = False  # model rows being rendered into the widget
+        self._syncing = False  # widget rows being parsed into the model
+        self._edit_cursors = (None, None)  # cursor before and after the widget edit being synced
+        self.document = Document()
+        self.entities = EntityIndex()
+        self.entities.reset(self.document)
+        self.history = EditHistory()
+        # gold entities of the whole document, for recommendation
+        self.lexicon = Lexicon()
+        # increased on every change of the content, to recognize stale background results
+        self.version = 0
+        # rows changed (or not highlighted yet) since last update_view, and lines rescanned by it
+        self.dirty_rows = RowSet()
+        self.rescanned_lines = 0
+        self.highlight_seconds = 0.0
+        # highlight only the visible rows, the rest is highlighted lazily while scrolling
+        self.viewport_only = False
+        self._view_update_pending = False
+        self.config(yscrollcommand=self._on_yscroll)
+        self._tk_command = self._w + '_orig'
+        self.tk.call('rename', self._w, self._tk_command)
+        self.tk.createcommand(self._w, self._dispatch)
+
+    def position(self, index: str) -> (int, int):
+        """
+        Convert Tk index to (row, col) of the document.
+        Tk never touches the trailing newline, so index 'end' is clamped to 'end-1c'
+        """
+        match = ROW_COL_INDEX.match(index)
+        if match:
+            # plain `row.col` is resolved in Python, clamped the same way as Tk
+            row, col = max(1, int(match.group(1))), int(match.group(2))
+            if row > self.document.line_count():
+                return self.document.end()
+            return row, min(col, len(self.document.lines[row - 1]))
+        row, col = self.tk.call(self._tk_command, 'index', index).split('.')
+        return min((int(row), int(col)), self.document.end())
+
+    def offset(self, index: str) -> int:
+        """absolute character offset of Tk index, shared with the parser, recommender and exporter"""
+        return self.document.offset(self.position(index))
+
+    def index_at(self, offset: int) -> str:
+        """`row.col` index of absolute character offset, without calling Tk"""
+        row, col = self.document.position(offset)
+        return f'{row}.{col}'
+
+    def _dispatch(self, operation, *args):
+        if operation in ('insert', 'delete', 'replace'):
+            self.version += 1
+        if operation == 'insert' and len(args) >= 2:
+            pos = self.position(args[0])
+            args = list(args)
+            # text may come from the document, i.e. with surrogate pairs which Tk refuses
+            args[1::2] = [python_text(text) for text in args[1::2]]
+            result = self.tk.call((self._tk_command, operation) + tuple(args))
+            inserted = tcl_text(''.join(args[1::2]))
+            new_end = self.document.replace(pos, pos, inserted)
+            self.dirty_rows.edit(pos[0], pos[0], new_end[0])
+            self.entities.edit(pos[0], pos[0], new_end[0])
+            self._sync_rows(pos[0], pos[0], new_end[0], pos, new_end)
+        elif operation == 'delete' and 1 <= len(args) <= 2:
+            start = self.position(args[0])
+            if len(args) == 2:
+                end = self.position(args[1])
+            else:
+                end = self.position(args[0] + '+1c')
+            result = self.tk.call((self._tk_command, operation) + args)
+            if start < end:
+                self.document.replace(start, end, '')
+                self.dirty_rows.edit(start[0], end[0], start[0])
+                self.entities.edit(start[0], end[0], start[0])
+                self._sync_rows(start[0], end[0], start[0], end, start)
+        elif operation in ('insert', 'delete', 'replace'):
+            # rare forms (multiple ranges, replace), resync the whole document
+            result = self.tk.call((self._tk_command, operation) + args)
+            old_line_count = self.document.line_count()
+            self.document = Document(tcl_text(self.tk.call(self._tk_command, 'get', '1.0', 'end-1c')))
+            self.dirty_rows.add(1, self.document.line_count())
+            self.entities.reset(self.document)
+            with self.history.paused():
+                self._sync_rows(1, old_line_count, self.document.line_count())
+            self.history.clear()
+        else:
+            result = self.tk.call((self._tk_command, operation) + args)
+        return result
+
     def set_colors(self, colors: Optional[List[Tuple[str, str]]]):
         """
         Set colors for different entity type
@@ -57,78 +163,181 @@ class Editor(ScrolledText):
                 self.tag_configure('entity_' + label, background=color)
                 self.tag_configure('recommend_' + label, background=color)
 
-    def _highlight_entity(self, start: str, count: int, tag_name: str):
-        end = f'{start}+{count}c'
-        sharp_pos = self.get(start, end).rfind('#')
-        word_start = f"{start}+2c"
-        word_end = f"{start}+{sharp_pos}c"
-        if self.colors:
-            label_start = f'{start}+{sharp_pos + 1}c'
-            label_end = f'{start}+{count - 2}c'
-            label = self.get(label_start, label_end)
-            tag_name = f'{tag_name}_{label}'
-        self.tag_add(tag_name, word_start, word_end)
-        self.tag_add("edge", start, word_start)
-        self.tag_add("edge", word_end, end)
+    def highlight_ranges(self, first_row: int, last_row: int) -> dict:
+        """
+        Tag ranges of the entities within the given rows, computed from the entity index without calling Tk
+        :return: {tag name: [start index, end index, start index, end index, ...]}
+        """
+        ranges = {'edge': []}
+        edge = ranges['edge']
+        for row in range(first_row, last_row + 1):
+            for entity in self.entities.row_entities(row):
+                tag_name = 'entity' if entity.kind == 'gold' else 'recommend'
+                if self.colors:
+                    tag_name = f'{tag_name}_{entity.label}'
+                word_start = entity.start + 2
+                ## before the `#label*]`, nested markup included
+                word_end = entity.end - len(entity.label) - 3
+                ranges.setdefault(tag_name, []).extend((f'{row}.{word_start}', f'{row}.{word_end}'))
+                edge.extend((f'{row}.{entity.start}', f'{row}.{word_start}',
+                             f'{row}.{word_end}', f'{row}.{entity.end}'))
+        return ranges
 
     def show_annotation_tag(self, show: bool):
         self.tag_configure('edge', elide=not show)
 
-    def highlight_recommend(self, start: str, count: int):
-        self._highlight_entity(start, count, 'recommend')
-
-    def highlight_entity(self, start: str, count: int):
-        self._highlight_entity(start, count, 'entity')
-
     def get_text(self) -> str:
         """get text from 0 to end"""
-        return self.get("1.0", "end-1c")
-
-    def _highlight_entities(self, pattern, highlight_func):
-        count_var = StringVar()
-        from_index = '1.0'
-        while True:
-            pos = self.search(pattern, from_index, END, count=count_var, regexp=True)
-            if pos == "":
-                break
-            from_index = f"{pos}+{count_var.get()}c"
-            highlight_func(pos, int(count_var.get()))
-
-    def update_view(self):
-        self._highlight_entities(self.entity_pattern, self.highlight_entity)
-        self._highlight_entities(self.recommend_pattern, self.highlight_recommend)
-
-    def current_entity(self) -> (str, (str, int)):
-        def find_pattern_span_in_line(pattern):
-            row, col = self.index(INSERT).split('.')
-            cursor_col = int(col)
-            count_var = StringVar()
-            from_index = f'{row}.0'
-            while True:
-                pos = self.search(pattern, from_index, f'{row}.end', count=count_var, regexp=True)
-                if pos == '':
-                    break
-                row, col = pos.split('.')
-                match_end = f'{row}.{int(col) + int(count_var.get())}'  # here don't use offset form
-                if int(col) < cursor_col < (int(col) + int(count_var.get())):
-                    return pos, match_end
-                from_index = match_end
-            return None
+        return python_text(self.document.text())
 
-        span = find_pattern_span_in_line(self.entity_pattern)
-        if span is not None:
-            return 'gold', span
-        span = find_pattern_span_in_line(self.recommend_pattern)
-        if span is not None:
-            return 'recommend', span
-        else:
-            return None, (None, None)
+    def replace_range(self, start: str, end: str, text: str):
+        """
+        Replace text between two indices in place, only the changed part is touched,
+        so tags, marks and scroll position elsewhere are kept.
+        """
+        start_pos, end_pos = self.position(start), self.position(end)
+        old_text = self.document.get(start_pos, end_pos)
+        prefix, suffix = common_affix_length(old_text, text)
+        if prefix == len(old_text) == len(text):
+            return
+        start = self.index_at(self.document.offset(start_pos) + prefix)
+        end = self.index_at(self.document.offset(end_pos) - suffix)
+        self.delete(start, end)
+        self.insert(start, text[prefix:len(text) - suffix])
 
-    def get_selection(self) -> Optional[str]:
+    def _sync_rows(self, first_row: int, old_last: int, new_last: int, cursor_before=None, cursor_after=None):
+        """
+        Widget rows first_row..old_last were edited into rows first_row..new_last, parse them into the model.
+        Rows rendered from the model are already there
+        """
+        if self._rendering:
+            return
+        self._edit_cursors = tuple(None if pos is None else f'{pos[0]}.{pos[1]}'
+                                   for pos in (cursor_before, cursor_after))
+        rows = parse_rows('\n'.join(self.document.lines[first_row - 1:new_last]))
+        self._syncing = True
+        try:
+            self.standoff.replace_rows(first_row, old_last, rows)
+        finally:
+            self._syncing = False
+            self._edit_cursors = (None, None)
+
+    def _model_changed(self, first_row: int, old_rows: list, new_rows: list):
+        """
+        Every edit of the model is recorded for undo and updates the lexicon.
+        Edits not coming from the widget are rendered into it, only the changed markup is touched
+        """
+        self.history.record(first_row, old_rows, new_rows, *self._edit_cursors)
+        self.lexicon.update_rows(old_rows, new_rows)
+        if self._syncing:
+            return
+        self._rendering = True
         try:
-            return self.selection_get()
-        except TclError:
+            self.replace_range(f'{first_row}.0', f'{first_row + len(old_rows) - 1}.end',
+                               '\n'.join(render_markup(text, spans) for text, spans in new_rows))
+        finally:
+            self._rendering = False
+
+    def load_text(self, text: str):
+        """Replace the whole content by a newly opened file, history and lexicon are rebuilt"""
+        with self.history.paused():
+            self.delete('1.0', END)
+            self.lexicon.clear()
+            self.insert('1.0', text)
+        self.history.clear()
+
+    def _apply_edits(self, edits):
+        """replace rows of the model, the widget follows through _model_changed"""
+        with self.history.paused():
+            for first_row, removed, inserted in edits:
+                self.standoff.replace_rows(first_row, first_row + len(removed) - 1, inserted)
+
+    def undo(self) -> Optional[str]:
+        """revert the last action, return cursor before it, or None if nothing to undo"""
+        action = self.history.undo()
+        if action is None:
             return None
+        self._apply_edits((first_row, inserted, removed) for first_row, removed, inserted in reversed(action.edits))
+        return action.cursor_before
+
+    def redo(self) -> Optional[str]:
+        """apply the last undone action again, return cursor after it, or None if nothing to redo"""
+        action = self.history.redo()
+        if action is None:
+            return None
+        self._apply_edits(action.edits)
+        return action.cursor_after
+
+    def export_rows(self) -> list:
+        """rows of the model as they are saved, i.e. with the surrogate pairs of non-BMP characters joined"""
+        rows = self.standoff.rows(1, self.standoff.line_count())
+        for row, (text, spans) in enumerate(rows):
+            if python_text(text) is not text:
+                rows[row] = parse_rows(python_text(render_markup(text, spans)))[0]
+        return rows
+
+    def _refresh_lines(self, first_row: int, last_row: int):
+        """Re-highlight entities within the given rows, with one Tk call per tag"""
+        start, end = f'{first_row}.0', f'{last_row}.end'
+        for t in self.tag_names():
+            if t.startswith('entity') or t.startswith('recommend') or t == 'edge':
+                self.tag_remove(t, start, end)
+        for tag_name, indices in self.highlight_ranges(first_row, last_row).items():
+            if indices:
+                self.tag_add(tag_name, *indices)
+
+    def visible_rows(self) -> (int, int):
+        first_row = int(self.index('@0,0').split('.')[0])
+        last_row = int(self.index(f'@0,{self.winfo_height()}').split('.')[0])
+        return first_row, last_row
+
+    def update_view(self, full: bool = False):
+        """
+        Re-highlight rows changed since last call, tags on other rows are left as they are.
+        In viewport_only mode, rows outside the visible window stay pending until scrolled into view.
+        :param full: rescan the whole document, e.g. after colors changed
+        """
+        line_count = self.document.line_count()
+        if full:
+            self.dirty_rows.add(1, line_count)
+        if self.viewport_only:
+            first_row, last_row = self.visible_rows()
+            blocks = self.dirty_rows.take(max(1, first_row - self.VIEW_MARGIN),
+                                          min(line_count, last_row + self.VIEW_MARGIN))
+        else:
+            blocks = self.dirty_rows.take(1, line_count)
+            self.dirty_rows.clear()
+        self.rescanned_lines = sum(last_row - first_row + 1 for first_row, last_row in blocks)
+        start = time.perf_counter()
+        for first_row, last_row in blocks:
+            self._refresh_lines(first_row, last_row)
+        self.highlight_seconds = time.perf_counter() - start
+
+    def _on_yscroll(self, first, last):
+        self.vbar.set(first, last)
+        if self.viewport_only and self.dirty_rows and not self._view_update_pending:
+            self._view_update_pending = True
+            self.after_idle(self._lazy_update_view)
+
+    def _lazy_update_view(self):
+        self._view_update_pending = False
+        self.update_view()
+
+    def plain_index(self, index: str, count: int) -> str:
+        """
+        Index count characters after index, or before it if count is negative, without counting entity markup,
+        as the counts of entry commands
+        """
+        row, col = self.position(index)
+        standoff = self.standoff
+        row, col = standoff.position(standoff.offset(row, standoff.plain_col(row, col)) + count)
+        return f'{row}.{standoff.markup_col(row, col)}'
+
+    def selection_range(self) -> (str, str):
+        """selected range, or the cursor position as an empty range"""
+        if self.tag_ranges(SEL):
+            return self.index(SEL_FIRST), self.index(SEL_LAST)
+        return self.index(INSERT), self.index(INSERT)
 
 
 @dataclass
@@ -221,14 +430,8 @@ class QueryExport(Dialog):
         return self.scheme_var.get()
 
     def _guess_segmented(self):
-        """False for non-segmented Chinese, True for English or Segmented Chinese.
-        Make naive guess, user should check whether the guess is right
-        """
-        ascii_percent = sum(1 for c in self.sample if c.isascii()) / len(self.sample)
-        is_english = (ascii_percent > 0.8)
-        space_percent = self.sample.count(' ') / len(self.sample)
-        many_space = (space_percent > 0.2)
-        return is_english or many_space or False
+        """Make naive guess, user should check whether the guess is right"""
+        return guess_segmented(self.sample)
 
 
 def all_colors():
@@ -248,7 +451,16 @@ class Application(Frame):
         self.fileName = ""
         self.file_encoding = 'utf-8'
         self.debug = False
-        self.history = deque(maxlen=20)
+        # undo history keeps at most this many characters of edits
+        self.historyBudget = 10000000
+        # annotation is saved by a background thread, merging edits within this many seconds
+        self.saver = AutoSaver(delay=0.5)
+        # recommendation beyond the near window runs on a worker thread
+        self.recommender = BackgroundRecommender()
+        self._recommend_version = None
+        self._recommend_polling = False
+        # files larger than this (in characters) are highlighted lazily, only around the visible rows
+        self.lazyHighlightSize = 1000000
 
         # default GUI display parameter
         self.readConfig()
@@ -296,6 +508,7 @@ class Application(Frame):
         self.filename_lbl = Label(self, text="File: no file is opened")
         self.filename_lbl.grid(sticky=W, pady=4, padx=5)
         self.text = Editor(self, self.entity_regex, self.recommendRe)
+        self.text.history.budget = self.historyBudget
         self.text.grid(row=1, column=0, columnspan=self.textColumn, rowspan=self.textRow, padx=12, sticky=NSEW)
 
         btn = Button(self, text="Open", command=self.onOpen)
@@ -340,6 +553,7 @@ class Application(Frame):
                 self.text.bind("<Control-Key-" + press_key + ">", self.keepCurrent)
 
         self.text.bind('<Control-Key-z>', self.backToHistory)
+        self.text.bind('<Control-Key-y>', self.forwardToHistory)
 
         self.text.bind('<Double-Button-1>', self.doubleLeftClick)
         self.text.bind('<ButtonRelease-1>', self.show_cursor_pos)
@@ -373,28 +587,52 @@ class Application(Frame):
 
     def toggle_use_recommend(self):
         if not self.use_recommend.get():
-            content = self.text.get_text()
-            content = removeRecommendContent(content, self.recommendRe)
-            self.writeFile(self.fileName, content, '1.0')
+            self.recommender.cancel()
+            self.pushToHistory()
+            ## only the spans of rows with recommendation change, the plain text is never touched
+            standoff = self.text.standoff
+            for row, spans in enumerate(standoff.spans.rows, 1):
+                if any(span[2] == '$' for span in spans):
+                    standoff.replace_spans(row, remove_kind(spans, '$'))
+            self.text.update_view()
+            self.text.history.end(self.text.index(INSERT))
+            self.saveFile()
 
     def toggle_use_colorful(self):
         if self.use_colorful_var.get():
             self.text.set_colors([(d.name, d.color) for d in self.pressCommand])
         else:
             self.text.set_colors(None)
-        self.text.update_view()
+        self.text.update_view(full=True)
 
     def onOpen(self):
         filename = filedialog.askopenfilename(
             filetypes=[('all files', '.*'), ('text files', '.txt'), ('ann files', '.ann')])
         if filename != '':
-            self.text.delete("1.0", END)
             text = self.readFile(filename)
-            self.text.insert(END, text)
+            self.text.viewport_only = len(text) > self.lazyHighlightSize
+            self.text.load_text(text)
             self.filename_lbl.config(text="File: " + filename)
-            self.autoLoadNewFile(self.fileName, "1.0")
             self.text.mark_set(INSERT, "1.0")
+            self.text.see("1.0")
             self.show_cursor_pos(None)
+            self.text.update_view()
+            if self.debug:
+                print(f"Action Track: onOpen, highlighted {self.text.rescanned_lines} lines "
+                      f"in {self.text.highlight_seconds * 1000:.1f} ms")
+
+    def onClose(self):
+        # make sure pending annotation reaches the disk before quit
+        if not self.saver.stop():
+            messagebox.showerror("Save error!", "Annotation could not be written within 10 seconds.")
+        self.show_save_error()
+        self.master.destroy()
+
+    def show_save_error(self):
+        """report a failed background write, e.g. text not encodable in the file encoding"""
+        error = self.saver.take_error()
+        if error is not None:
+            messagebox.showerror("Save error!", f"Failed to save {self.fileName}:\n{error}")
 
     def readFile(self, filename):
         f = open(filename)
@@ -432,10 +670,11 @@ class Application(Frame):
             count = int(match.group(1))
         else:
             count = 1
+        ## counts are plain characters, entity markup is skipped
         if count > 0:
-            self.text.tag_add(preview_tag, INSERT, f'{INSERT}+{count}c')
+            self.text.tag_add(preview_tag, INSERT, self.text.plain_index(INSERT, count))
         else:
-            self.text.tag_add(preview_tag, f'{INSERT}-{abs(count)}c', INSERT)
+            self.text.tag_add(preview_tag, self.text.plain_index(INSERT, count), INSERT)
         return True
 
     def execute_command(self, _):
@@ -443,6 +682,7 @@ class Application(Frame):
         content = self.entry.get()
         self.clearCommand()
         self.execute_entry_command(content.strip())
+        self.text.history.end(self.text.index(INSERT))
         return content
 
     def alphanum_key_pressed(self, event):
@@ -450,16 +690,35 @@ class Application(Frame):
         self.pushToHistory()
         self.clearCommand()
         self.execute_cursor_command(press_key.lower())
+        self.text.history.end(self.text.index(INSERT))
         return 'break'
 
     def backToHistory(self, _):
         if self.debug:
             print("Action Track: backToHistory")
-        if len(self.history) > 0:
-            content, cursor = self.history.pop()
-            self.writeFile(self.fileName, content, cursor)
-        else:
+        cursor = self.text.undo()
+        if cursor is None:
             print("History is empty!")
+        else:
+            self.afterHistoryMove(cursor)
+        return 'break'
+
+    def forwardToHistory(self, _):
+        if self.debug:
+            print("Action Track: forwardToHistory")
+        cursor = self.text.redo()
+        if cursor is None:
+            print("Nothing to redo!")
+        else:
+            self.afterHistoryMove(cursor)
+        return 'break'
+
+    def afterHistoryMove(self, cursor):
+        self.text.update_view()
+        self.text.mark_set(INSERT, cursor)
+        self.text.see(cursor)
+        self.show_cursor_pos(None)
+        self.saveFile()
 
     def keepCurrent(self, _):
         if self.debug:
@@ -476,55 +735,112 @@ class Application(Frame):
 
     def execute_cursor_command(self, command):
         print("Command:" + command)
-        found, (start, end) = self.text.current_entity()
-        selected = self.text.get_selection()
-        if not found and not selected:
+        keydef = self.get_cmd_by_key(command)
+        start, end = self.text.selection_range()
+        (row, start_col), (end_row, end_col) = self.text.position(start), self.text.position(end)
+        ## cursor only: a binary search in the entity index, the row is looked at only when inside an entity
+        if start == end and self.text.entities.entity_at(row, start_col) is None:
             print(f'{command} outside entity, no selection, do nothing')
             return
-        # selected whole entity, cursor just outside it
-        selected_whole = selected is not None and \
-                         (re.match(self.entity_regex, selected) or re.match(self.recommendRe, selected))
-
-        # cursor outside existing entity & has selection
-        if not found and selected is not None and not selected_whole:
-            if self.get_cmd_by_key(command) is None:
+        if end_row != row:
+            print(f'{command}: selection spans several lines, do nothing')
+            return
+        standoff = self.text.standoff
+        # the whole entity selected, or cursor (and selection) inside an entity
+        span = standoff.span_at(row, start_col, end_col)
+        if span is None:
+            if start == end:
+                print(f'{command} outside entity, no selection, do nothing')
+                return
+            elif keydef is None:
                 print(f'{command} key not bound, outside entity, do nothing')
                 return
-            cursor_index = self.text.index(SEL_LAST)
-            entity_content, cursor_index = self.replaceString(selected, selected, command, cursor_index)
-            above_half = self.text.get('1.0', SEL_FIRST) + entity_content
-            below_half = self.text.get(SEL_LAST, "end-1c")
-            content = self.addRecommendContent(above_half, below_half, self.use_recommend.get())
-            self.writeFile(self.fileName, content, cursor_index)
-        # Cursor inside existing entity, no matter has or not has selection.
-        # Or Cursor outside existing entity (just on the edge), with the whole entity selected
-        else:
-            if selected_whole:
-                start, end = self.text.index(SEL_FIRST), self.text.index(SEL_LAST)
-            covered_string = self.text.get(start, end)
-            old_entity, old_label = covered_string.strip('[@$*]').rsplit('#', 1)
-
-            if command == "q":
-                print('q: remove entity label')
-                new_cursor = f'{end}-{5 + len(old_label)}c'
-                entity_content = old_entity
-            elif command == 'y':
-                print("y: confirm recommend label")
-                entity_content = f'[@{old_entity}#{old_label}*]'
-                new_cursor = end
-            elif len(old_entity) > 0 and self.get_cmd_by_key(command) is not None:
-                print(f'{command}: change entity type')
-                cmd = self.get_cmd_by_key(command)
-                entity_content = f'[@{old_entity}#{cmd.name}*]'
-                delta = len(cmd.name) - len(old_label)
-                new_cursor = end + (f'+{delta}c' if delta >= 0 else f'{delta}c')
-            else:
-                print(f'{command}: key not bound, do nothing')
+            span = standoff.annotate(row, standoff.plain_col(row, start_col), standoff.plain_col(row, end_col),
+                                     keydef.name)
+            if span is None:
+                print(f'{command}: selection crosses an entity, do nothing')
                 return
-            above_half = self.text.get('1.0', start) + entity_content
-            below_half = self.text.get(end, 'end-1c')
-            content = self.addRecommendContent(above_half, below_half, self.use_recommend.get())
-            self.writeFile(self.fileName, content, new_cursor)
+            cursor = standoff.markup_end(row, span)
+        elif command == "q":
+            print('q: remove entity label')
+            standoff.remove(row, span)
+            cursor = standoff.markup_col(row, span[1])
+        elif command == 'y':
+            print("y: confirm recommend label")
+            cursor = standoff.markup_end(row, standoff.relabel(row, span, span[3]))
+        elif span[0] < span[1] and keydef is not None:
+            print(f'{command}: change entity type')
+            cursor = standoff.markup_end(row, standoff.relabel(row, span, keydef.name))
+        else:
+            print(f'{command}: key not bound, do nothing')
+            return
+        self.finish_annotation(f'{row}.{cursor}')
+
+    def finish_annotation(self, new_cursor):
+        """After entities were edited in the standoff model: recommend, redraw, save and move the cursor"""
+        if self.use_recommend.get():
+            self.recommend_from(new_cursor)
+        self.text.update_view()
+        if self.debug:
+            print(f"Action Track: finish_annotation, rescanned {self.text.rescanned_lines} lines "
+                  f"in {self.text.highlight_seconds * 1000:.1f} ms")
+        self.text.mark_set(INSERT, new_cursor)
+        self.text.see(INSERT)
+        self.show_cursor_pos(None)
+        self.saveFile()
+
+    def recommend_from(self, index):
+        """Refresh recommendation for the text after index, within the following 20 lines"""
+        standoff = self.text.standoff
+        row, col = self.text.position(index)
+        last_row = min(row + 20, standoff.line_count())
+        if len(self.text.lexicon):
+            matcher = self.text.lexicon.matcher()
+            start = standoff.plain_col(row, col)
+            for offset, (text, spans) in enumerate(standoff.rows(row, last_row)):
+                recommended = recommend_spans(text, spans, matcher, start if offset == 0 else 0)
+                if recommended != spans:
+                    standoff.replace_spans(row + offset, recommended)
+        self.recommend_rest(last_row + 1)
+
+    def recommend_rest(self, first_row):
+        """Recommend rows from first_row to the end of document in background"""
+        if first_row > self.text.document.line_count():
+            return
+        standoff = self.text.standoff
+        self.recommender.start(first_row, standoff.rows(first_row, standoff.line_count()), self.text.lexicon)
+        self._recommend_version = self.text.version
+        if not self._recommend_polling:
+            self._recommend_polling = True
+            self.after(50, self.poll_recommend)
+
+    def poll_recommend(self):
+        """Merge background recommendation into the editor, drop it if the document changed since"""
+        merged = False
+        try:
+            results = self.recommender.poll()
+        except RuntimeError as e:
+            self._recommend_polling = False
+            messagebox.showerror("Recommend Error", f"{e}: {e.__cause__!r}")
+            return
+        for job_id, first_row, last_row, recommended_rows in results:
+            if job_id != self.recommender.job_id:
+                continue
+            if self.text.version != self._recommend_version:
+                self.recommender.cancel()
+                break
+            # undone together with the action which started the job
+            with self.text.history.recording_into(self.text.history.last_action()):
+                self.text.standoff.replace_rows(first_row, last_row, recommended_rows)
+            self._recommend_version = self.text.version
+            merged = True
+        if merged:
+            self.text.update_view()
+            self.saveFile()
+        if self.recommender.busy() or not self.recommender.results.empty():
+            self.after(50, self.poll_recommend)
+        else:
+            self._recommend_polling = False
 
     def execute_entry_command(self, command):
         print(f"EntryCommand: {command}")
@@ -532,12 +848,8 @@ class Application(Frame):
             row, _ = self.text.index(INSERT).split('.')
             self.text.mark_set(INSERT, f'{int(row) + 1}.0')
             self.show_cursor_pos(None)
-        elif command.isdigit():
-            self.text.mark_set(INSERT, f'{INSERT}+{command}c')
-            self.show_cursor_pos(None)
-            self.preview_cmd_range()
-        elif len(command) >= 2 and command[0] == '-' and command[1:].isdigit():
-            self.text.mark_set(INSERT, f'{INSERT}{command}c')
+        elif command.isdigit() or len(command) >= 2 and command[0] == '-' and command[1:].isdigit():
+            self.text.mark_set(INSERT, self.text.plain_index(INSERT, int(command)))
             self.show_cursor_pos(None)
             self.preview_cmd_range()
         else:
@@ -548,80 +860,60 @@ class Application(Frame):
                     if c.isdigit():
                         num += c
                     else:
-                        commands.append((int(num), c))
+                        commands.append((int(num or 0), c))
                         num = ''
                 return commands
 
-            for select_num, cmd in split_commands(command):
-                assert select_num > 0
-                sel_start = self.text.index(INSERT)
-                sel_end = self.text.index(f'{INSERT}+{select_num}c')
-                selected = self.text.get(sel_start, sel_end)
-                if self.get_cmd_by_key(cmd) is not None:
-                    above_half = self.text.get('1.0', sel_start)
-                    below_half = self.text.get(sel_start, "end-1c")
-                    below_half, new_cursor = self.replaceString(below_half, selected, cmd, sel_end)
-                    content = self.addRecommendContent(above_half, below_half, self.use_recommend.get())
-                    self.writeFile(self.fileName, content, new_cursor)
-
-
-    def replaceString(self, content, string, replaceType, cursor_index):
-        keydef = self.get_cmd_by_key(replaceType)
-        if keydef is not None:
-            new_string = "[@" + string + "#" + keydef.name + "*]"
-            row, col = cursor_index.split('.')
-            newcursor_index = f"{row}.{int(col) + len(keydef.name) + 5}"
-            content = content.replace(string, new_string, 1)
-            return content, newcursor_index
-        else:
-            print("Invalid command!")
-            print("cursor index: ", self.text.index(INSERT))
-            return content, cursor_index
-
-    def writeFile(self, fileName, content, newcursor_index):
-        print("writeFile")
-        if len(fileName) > 0:
-            if ".ann" in fileName:
-                new_name = fileName
-                ann_file = open(new_name, 'w', encoding=self.file_encoding)
-                ann_file.write(content)
-                ann_file.close()
-            else:
-                new_name = fileName + '.ann'
-                ann_file = open(new_name, 'w', encoding=self.file_encoding)
-                ann_file.write(content)
-                ann_file.close()
-            self.autoLoadNewFile(new_name, newcursor_index)
-        else:
-            print("Don't write to empty file!")
-
-
-    def addRecommendContent(self, train_data, decode_data, recommendMode):
-        if not recommendMode:
-            content = train_data + decode_data
-        else:
-            if self.debug:
-                print("Action Track: addRecommendContent, start Recommend entity")
-            content = maximum_matching(train_data, decode_data)
-        return content
+            self.annotate_commands(split_commands(command))
 
+    def annotate_commands(self, commands):
+        """
+        Label consecutive spans from the cursor, e.g. `3a5b` labels 3 characters by key `a` then 5 by key `b`.
+        Counts are plain characters of the standoff model, the whole command string is one action
+        with one recommendation update, one redraw and one save.
+        """
+        standoff = self.text.standoff
+        row, col = self.text.position(INSERT)
+        offset = standoff.offset(row, standoff.plain_col(row, col))
+        cursor = None
+        for select_num, cmd in commands:
+            keydef = self.get_cmd_by_key(cmd)
+            if select_num <= 0:
+                print(f"{select_num}{cmd}: invalid command, skip")
+                continue
+            if keydef is None:
+                continue
+            (row, start), (end_row, end) = standoff.position(offset), standoff.position(offset + select_num)
+            span = standoff.annotate(row, start, end, keydef.name) if end_row == row else None
+            if end_row != row:
+                print(f"{select_num}{keydef.name}: crosses a line end, skip")
+            elif span is None:
+                print(f"{select_num}{keydef.name}: crosses an entity, skip")
+            else:
+                cursor = f'{row}.{standoff.markup_end(row, span)}'
+            offset += select_num
+        if cursor is not None:
+            self.finish_annotation(cursor)
 
-    def autoLoadNewFile(self, fileName, newcursor_index):
+    def saveFile(self):
+        """
+        Hand the in-memory document to the background saver, which merges the saves
+        arriving within its delay into one write.
+        """
+        if len(self.fileName) == 0:
+            print("Don't write to empty file!")
+            return
+        new_name = self.fileName if ".ann" in self.fileName else self.fileName + '.ann'
+        self.show_save_error()
+        self.saver.save(new_name, self.text.get_text(), self.file_encoding)
         if self.debug:
-            print("Action Track: autoLoadNewFile")
-        if len(fileName) > 0:
-            self.text.delete("1.0", END)
-            text = self.readFile(fileName)
-            self.text.insert("end-1c", text)
-            self.filename_lbl.config(text="File: " + fileName)
-            self.text.mark_set(INSERT, newcursor_index)
-            self.text.see(newcursor_index)
-            self.show_cursor_pos(None)
-            self.text.update_view()
-
+            print("Action Track: saveFile", self.saver.stats())
+        if new_name != self.fileName:
+            self.fileName = new_name
+            self.filename_lbl.config(text="File: " + new_name)
 
     def pushToHistory(self):
-        self.history.append((self.text.get_text(), self.text.index(INSERT)))
+        self.text.history.begin(self.text.index(INSERT))
 
     # update shortcut map, directly in current configfile
     def renewPressCommand(self):
@@ -676,26 +968,10 @@ class Application(Frame):
         if not dlg.confirmed:
             print("Operation canceled")
             return
-        fileLines = open(self.fileName, 'r', encoding=self.file_encoding).readlines()
-        lineNum = len(fileLines)
         new_filename = self.fileName.split('.ann')[0] + '.' + dlg.tag_scheme().lower()
-        seqFile = open(new_filename, 'w', encoding=self.file_encoding)
-        for line in fileLines:
-            if len(line) <= 2:
-                seqFile.write('\n')
-                continue
-            else:
-                if not dlg.keep_recommended():
-                    line = removeRecommendContent(line, self.recommendRe)
-                    pattern = self.entity_regex
-                else:
-                    pattern = self.goldAndrecomRe
-                wordTagPairs = getWordTagPairs(line, dlg.segmented(), dlg.tag_scheme(), dlg.only_NP(), pattern)
-                for wordTag in wordTagPairs:
-                    seqFile.write(wordTag)
-                # use null line to separate sentences
-                seqFile.write('\n')
-        seqFile.close()
+        ## straight from the standoff model, the .ann file may still be waiting for the background saver
+        lineNum = export_rows(self.text.export_rows(), new_filename, dlg.segmented(), dlg.tag_scheme(),
+                              dlg.only_NP(), dlg.keep_recommended(), self.file_encoding)
         print("Exported file into sequence style in file: ", new_filename)
         print("Line number:", lineNum)
         showMessage = "Exported file successfully!\n\n"
@@ -719,110 +995,6 @@ def getConfigList():
     return list(filteredFileNames)
 
 
-def getWordTagPairs(tagedSentence, segmented=True, tagScheme="BMES", onlyNP=False, entityRe=r'\[\@.*?\#.*?\*\]'):
-    sentence = tagedSentence.strip('\n')
-    tagged_chunks = []
-    for match in re.finditer(entityRe, sentence):
-        chunk = (match.group(), match.start(), match.end(), True)  # (chunk_of_words, start, end, is_tagged)
-        tagged_chunks.append(chunk)
-
-    if len(tagged_chunks) == 0:
-        tagged_chunks = [(sentence, 0, len(sentence), False)]  # TODO semantically wrong
-
-    chunks = []
-    for idx in range(0, len(tagged_chunks)):
-        if idx == 0:
-            if tagged_chunks[idx][1] > 0:  # first character is not tagged
-                chunks.append((sentence[0:tagged_chunks[idx][1]], 0, tagged_chunks[idx][1], False))
-                chunks.append(tagged_chunks[idx])
-            else:
-                chunks.append(tagged_chunks[idx])
-        else:
-            if tagged_chunks[idx][1] == tagged_chunks[idx - 1][2]:
-                chunks.append(tagged_chunks[idx])
-            elif tagged_chunks[idx][1] < tagged_chunks[idx - 1][2]:
-                print("ERROR: found pattern has overlap!", tagged_chunks[idx][1], ' with ', tagged_chunks[idx - 1][2])
-            else:
-                chunks.append(
-                    (sentence[tagged_chunks[idx - 1][2]:tagged_chunks[idx][1]], tagged_chunks[idx - 1][2],
-                     tagged_chunks[idx][1],
-                     False))
-                chunks.append(tagged_chunks[idx])
-
-        sent_len = len(sentence)
-        if idx == len(tagged_chunks) - 1:
-            if tagged_chunks[idx][2] > sent_len:
-                print("ERROR: found pattern position larger than sentence length!")
-            elif tagged_chunks[idx][2] < sent_len:
-                chunks.append([sentence[tagged_chunks[idx][2]:sent_len], tagged_chunks[idx][2], sent_len, False])
-            else:
-                continue
-    return turnFullListToOutputPair(chunks, segmented, tagScheme, onlyNP)
-
-
-def turnFullListToOutputPair(fullList, segmented=True, tagScheme="BMES", onlyNP=False):
-    pair_list = []
-    for chunk_words, start, end, is_tagged in fullList:
-        if is_tagged:
-            plain_words, label = chunk_words.strip('[@$]').rsplit('#', 1)
-            label = label.strip('*')
-            if segmented:
-                plain_words = plain_words.split()
-            if onlyNP:
-                label = "NP"
-            outList = outputWithTagScheme(plain_words, label, tagScheme)
-            pair_list.extend(outList)
-        else:
-            if segmented:
-                words = chunk_words.split()
-            else:
-                words = chunk_words  # actually chars
-            for word_or_char in words:
-                if word_or_char == ' ':
-                    continue
-                pair = word_or_char + ' ' + 'O\n'
-                pair_list.append(pair)
-    return pair_list
-
-
-def outputWithTagScheme(input_list, label, tagScheme="BMES"):
-    output_list = []
-    list_length = len(input_list)
-    if tagScheme == "BMES":
-        if list_length == 1:
-            pair = input_list[0] + ' ' + 'S-' + label + '\n'
-            output_list.append(pair)
-        else:
-            for idx in range(list_length):
-                if idx == 0:
-                    pair = input_list[idx] + ' ' + 'B-' + label + '\n'
-                elif idx == list_length - 1:
-                    pair = input_list[idx] + ' ' + 'E-' + label + '\n'
-                else:
-                    pair = input_list[idx] + ' ' + 'M-' + label + '\n'
-                output_list.append(pair)
-    else:
-        for idx in range(list_length):
-            if idx == 0:
-                pair = input_list[idx] + ' ' + 'B-' + label + '\n'
-            else:
-                pair = input_list[idx] + ' ' + 'I-' + label + '\n'
-            output_list.append(pair)
-    return output_list
-
-
-def removeRecommendContent(content, recommendRe=r'\[\$.*?\#.*?\*\](?!\#)'):
-    output_content = ""
-    last_match_end = 0
-    for match in re.finditer(recommendRe, content):
-        matched = content[match.span()[0]:match.span()[1]]
-        words = matched.strip('[$]').split("#")[0]
-        output_content += content[last_match_end:match.span()[0]] + words
-        last_match_end = match.span()[1]
-    output_content += content[last_match_end:]
-    return output_content
-
-
 def main():
     print("YEDDA launched!")
     print("OS:", platform.system())
@@ -833,6 +1005,7 @@ def main():
     root.geometry(f'{width}x{height}+{x}+{y}')
     app = Application(root)
     app.setFont(17)
+    root.protocol("WM_DELETE_WINDOW", app.onClose)
     root.mainloop()
 
 
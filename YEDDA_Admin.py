@@ -7,11 +7,14 @@
 
 # -*- coding: utf-8 -*-
 import platform
+import queue
 import tkinter.filedialog as tkFileDialog
 import tkinter.messagebox as tkMessageBox
 from tkinter import *
 from tkinter.ttk import *  # Frame, Button, Label, Style, Scrollbar
+from concurrent.futures import ProcessPoolExecutor
 
+from utils.agreement import agreement_string, file_agreement
 from utils.compareAnn import *
 from utils.metric4ann import *
 
@@ -23,6 +26,12 @@ class Example(Frame):
         self.OS = platform.system().lower()
         self.parent = parent
         self.fileName = ""
+        self.executor = None  # process pool computing the pairwise matrix and the agreement
+        self.finished = queue.Queue()  # futures done, filled by executor threads
+        self.agreementFuture = None
+        self.pairFutures = {}  # future -> (idx, idy) cell of the matrix it fills
+        self.taskNum = 0
+        self.taskDone = 0
         # default GUI display parameter
         self.textColumn = 3
         self.initUI()
@@ -85,14 +94,27 @@ class Example(Frame):
         title_string = "F:Entity/Chunk"
         self.tree = Treeview(win2, columns=[title_string] + file_list, show="headings")
 
+        # progress of the pairwise matrix
+        progressFrame = Frame(win2)
+        progressFrame.pack(side=BOTTOM, fill=X)
+        self.progress = Progressbar(progressFrame, mode='determinate')
+        self.progress.pack(side=LEFT, fill=X, expand=True)
+        self.progressLabel = Label(progressFrame, text="")
+        self.progressLabel.pack(side=LEFT)
+        Button(progressFrame, text="Cancel", command=self.cancelAnalysis).pack(side=RIGHT)
+        # chance-corrected agreement of all annotators
+        self.agreementLabel = Label(win2, text="Fleiss' kappa / Krippendorff's alpha: ...", anchor=CENTER)
+        self.agreementLabel.pack(side=BOTTOM, fill=X)
+
         self.tree.heading(title_string, text=title_string, anchor=CENTER)
         self.tree.column(title_string, stretch=YES, minwidth=50, width=100, anchor=CENTER)
         for each_file in file_list:
             self.tree.heading(each_file, text=each_file, anchor=CENTER)
             self.tree.column(each_file, stretch=YES, minwidth=50, width=100, anchor=CENTER)
+        self.treeRows = []
         for idx in range(len(file_list)):
-            self.tree.insert("", 'end', text=file_list[idx], values=[file_list[idx]] + result_matrix[idx],
-                             tags=('chart',))
+            self.treeRows.append(self.tree.insert("", 'end', text=file_list[idx],
+                                                  values=[file_list[idx]] + result_matrix[idx], tags=('chart',)))
         the_font = ('TkDefaultFont', 18,)
         self.tree.tag_configure('chart', font=the_font)
         style = Style()
@@ -104,6 +126,11 @@ class Example(Frame):
 
         self.tree.bind("<Button-3>", do_popup)
 
+        def on_close():
+            self.cancelAnalysis()
+            win2.destroy()
+
+        win2.protocol("WM_DELETE_WINDOW", on_close)
         win2.minsize(30, 30)
 
     def selection(self):
@@ -115,8 +142,75 @@ class Example(Frame):
         if len(filez) < 2:
             tkMessageBox.showinfo("Monitor Error", "Selected less than two files!\n\nPlease select at least two files!")
         else:
-            result_matrix = generate_report_from_list(filez)
+            self.cancelAnalysis()
+            file_num = len(filez)
+            result_matrix = [[output_model(1.0, 1.0) if idx == idy else "..." for idy in range(file_num)]
+                             for idx in range(file_num)]
             self.ChildWindow(filez, result_matrix)
+            ## fill cells as pairs finish in a process pool, the window stays responsive
+            self.executor = ProcessPoolExecutor()
+            self.finished = queue.Queue()
+            self.taskNum = file_num * (file_num - 1) // 2 + 1
+            self.taskDone = 0
+            self.agreementFuture = self.executor.submit(file_agreement, filez)
+            self.agreementFuture.add_done_callback(self.finished.put)
+            self.pairFutures = {}
+            for idx in range(file_num - 1):
+                for idy in range(idx + 1, file_num):
+                    future = self.executor.submit(compare_pair, filez[idx], filez[idy], idx, idy)
+                    self.pairFutures[future] = (idx, idy)
+                    future.add_done_callback(self.finished.put)
+            self.progress.configure(maximum=self.taskNum, value=0)
+            self.progressLabel.config(text=f"0/{self.taskNum}")
+            self.after(100, self.pollAnalysis, self.executor)
+
+    def pollAnalysis(self, executor):
+        if executor is not self.executor:
+            return
+        while True:
+            try:
+                future = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            if future.cancelled():
+                continue
+            self.taskDone += 1
+            try:
+                result = future.result()
+            except Exception as e:
+                ## e.g. files of different sentence number, show the error where the result would be
+                error = type(e).__name__
+                print("Multi-Annotator Analysis error:", error, e)
+                if future is self.agreementFuture:
+                    self.agreementLabel.config(text=f"Fleiss' kappa / Krippendorff's alpha: {error} {e}")
+                else:
+                    idx, idy = self.pairFutures[future]
+                    self.tree.set(self.treeRows[idx], idy + 1, error)
+                    self.tree.set(self.treeRows[idy], idx + 1, error)
+                continue
+            if future is self.agreementFuture:
+                kappa, alpha, token_num = result
+                self.agreementLabel.config(text="Fleiss' kappa: %s; Krippendorff's alpha: %s (%d tokens)"
+                                                % (agreement_string(kappa), agreement_string(alpha), token_num))
+                continue
+            idx, idy, f, f2 = result
+            cell = output_model(f, f2)
+            self.tree.set(self.treeRows[idx], idy + 1, cell)
+            self.tree.set(self.treeRows[idy], idx + 1, cell)
+        self.progress.configure(value=self.taskDone)
+        self.progressLabel.config(text=f"{self.taskDone}/{self.taskNum}")
+        if self.taskDone >= self.taskNum:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        else:
+            self.after(100, self.pollAnalysis, executor)
+
+    def cancelAnalysis(self):
+        if self.executor is None:
+            return
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = None
+        self.progressLabel.config(text="Cancelled")
 
     def compareTwoFiles(self):
         ftypes = [('ann files', '.ann')]
@@ -124,15 +218,22 @@ class Example(Frame):
         if len(filez) != 2:
             tkMessageBox.showinfo("Compare Error", "Please select exactly two files!")
         else:
-            outfile = tkFileDialog.asksaveasfilename(defaultextension=".tex")
-            write_result = compareBoundary(filez[0], filez[1], outfile)
+            ## html report opens in a browser directly, latex needs to be compiled with pdflatex
+            outfile = tkFileDialog.asksaveasfilename(defaultextension=".html",
+                                                     filetypes=[('HTML report', '.html'), ('Latex', '.tex')])
+            if not outfile:
+                return
+            if outfile.endswith(".tex"):
+                write_result = compareBoundary(filez[0], filez[1], outfile)
+            else:
+                write_result = compareBoundaryHtml(filez[0], filez[1], outfile)
             if write_result:
-                tkMessageBox.showinfo("Latex Generate", "Latex file generated successfully!\n\nSaved to " + outfile)
+                tkMessageBox.showinfo("Report Generate", "Report generated successfully!\n\nSaved to " + outfile)
                 # import os
                 # os.system("pdflatex "+ f.name)
             else:
-                tkMessageBox.showinfo("Latex Error",
-                                      "Latex generated Error, two files don't have same sentence number!")
+                tkMessageBox.showinfo("Report Error",
+                                      "Report generated Error, two files don't have same sentence number!")
 
 
 def main():
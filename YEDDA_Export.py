@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Headless exporter, converts every .ann file under a directory into BMES/BIO sequence files
+with the same options as the Export button, e.g.
+    python YEDDA_Export.py corpus/ --scheme BIO --output-dir seq/ --workers 8
+"""
+import argparse
+
+from utils.export import export_directory
+
+
+def non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"{value} is negative")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export .ann files into sequence format without GUI")
+    parser.add_argument('input_dir', help="directory searched recursively for .ann files")
+    parser.add_argument('--output-dir', default=None, help="default: next to each .ann file")
+    parser.add_argument('--scheme', choices=['BMES', 'BIO'], default='BMES')
+    segmented = parser.add_mutually_exclusive_group()
+    segmented.add_argument('--segmented', dest='segmented', action='store_true', default=None,
+                           help="words are separated by space (English or segmented Chinese)")
+    segmented.add_argument('--not-segmented', dest='segmented', action='store_false',
+                           help="export character by character; default is guessing for each file")
+    parser.add_argument('--only-np', action='store_true', help="use NP as label of all entities")
+    parser.add_argument('--drop-recommended', action='store_true', help="do not export recommended entities")
+    parser.add_argument('--encoding', default='utf-8')
+    parser.add_argument('--workers', type=int, default=None, help="process number, default: CPU count")
+    parser.add_argument('--shard-size', type=non_negative_int, default=64,
+                        help="split files larger than this many MB into shards exported in parallel, 0: never")
+    args = parser.parse_args()
+
+    file_num, line_num, byte_num, seconds = export_directory(
+        args.input_dir, args.output_dir, args.segmented, args.scheme, args.only_np,
+        not args.drop_recommended, args.encoding, args.workers, args.shard_size << 20)
+    seconds = max(seconds, 1e-9)
+    print(f"Exported {file_num} files, {line_num} lines, {byte_num / 1e6:.1f} MB in {seconds:.2f}s")
+    print(f"Throughput: {file_num / seconds:.1f} files/s, {line_num / seconds:.0f} lines/s, "
+          f"{byte_num / 1e6 / seconds:.2f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark entity highlighting of the Editor against the Tk search loop it replaced,
+which made a `search`, a `get` and three `tag_add` calls for every entity.
+Needs a display (e.g. xvfb-run). Run from the repository root: python -m benchmarks.bench_highlight
+"""
+import random
+import time
+from tkinter import StringVar, Tk, TclError
+
+from YEDDA import Editor
+
+ENTITY_PATTERN = r'\[\@.*?\#.*?\*\](?!\#)'
+RECOMMEND_PATTERN = r'\[\$.*?\#.*?\*\](?!\#)'
+
+
+def make_text(entity_num, entities_per_line=10, seed=1):
+    random.seed(seed)
+    words = ['Jie', 'Yang', 'Shanghai', 'annotation', 'tool', 'of', 'the', 'a']
+    lines = []
+    for _ in range(entity_num // entities_per_line):
+        pieces = []
+        for _ in range(entities_per_line):
+            pieces.append(' '.join(random.choice(words) for _ in range(random.randint(1, 5))))
+            pieces.append('[%s%s#Type%d*]' % (random.choice('@$'), random.choice(words), random.randint(0, 4)))
+        lines.append(' '.join(pieces))
+    return '\n'.join(lines)
+
+
+def legacy_highlight_entity(editor, start, count, tag_name):
+    end = f'{start}+{count}c'
+    sharp_pos = editor.get(start, end).rfind('#')
+    word_start = f"{start}+2c"
+    word_end = f"{start}+{sharp_pos}c"
+    if editor.colors:
+        label_start = f'{start}+{sharp_pos + 1}c'
+        label_end = f'{start}+{count - 2}c'
+        label = editor.get(label_start, label_end)
+        tag_name = f'{tag_name}_{label}'
+    editor.tag_add(tag_name, word_start, word_end)
+    editor.tag_add("edge", start, word_start)
+    editor.tag_add("edge", word_end, end)
+
+
+def legacy_highlight_entities(editor, pattern, tag_name, from_index='1.0', stop_index='end'):
+    count_var = StringVar()
+    while True:
+        pos = editor.search(pattern, from_index, stop_index, count=count_var, regexp=True)
+        if pos == "":
+            break
+        from_index = f"{pos}+{count_var.get()}c"
+        legacy_highlight_entity(editor, pos, int(count_var.get()), tag_name)
+
+
+def legacy_refresh(editor):
+    last_row = editor.document.line_count()
+    for t in editor.tag_names():
+        if t.startswith('entity') or t.startswith('recommend') or t == 'edge':
+            editor.tag_remove(t, '1.0', 'end')
+    legacy_highlight_entities(editor, ENTITY_PATTERN, 'entity', '1.0', f'{last_row}.end')
+    legacy_highlight_entities(editor, RECOMMEND_PATTERN, 'recommend', '1.0', f'{last_row}.end')
+
+
+def batched_refresh(editor):
+    editor.update_view(full=True)
+
+
+def timeit(func, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    try:
+        root = Tk()
+    except TclError as e:
+        print("bench_highlight needs a display:", e)
+        return
+    editor = Editor(root, ENTITY_PATTERN, RECOMMEND_PATTERN)
+    print(f"{'entities':<12}{'colors':<8}{'legacy (ms)':>14}{'batched (ms)':>14}{'speed-up':>10}")
+    for entity_num in [1000, 10000]:
+        editor.load_text(make_text(entity_num))
+        for colors in [None, [(f'Type{idx}', 'light green') for idx in range(5)]]:
+            editor.set_colors(colors)
+            legacy = timeit(lambda: legacy_refresh(editor))
+            batched = timeit(lambda: batched_refresh(editor))
+            print(f'{entity_num:<12}{"yes" if colors else "no":<8}{legacy * 1000:>14.2f}{batched * 1000:>14.2f}'
+                  f'{legacy / batched:>9.1f}x')
+    root.destroy()
+
+
+if __name__ == '__main__':
+    main()
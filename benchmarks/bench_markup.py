@@ -0,0 +1,342 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the single-pass markup tokenizer against the parsers it replaced:
+regex plus chunk stitching in getWordTagPairs, the character state machines of
+metric4ann/compareAnn get_ner_from_sentence, and the regex passes of removeRecommendContent
+and recommendation. The last case has `[@` never closed, where the non-greedy patterns backtrack.
+Run from the repository root: python -m benchmarks.bench_markup
+"""
+import glob
+import random
+import re
+import time
+
+from utils import compareAnn, metric4ann
+from utils.export import getWordTagPairs, outputWithTagScheme, removeRecommendContent
+from utils.recommend import Lexicon, recommend_text
+
+goldAndrecomRe = r'\[[\@\$)].*?\#.*?\*\](?!\#)'
+
+
+## previous implementations, kept verbatim for comparison
+def legacy_getWordTagPairs(tagedSentence, segmented=True, tagScheme="BMES", onlyNP=False, entityRe=r'\[\@.*?\#.*?\*\]'):
+    sentence = tagedSentence.strip('\n')
+    tagged_chunks = []
+    for match in re.finditer(entityRe, sentence):
+        chunk = (match.group(), match.start(), match.end(), True)  # (chunk_of_words, start, end, is_tagged)
+        tagged_chunks.append(chunk)
+
+    if len(tagged_chunks) == 0:
+        tagged_chunks = [(sentence, 0, len(sentence), False)]  # TODO semantically wrong
+
+    chunks = []
+    for idx in range(0, len(tagged_chunks)):
+        if idx == 0:
+            if tagged_chunks[idx][1] > 0:  # first character is not tagged
+                chunks.append((sentence[0:tagged_chunks[idx][1]], 0, tagged_chunks[idx][1], False))
+                chunks.append(tagged_chunks[idx])
+            else:
+                chunks.append(tagged_chunks[idx])
+        else:
+            if tagged_chunks[idx][1] == tagged_chunks[idx - 1][2]:
+                chunks.append(tagged_chunks[idx])
+            elif tagged_chunks[idx][1] < tagged_chunks[idx - 1][2]:
+                print("ERROR: found pattern has overlap!", tagged_chunks[idx][1], ' with ', tagged_chunks[idx - 1][2])
+            else:
+                chunks.append(
+                    (sentence[tagged_chunks[idx - 1][2]:tagged_chunks[idx][1]], tagged_chunks[idx - 1][2],
+                     tagged_chunks[idx][1],
+                     False))
+                chunks.append(tagged_chunks[idx])
+
+        sent_len = len(sentence)
+        if idx == len(tagged_chunks) - 1:
+            if tagged_chunks[idx][2] > sent_len:
+                print("ERROR: found pattern position larger than sentence length!")
+            elif tagged_chunks[idx][2] < sent_len:
+                chunks.append([sentence[tagged_chunks[idx][2]:sent_len], tagged_chunks[idx][2], sent_len, False])
+            else:
+                continue
+    return legacy_turnFullListToOutputPair(chunks, segmented, tagScheme, onlyNP)
+
+
+def legacy_turnFullListToOutputPair(fullList, segmented=True, tagScheme="BMES", onlyNP=False):
+    pair_list = []
+    for chunk_words, start, end, is_tagged in fullList:
+        if is_tagged:
+            plain_words, label = chunk_words.strip('[@$]').rsplit('#', 1)
+            label = label.strip('*')
+            if segmented:
+                plain_words = plain_words.split()
+            if onlyNP:
+                label = "NP"
+            outList = outputWithTagScheme(plain_words, label, tagScheme)
+            pair_list.extend(outList)
+        else:
+            if segmented:
+                words = chunk_words.split()
+            else:
+                words = chunk_words  # actually chars
+            for word_or_char in words:
+                if word_or_char == ' ':
+                    continue
+                pair = word_or_char + ' ' + 'O\n'
+                pair_list.append(pair)
+    return pair_list
+
+
+def legacy_removeRecommendContent(content, recommendRe=r'\[\$.*?\#.*?\*\](?!\#)'):
+    output_content = ""
+    last_match_end = 0
+    for match in re.finditer(recommendRe, content):
+        matched = content[match.span()[0]:match.span()[1]]
+        words = matched.strip('[$]').split("#")[0]
+        output_content += content[last_match_end:match.span()[0]] + words
+        last_match_end = match.span()[1]
+    output_content += content[last_match_end:]
+    return output_content
+
+
+def legacy_metric_get_ner_from_sentence(sentence):
+    ## remove segmentation space, avoid segmentation changes
+    sentence = sentence.strip().replace(' ', '')
+    sentence_len = len(sentence)
+    # print sentence
+    entity_start = []
+    words = []
+    last_char = ''
+    entity_type_start = False
+    entity_type = ''
+    word_id = 0
+    entity_list = []
+    for idx in range(sentence_len):
+        if sentence[idx] == '[':
+            left_bracket = True
+        elif sentence[idx] == '@':
+            if last_char == '[':
+                entity_start.append(word_id)
+            else:
+                words.append(sentence[idx])
+                word_id += 1
+        elif sentence[idx] == '#':
+            if len(entity_start) > 0:
+                entity_type_start = True
+            else:
+                words.append(sentence[idx])
+                word_id += 1
+        elif sentence[idx] == ']':
+            if last_char == '*':
+                ## remove inside nested entity
+                if len(entity_start) > 1:
+                    entity_start.pop()
+                    entity_type = ''
+                    entity_type_start = False
+                elif len(entity_start) == 1:
+                    entity_info = '[' + str(entity_start[0]) + ',' + str(word_id - 1) + ']:' + entity_type.strip('*')
+                    entity_list.append(entity_info)
+                    entity_type = ''
+                    entity_start = []
+                    entity_type_start = False
+                else:
+                    words.append(sentence[idx])
+                    word_id += 1
+        else:
+            if entity_type_start:
+                entity_type += sentence[idx]
+            else:
+                words.append(sentence[idx])
+                word_id += 1
+        last_char = sentence[idx]
+    # print entity_list
+    return entity_list
+
+
+def legacy_compare_get_ner_from_sentence(sentence, remove_seg=True):
+    ## remove segmentation space, avoid segmentation changes
+    if remove_seg:
+        sentence = sentence.strip().replace(' ', '')
+    else:
+        sentence = sentence.strip()
+    sentence_len = len(sentence)
+    # print sentence
+    entity_start = []
+    words = []
+    words_bound = []
+    last_char = ''
+    entity_type_start = False
+    entity_type = ''
+    word_id = 0
+    entity_list = []
+    origin_text = ""
+    for idx in range(sentence_len):
+        if sentence[idx] == '[':
+            left_bracket = True
+        elif sentence[idx] == '@' or sentence[idx] == '$':
+            if last_char == '[':
+                entity_start.append(word_id)
+            else:
+                words.append(sentence[idx])
+                word_id += 1
+                words_bound.append(0)
+        elif sentence[idx] == '#':
+            if len(entity_start) > 0:
+                entity_type_start = True
+            else:
+                words.append(sentence[idx])
+                word_id += 1
+                words_bound.append(0)
+        elif sentence[idx] == ']':
+            if last_char == '*':
+                ## remove inside nested entity
+                if len(entity_start) > 1:
+                    entity_start.pop()
+                    entity_type = ''
+                    entity_type_start = False
+                elif len(entity_start) == 1:
+                    entity_info = '[' + str(entity_start[0]) + ',' + str(word_id - 1) + ']:' + entity_type.strip('*')
+                    entity_list.append(entity_info)
+                    entity_type = ''
+                    entity_start = []
+                    entity_type_start = False
+                else:
+                    words.append(sentence[idx])
+                    word_id += 1
+                    words_bound.append(0)
+        else:
+            if entity_type_start:
+                entity_type += sentence[idx]
+            else:
+                words.append(sentence[idx])
+                word_id += 1
+                if entity_start:
+                    words_bound.append(1)
+                else:
+                    words_bound.append(0)
+
+        last_char = sentence[idx]
+    assert (len(words) == len(words_bound))
+    return entity_list, words, words_bound
+
+
+def legacy_recommend_text(decode_text, lexicon, entityRe=r'\[\@.*?\#.*?\*\](?!\#)',
+                   recommendRe=r'\[\$.*?\#.*?\*\](?!\#)'):
+    """recommend entities of lexicon in the whole decode_text"""
+    ### forward maximum match algorithm with following conditions:
+    ### 1. for previous recommend entities, remove them and recommend again
+    ### 2. for recognized entities, ignored them (forward process ends at the begining of recognized entity)
+
+    ## remove previous recommend entity format
+    pieces = []
+    last_entity_end = 0
+    for match in re.finditer(recommendRe, decode_text):
+        pieces.append(decode_text[last_entity_end:match.start()])
+        pieces.append(match.group().strip('[$]').rsplit('#', 1)[0])
+        last_entity_end = match.end()
+    pieces.append(decode_text[last_entity_end:])
+    decode_no_recommend = ''.join(pieces)
+    ## ignored annotated entities but record them as (start, end, source, label) spans of the plain text
+    pieces = []
+    spans = []
+    origin_length = 0
+    last_entity_end = 0
+    for match in re.finditer(entityRe, decode_no_recommend):
+        before = decode_no_recommend[last_entity_end:match.start()]
+        [entity, recognized_type] = match.group().strip('[@]*').rsplit('#', 1)
+        origin_length += len(before)
+        spans.append((origin_length, origin_length + len(entity), '@', recognized_type))
+        origin_length += len(entity)
+        pieces.append(before)
+        pieces.append(entity)
+        last_entity_end = match.end()
+    pieces.append(decode_no_recommend[last_entity_end:])
+    decode_origin = ''.join(pieces)
+
+    ## forward maximum matching (FMM) over the lexicon trie, within each segment
+    ## between recognized entities and newlines
+    recommend_spans = []
+    segment_start = 0
+    for span_start, span_end, _, _ in spans + [(len(decode_origin), len(decode_origin), None, None)]:
+        for line in decode_origin[segment_start:span_start].split('\n'):
+            for start, end, label in lexicon.longest_matches(decode_origin, segment_start, segment_start + len(line)):
+                recommend_spans.append((start, end, '$', label))
+            segment_start += len(line) + 1
+        segment_start = span_end
+    return legacy_merge_text_with_entity(decode_origin, sorted(spans + recommend_spans))
+
+
+def legacy_merge_text_with_entity(origin_text, spans):
+    """
+    Put entity markup back into plain text
+    :param spans: sorted, non-overlapping (start, end, source, label), source is '@' (gold) or '$' (recommend)
+    """
+    pieces = []
+    last_end = 0
+    for start, end, source, label in spans:
+        pieces.append(origin_text[last_end:start])
+        pieces.append("[" + source + origin_text[start:end] + "#" + label + "*]")
+        last_end = end
+    pieces.append(origin_text[last_end:])
+    return ''.join(pieces)
+
+
+def make_line(length, entity_rate=0.2, seed=1):
+    random.seed(seed)
+    words = ['Jie', 'Yang', 'Shanghai', 'annotation', 'tool', 'of', 'the', 'a']
+    pieces = []
+    size = 0
+    while size < length:
+        if random.random() < entity_rate:
+            piece = '[%s%s %s#Type%d*] ' % (random.choice('@$'), random.choice(words), random.choice(words),
+                                            random.randint(0, 4))
+        else:
+            piece = random.choice(words) + ' '
+        pieces.append(piece)
+        size += len(piece)
+    return ''.join(pieces)
+
+
+def demo_lines():
+    lines = []
+    for name in sorted(glob.glob('demotext/*.ann')):
+        with open(name, encoding='utf-8') as fp:
+            lines += [line for line in fp.read().split('\n') if line]
+    return lines
+
+
+def timeit(func, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    lexicon = Lexicon()
+    for word in ['Jie Yang', 'Shanghai', 'annotation tool', '上海', '中国']:
+        lexicon.add(word, 'Type0')
+    paths = [('getWordTagPairs', lambda line: legacy_getWordTagPairs(line, True, 'BMES', False, goldAndrecomRe),
+              lambda line: getWordTagPairs(line, True, 'BMES', False, True)),
+             ('metric4ann.get_ner', legacy_metric_get_ner_from_sentence, metric4ann.get_ner_from_sentence),
+             ('compareAnn.get_ner', legacy_compare_get_ner_from_sentence, compareAnn.get_ner_from_sentence),
+             ('removeRecommendContent', legacy_removeRecommendContent, removeRecommendContent),
+             ('recommend_text', lambda line: legacy_recommend_text(line, lexicon),
+              lambda line: recommend_text(line, lexicon))]
+    ## `#` but no closing `*]`, e.g. hashtags after an `[@`: the non-greedy patterns retry to the end of line
+    ## from every `[@`, twice nested
+    unclosed = '[@Jie#Person Yang ' * 150
+    print(f"{'path':<24}{'lines':<26}{'legacy (ms)':>14}{'tokenizer (ms)':>16}{'speed-up':>10}")
+    for lines_name, lines in [('demotext/*.ann', demo_lines()),
+                              ('1000 x 200 chars', [make_line(200, seed=idx) for idx in range(1000)]),
+                              ('10 x 20000 chars', [make_line(20000, seed=idx) for idx in range(10)]),
+                              ('unclosed, 2700 chars', [unclosed, unclosed.replace('[@', '[$')])]:
+        for path_name, legacy, new in paths:
+            legacy_time = timeit(lambda: [legacy(line) for line in lines])
+            new_time = timeit(lambda: [new(line) for line in lines])
+            print(f'{path_name:<24}{lines_name:<26}{legacy_time * 1000:>14.2f}{new_time * 1000:>16.2f}'
+                  f'{legacy_time / new_time:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
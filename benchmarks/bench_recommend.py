@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark recommendation against the previous forward maximum matching,
+which tried every substring length at every position and built per-character label lists,
+and the automaton against the plain trie walk, which restarted at every position.
+Run from the repository root: python -m benchmarks.bench_recommend
+"""
+import random
+import re
+import time
+
+from utils.recommend import Lexicon, maximum_matching
+
+
+def legacy_maximum_matching(train_text, decode_text, entityRe=r'\[\@.*?\#.*?\*\](?!\#)',
+                            recommendRe=r'\[\$.*?\#.*?\*\](?!\#)'):
+    extracted_dict = {}
+    max_length = 0
+    for match in re.finditer(entityRe, train_text):
+        recognized_entity = train_text[match.span()[0]:match.span()[1]]
+        [entity, entity_type] = recognized_entity.strip('[@]*').rsplit('#', 1)
+
+        if len(entity) > max_length:
+            max_length = len(entity)
+
+        extracted_dict[entity] = entity_type
+
+    if len(extracted_dict) == 0:
+        return train_text + decode_text
+
+    ## only recommend following 10 sentences (reduce time)
+    near_sentences = ""
+    far_sentences = ""
+    sentences = decode_text.split('\n')
+    for idx in range(len(sentences)):
+        if idx != len(sentences) - 1:
+            new_string = sentences[idx] + '\n'
+        else:
+            new_string = sentences[idx]
+        if idx > 20:
+            far_sentences += new_string
+        else:
+            near_sentences += new_string
+    decode_text = near_sentences
+
+    ### forward maximum match algorithm with following conditions:
+    ### 1. for previous recommend entities, remove them and recommend again
+    ### 2. for recognized entities, ignored them (forward process ends at the begining of recognized entity)
+
+    ## remove previous recommend entity format
+    decode_no_recommend = ""
+    last_entity_end = 0
+    for match in re.finditer(recommendRe, decode_text):
+        decode_no_recommend += decode_text[last_entity_end:match.span()[0]]
+        recommend_entity = decode_text[match.span()[0]:match.span()[1]]
+        entity = recommend_entity.strip('[$]').rsplit('#', 1)[0]
+        decode_no_recommend += entity
+        last_entity_end = match.span()[1]
+    decode_no_recommend += decode_text[last_entity_end:]
+    ## ignored annotated entities but record them position (in entity_recognized_list)
+    decode_origin = ""
+    entity_recognized_list = []
+    last_entity_end = 0
+    for match in re.finditer(entityRe, decode_no_recommend):
+        decode_origin += decode_no_recommend[last_entity_end:match.span()[0]]
+        entity_recognized_list += [0] * (match.span()[0] - last_entity_end)
+        recommend_entity = decode_no_recommend[match.span()[0]:match.span()[1]]
+        [entity, recognized_type] = recommend_entity.strip('[@]*').rsplit('#', 1)
+        decode_origin += entity
+        entity_recognized_list += ["B-@-" + recognized_type] + ["I-@-" + recognized_type] * (len(entity) - 1)
+        last_entity_end = match.span()[1]
+    decode_origin += decode_no_recommend[last_entity_end:]
+    entity_recognized_list += [0] * (len(decode_no_recommend) - last_entity_end)
+    assert (len(decode_origin) == len(entity_recognized_list))
+
+    ## forward maximum matching (FMM)
+    origin_length = len(decode_origin)
+    FMM_start = 0
+    FMM_end = (FMM_start + max_length) if (FMM_start + max_length) < origin_length - 1 else origin_length - 1
+    entity_recommend_list = []
+    while FMM_start < origin_length:
+
+        if FMM_end == FMM_start:
+            entity_recommend_list += [0]
+            FMM_start += 1
+            FMM_end = (FMM_start + max_length) if (FMM_start + max_length) < origin_length - 1 else origin_length - 1
+        ## recognized span detection: for the following two conditions, it jump when the word is located in recognized entity span
+        elif entity_recognized_list[FMM_start] != 0 or decode_origin[FMM_start] == '\n':
+            entity_recommend_list += [0]
+            FMM_start += 1
+            FMM_end = (FMM_start + max_length) if (FMM_start + max_length) < origin_length - 1 else origin_length - 1
+        elif entity_recognized_list[FMM_end] != 0 or decode_origin[FMM_end] == '\n':
+            FMM_end -= 1
+        ## finish recognized span detection
+        else:
+            word = decode_origin[FMM_start:FMM_end]
+            if word in extracted_dict:
+                entity_recommend_list += ["B-$-" + extracted_dict[word]] + ["I-$-" + extracted_dict[word]] * (
+                            FMM_end - FMM_start - 1)
+                FMM_start = FMM_end
+                FMM_end = (FMM_start + max_length) if (
+                                                                  FMM_start + max_length) < origin_length - 1 else origin_length - 1
+            else:
+                FMM_end -= 1
+    assert (len(entity_recommend_list) == len(entity_recognized_list))
+    recommend_decode_text = legacy_merge_text_with_entity(decode_origin, entity_recognized_list, entity_recommend_list)
+    return train_text + recommend_decode_text + far_sentences
+
+
+
+def legacy_merge_text_with_entity(origin_text, recognized_list, recommend_list):
+    length = len(origin_text)
+    assert (len(recognized_list) == length)
+    assert (len(recommend_list) == length)
+    combine_list = recommend_list
+    for idx in range(length):
+        if combine_list[idx] == 0 and recognized_list[idx] != 0:
+            combine_list[idx] = recognized_list[idx]
+    new_string = ""
+    entity_string = ""
+    entity_type = "Error"
+    entity_source = "Error"
+    for idx in range(length):
+        if combine_list[idx] == 0:
+            if entity_string:
+                new_string += "[" + entity_source + entity_string + "#" + entity_type + "*]"
+                entity_string = ""
+                entity_type = "Error"
+                entity_source = "Error"
+            new_string += origin_text[idx]
+
+        elif combine_list[idx].startswith("B-"):
+            if entity_string:
+                new_string += "[" + entity_source + entity_string + "#" + entity_type + "*]"
+                entity_string = ""
+                entity_type = "Error"
+                entity_source = "Error"
+            entity_string = origin_text[idx]
+            entity_type = combine_list[idx][4:]
+            entity_source = combine_list[idx][2:3]
+        elif combine_list[idx].startswith("I-"):
+            entity_string += origin_text[idx]
+        else:
+            print("merge_text_with_entity error!")
+    if entity_string:
+        new_string += "[" + entity_source + entity_string + "#" + entity_type + "*]"
+        entity_string = ""
+        entity_type = "Error"
+        entity_source = "Error"
+    return new_string
+
+def trie_longest_matches(entities, text):
+    """previous Lexicon.longest_matches: walk the trie from every position, O(text x entity length)"""
+    trie = {}
+    for entity in entities:
+        node = trie
+        for char in entity:
+            node = node.setdefault(char, {})
+        node[None] = entity
+    matches = []
+    pos = 0
+    while pos < len(text):
+        node = trie.get(text[pos])
+        matched_end = -1
+        idx = pos + 1
+        while node is not None:
+            if None in node:
+                matched_end = idx
+            if idx >= len(text):
+                break
+            node = node.get(text[idx])
+            idx += 1
+        if matched_end > 0:
+            matches.append((pos, matched_end))
+            pos = matched_end
+        else:
+            pos += 1
+    return matches
+
+
+def make_corpus(entity_num=300, line_num=21, line_length=200, long_entity_length=0, seed=1):
+    random.seed(seed)
+    chars = [chr(c) for c in range(0x4e00, 0x4e00 + 500)]
+    entities = [''.join(random.choice(chars) for _ in range(random.randint(2, 6))) for _ in range(entity_num)]
+    if long_entity_length:
+        entities.append(''.join(random.choice(chars) for _ in range(long_entity_length)))
+    train_text = ''.join(f'[@{entity}#Type{idx % 5}*]' for idx, entity in enumerate(entities))
+    lines = []
+    for _ in range(line_num):
+        line = ''
+        while len(line) < line_length:
+            line += random.choice(entities) if random.random() < 0.1 else random.choice(chars)
+        lines.append(line)
+    return train_text, '\n'.join(lines)
+
+
+def timeit(func, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"{'case':<32}{'legacy (ms)':>14}{'lexicon (ms)':>14}{'speed-up':>10}")
+    for name, kwargs in [('21 lines x 200 chars', {}),
+                         ('21 lines x 2000 chars', {'line_length': 2000}),
+                         ('long entity (200 chars)', {'long_entity_length': 200}),
+                         ('long entity (2000 chars)', {'long_entity_length': 2000})]:
+        train_text, decode_text = make_corpus(**kwargs)
+        lexicon = Lexicon()
+        lexicon.add_text(train_text)
+        legacy = timeit(lambda: legacy_maximum_matching(train_text, decode_text))
+        trie = timeit(lambda: maximum_matching(train_text, decode_text, lexicon=lexicon))
+        print(f'{name:<32}{legacy * 1000:>14.2f}{trie * 1000:>14.2f}{legacy / trie:>9.1f}x')
+    ## a long gazetteer entry sharing a prefix or a suffix with a long run of text, e.g. `a` * L + `b` or
+    ## `b` + `a` * L in `a` * 20000
+    print(f"\n{'case':<32}{'trie walk (ms)':>16}{'automaton (ms)':>16}{'speed-up':>12}")
+    text = 'a' * 20000
+    for length in [10, 1000, 5000]:
+        for entity in ['a' * length + 'b', 'b' + 'a' * length]:
+            entities = [entity]
+            lexicon = Lexicon()
+            lexicon.add(entity, 'Type0')
+            lexicon.matcher()
+            walk = timeit(lambda: trie_longest_matches(entities, text), repeat=1)
+            automaton = timeit(lambda: lexicon.longest_matches(text))
+            name = f"'a' * {length} + 'b'" if entity[0] == 'a' else f"'b' + 'a' * {length}"
+            print(f'{name:<32}{walk * 1000:>16.2f}{automaton * 1000:>16.2f}'
+                  f'{walk / automaton:>11.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from utils.document import Document, EntityIndex
+
+
+def entity_index(text):
+    entities = EntityIndex()
+    entities.reset(Document(text))
+    return entities
+
+
+def test_next_and_previous_entity():
+    ## cols:    0         10        20        30        40
+    entities = entity_index('[@Jie#Person*] at [$Fudan#School*]\nnothing\nin [@Shanghai#Location*]')
+    row, entity = entities.next_entity(1, 0)
+    assert (row, entity.text) == (1, 'Jie')
+    row, entity = entities.next_entity(1, 1)
+    assert (row, entity.text, entity.kind) == (1, 'Fudan', 'recommend')
+    ## skips the row without entity
+    row, entity = entities.next_entity(1, 19)
+    assert (row, entity.text) == (3, 'Shanghai')
+    assert entities.next_entity(3, 4) is None
+
+    row, entity = entities.previous_entity(3, 0)
+    assert (row, entity.text) == (1, 'Fudan')
+    ## the entity containing col does not end before it
+    row, entity = entities.previous_entity(1, 20)
+    assert (row, entity.text) == (1, 'Jie')
+    row, entity = entities.previous_entity(1, 14)
+    assert (row, entity.text) == (1, 'Jie')
+    assert entities.previous_entity(1, 13) is None
+
+
+def test_entities_in_range():
+    entities = entity_index('[@Jie#Person*] at [$Fudan#School*]\nnothing\nin [@Shanghai#Location*]')
+    assert [(row, entity.text) for row, entity in entities.entities_in_range((1, 14), (3, 3))] == [(1, 'Fudan')]
+    assert [(row, entity.text) for row, entity in entities.entities_in_range((1, 13), (3, 4))] == \
+           [(1, 'Jie'), (1, 'Fudan'), (3, 'Shanghai')]
+    assert entities.entities_in_range((2, 0), (2, 7)) == []
+
+
+def test_nested_markup_is_one_entity():
+    entities = entity_index('in [@陆家嘴 [@金融#Fin-Concept*]#Location*] [$金融#Fin-Concept*]')
+    assert entities.row_entities(1) == [(3, 38, 'gold', '陆家嘴 金融', 'Location'),
+                                        (39, 57, 'recommend', '金融', 'Fin-Concept')]
+    row, entity = entities.entity_at(1, 10)
+    assert entity.label == 'Location'
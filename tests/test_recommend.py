@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from utils.recommend import BackgroundRecommender, Lexicon, recommend_spans, recommend_text
+from utils.standoff import StandoffDocument, parse_rows
+
+
+def wait(recommender, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while recommender.busy() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert not recommender.busy()
+
+
+def test_recommend_text_accepts_lexicon_and_matcher():
+    lexicon = Lexicon()
+    lexicon.add_text('[@Jie Yang#Person*] lives in [@Shanghai#Location*]')
+    text = 'Jie Yang left Shanghai'
+    expected = '[$Jie Yang#Person*] left [$Shanghai#Location*]'
+    assert recommend_text(text, lexicon) == expected
+    assert recommend_text(text, lexicon.matcher()) == expected
+
+
+def test_lexicon_keys_of_nested_entities_survive_load_edit_and_remove():
+    text = '[@陆家嘴 [@金融#Fin-Concept*]#Location*] 中心'
+    lexicon = Lexicon()
+    lexicon.add_text(text)
+    assert lexicon.labels == {'陆家嘴 金融': {'Location': 1}, '金融': {'Fin-Concept': 1}}
+    standoff = StandoffDocument.from_markup(text)
+    standoff.on_change = lambda first_row, old_rows, new_rows: lexicon.update_rows(old_rows, new_rows)
+
+    def reloaded():
+        fresh = Lexicon()
+        fresh.add_text(standoff.markup())
+        return fresh.labels
+
+    standoff.annotate(1, 7, 9, 'Location')
+    assert lexicon.labels == reloaded()
+    assert '中心' in lexicon.labels
+    standoff.remove(1, standoff.spans[1][0])
+    assert lexicon.labels == reloaded() == {'金融': {'Fin-Concept': 1}, '中心': {'Location': 1}}
+    for span in list(standoff.spans[1]):
+        standoff.remove(1, span)
+    assert lexicon.labels == {}
+
+
+def test_recommend_spans_keeps_recommendation_before_start():
+    lexicon = Lexicon()
+    lexicon.add('Shanghai', 'Location')
+    (text, spans), = parse_rows('[$Shanghai#City*] to Shanghai, [$Beijing#City*] [@Shanghai#Location*]')
+    assert recommend_spans(text, spans, lexicon, start=9) == parse_rows(
+        '[$Shanghai#City*] to [$Shanghai#Location*], Beijing [@Shanghai#Location*]')[0][1]
+
+
+def test_background_job_returns_recommended_chunks():
+    lexicon = Lexicon()
+    lexicon.add('Shanghai', 'Location')
+    rows = parse_rows('Shanghai\nnothing here\n[@Shanghai#City*] and Shanghai\nno\nShanghai')
+    recommender = BackgroundRecommender(chunk_lines=2)
+    job_id = recommender.start(3, rows, lexicon)
+    wait(recommender)
+    results = recommender.poll()
+    assert results == [(job_id, 3, 4, parse_rows('[$Shanghai#Location*]\nnothing here')),
+                       (job_id, 5, 6, parse_rows('[@Shanghai#City*] and [$Shanghai#Location*]\nno')),
+                       (job_id, 7, 7, parse_rows('[$Shanghai#Location*]'))]
+    assert recommender.poll() == []
+
+
+def test_background_job_failure_is_raised_by_poll():
+    class BrokenMatcher:
+        def segment_matches(self, text, segments):
+            raise ValueError('broken')
+
+    class BrokenLexicon:
+        def matcher(self):
+            return BrokenMatcher()
+
+    recommender = BackgroundRecommender()
+    recommender.start(1, parse_rows('Shanghai'), BrokenLexicon())
+    wait(recommender)
+    with pytest.raises(RuntimeError) as error:
+        recommender.poll()
+    assert isinstance(error.value.__cause__, ValueError)
+    assert recommender.poll() == []
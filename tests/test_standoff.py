@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import random
+
+from utils.export import export_file, export_rows
+from utils.metric4ann import entity_table_from_lines, entity_table_from_rows
+from utils.standoff import PieceTable, StandoffDocument, parse_rows
+
+TEXT = '[@Jie Yang#Person*] lives in [$Shanghai#Location*]\n\n[@陆家嘴 [@金融#Fin-Concept*]#Location*] 金融'
+
+
+def test_rows_render_back_to_the_markup():
+    standoff = StandoffDocument.from_markup(TEXT)
+    assert standoff.line_count() == 3
+    assert standoff.row(1) == ('Jie Yang lives in Shanghai', ((0, 8, '@', 'Person', 0), (18, 26, '$', 'Location', 0)))
+    assert standoff.row(2) == ('', ())
+    assert standoff.row(3) == ('陆家嘴 金融 金融', ((0, 6, '@', 'Location', 0), (4, 6, '@', 'Fin-Concept', 1)))
+    assert standoff.markup() == TEXT
+
+
+def test_entity_edits_touch_spans_only():
+    standoff = StandoffDocument.from_markup(TEXT)
+    changes = []
+    standoff.on_change = lambda first_row, old_rows, new_rows: changes.append((first_row, old_rows, new_rows))
+    buffers = list(standoff.text.buffers)
+    span = standoff.annotate(1, 9, 14, 'Action')
+    standoff.relabel(1, standoff.span_at(1, 45, 45), 'City')
+    standoff.remove(3, standoff.spans[3][0])
+    assert standoff.markup() == ('[@Jie Yang#Person*] [@lives#Action*] in [@Shanghai#City*]\n\n'
+                                 '陆家嘴 [@金融#Fin-Concept*] 金融')
+    assert standoff.text.buffers == buffers
+    assert [first_row for first_row, _, _ in changes] == [1, 1, 3]
+    assert changes[0][1] == parse_rows(TEXT)[:1]
+    assert standoff.markup_end(1, span) == 36
+    ## a selection crossing an entity is refused
+    assert standoff.annotate(1, 5, 12, 'Person') is None
+
+
+def test_columns_map_between_plain_and_markup():
+    standoff = StandoffDocument.from_markup(TEXT)
+    assert standoff.markup_col(1, 9) == 20
+    assert standoff.plain_col(1, 20) == 9
+    ## inside the markup of an entity
+    assert standoff.plain_col(1, 1) == 0
+    assert standoff.span_at(3, 8, 8) == (4, 6, '@', 'Fin-Concept', 1)
+    assert standoff.span_at(3, 1, 1) == (0, 6, '@', 'Location', 0)
+    assert standoff.position(standoff.offset(3, 2)) == (3, 2)
+    assert standoff.position(1000) == (3, 9)
+
+
+def test_replace_rows_keeps_text_rows_and_spans_together():
+    random.seed(0)
+    lines = TEXT.split('\n')
+    standoff = StandoffDocument.from_markup(TEXT)
+    for _ in range(500):
+        first_row = random.randint(1, len(lines))
+        last_row = random.randint(first_row, len(lines))
+        new_lines = random.choices(['', 'plain', '[@a b#X*] c', '[$d#Y*][@e#Z*]'], k=random.randint(1, 3))
+        old_rows = standoff.replace_rows(first_row, last_row, parse_rows('\n'.join(new_lines)))
+        assert old_rows == parse_rows('\n'.join(lines[first_row - 1:last_row]))
+        lines[first_row - 1:last_row] = new_lines
+        assert standoff.rows(1, standoff.line_count()) == parse_rows('\n'.join(lines))
+    assert standoff.markup() == '\n'.join(lines)
+
+
+def test_piece_table_never_copies_its_buffers():
+    random.seed(1)
+    text = 'hello world'
+    table = PieceTable(text)
+    for _ in range(500):
+        start = random.randint(0, len(text))
+        end = random.randint(start, len(text))
+        inserted = random.choice(['', 'x', 'yz\n'])
+        table.replace(start, end, inserted)
+        text = text[:start] + inserted + text[end:]
+        assert table.get() == text
+        assert table.get(start, start + 3) == text[start:start + 3]
+    assert len(table.buffers) <= 2 * len(table.pieces) + 16
+
+
+def test_export_and_metrics_from_rows(tmp_path):
+    ann_file = tmp_path / 'sample.ann'
+    ann_file.write_text(TEXT + '\n', encoding='utf-8')
+    rows = parse_rows(TEXT + '\n')
+    for keep_recommended in (True, False):
+        export_file(str(ann_file), str(tmp_path / 'file.bmes'), keepRecommended=keep_recommended)
+        export_rows(rows, str(tmp_path / 'rows.bmes'), keepRecommended=keep_recommended)
+        assert (tmp_path / 'file.bmes').read_text(encoding='utf-8') == \
+               (tmp_path / 'rows.bmes').read_text(encoding='utf-8')
+    from_rows = entity_table_from_rows(parse_rows(line.replace(' ', ''))[0] for line in TEXT.split('\n'))
+    from_lines = entity_table_from_lines(TEXT.split('\n'))
+    assert from_rows.entities.tolist() == from_lines.entities.tolist() == [(0, 0, 7, 0), (2, 0, 5, 1)]
+    assert from_rows.types == ['Person', 'Location']
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Chance-corrected agreement of several annotators on the same text.
+Each annotator's file becomes one row of a token-level label matrix (a token is a character of the text
+with segmentation spaces removed, as in metric4ann), and Fleiss' kappa and Krippendorff's alpha are
+computed from that matrix at once for all annotators, instead of pair by pair.
+"""
+import numpy as np
+
+from .metric4ann import layer_entities, load_entity_table
+
+## above this many annotators agreement_scores counts labels per token instead of comparing annotator pairs
+PAIRWISE_ANNOTATORS = 20
+
+
+def label_matrix(tables):
+    """
+    Token labels of each annotator, one row per entity table and one column per token.
+    Labels are 0 for O, 2 * type_id + 1 for B-type and 2 * type_id + 2 for I-type.
+    Sentences whose text length differs between annotators can't be aligned and are left out.
+    :return: (matrix, type names)
+    """
+    sentence_num = tables[0].sentence_num
+    assert all(table.sentence_num == sentence_num for table in tables)
+    lengths = np.stack([table.sentence_length for table in tables])
+    aligned = np.all(lengths == lengths[0], axis=0)
+    sentence_length = np.where(aligned, lengths[0], 0).astype(np.int64)
+    offsets = np.cumsum(sentence_length) - sentence_length
+    type_ids = {}
+    matrix = np.zeros((len(tables), int(sentence_length.sum())), dtype=np.int32)
+    for row, table in zip(matrix, tables):
+        entities = layer_entities(table, 0, type_ids)
+        entities = entities[aligned[entities['sentence']] & (entities['end'] > entities['start'])]
+        start = offsets[entities['sentence']] + entities['start']
+        length = (entities['end'] - entities['start']).astype(np.int64)
+        code = 2 * entities['type'] + 2
+        ## every token of an entity gets I-type, then its first token B-type
+        inside = np.repeat(start + length - np.cumsum(length), length) + np.arange(length.sum())
+        row[inside] = np.repeat(code, length)
+        row[start] = code - 1
+    return matrix, list(type_ids)
+
+
+def agreeing_pairs(matrix, block=4096):
+    """
+    Annotator pairs giving a token the same label, summed over tokens, linear in the number of annotators:
+    one bincount of (token, label) per block of tokens, n annotators giving the same label agree in n * (n - 1) / 2
+    pairs. Blocks keep the counts in cache.
+    """
+    annotator_num, token_num = matrix.shape
+    label_num = int(matrix.max()) + 1
+    base = np.arange(0, block * label_num, label_num, dtype=np.intp)[:, None]
+    square = 0  # sum of n * n
+    for start in range(0, token_num, block):
+        tokens = matrix[:, start:start + block].T
+        counts = np.bincount((base[:len(tokens)] + tokens).ravel(), minlength=block * label_num)
+        square += int(np.dot(counts, counts))
+    return (square - annotator_num * token_num) // 2
+
+
+def agreement_scores(matrix):
+    """
+    Fleiss' kappa and Krippendorff's alpha (nominal) of a label matrix with one row per annotator.
+    Both only need the number of agreeing annotator pairs over all tokens and the label totals.
+    :return: (kappa, alpha), "Nan" when undefined, e.g. every token has the same label
+    """
+    annotator_num, token_num = matrix.shape
+    if annotator_num < 2 or token_num == 0:
+        return "Nan", "Nan"
+    if annotator_num > PAIRWISE_ANNOTATORS:
+        agree_pairs = agreeing_pairs(matrix)
+    else:
+        ## comparing rows at SIMD speed costs less than counting every value while there are few of them
+        agree_pairs = sum(int(np.count_nonzero(matrix[idx + 1:] == matrix[idx])) for idx in range(annotator_num - 1))
+    value_num = annotator_num * token_num
+    label_square = float(np.square(np.bincount(matrix.ravel()).astype(np.float64)).sum())
+    if label_square == float(value_num) ** 2:
+        return "Nan", "Nan"
+    ## Fleiss: observed agreement of token pairs against agreement expected from the label totals
+    observed = 2.0 * agree_pairs / (token_num * annotator_num * (annotator_num - 1))
+    expected = label_square / float(value_num) ** 2
+    kappa = (observed - expected) / (1 - expected)
+    ## Krippendorff: disagreeing pairs of the coincidence matrix against pairs of all values
+    disagree = (token_num * annotator_num * (annotator_num - 1) - 2.0 * agree_pairs) / (annotator_num - 1)
+    alpha = 1 - (value_num - 1) * disagree / (float(value_num) ** 2 - label_square)
+    return kappa, alpha
+
+
+def file_agreement(file_list):
+    """
+    Agreement of the annotators of file_list, runs in a worker process of the admin tool
+    :return: (kappa, alpha, number of tokens compared)
+    """
+    matrix, _ = label_matrix([load_entity_table(file_name) for file_name in file_list])
+    kappa, alpha = agreement_scores(matrix)
+    return kappa, alpha, matrix.shape[1]
+
+
+def agreement_string(score):
+    if score != 'Nan':
+        return str(round(score, 4))
+    return score
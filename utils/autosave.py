@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+def atomic_write(file_name, content, encoding='utf-8'):
+    """write to a temp file in the same directory then rename, a crash never leaves a truncated file"""
+    directory = os.path.dirname(os.path.abspath(file_name))
+    fd, temp_name = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(file_name), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding=encoding) as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        if os.path.exists(file_name):
+            shutil.copymode(file_name, temp_name)
+        else:
+            os.chmod(temp_name, 0o644)
+        os.replace(temp_name, file_name)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+class AutoSaver:
+    """
+    Write-behind saver running on a background thread.
+    Save requests arriving within `delay` seconds of each other are merged into one write,
+    the GUI thread only hands over the content and never waits for the disk.
+    """
+
+    def __init__(self, delay=0.5, max_delay=3.0):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.pending = {}  # file_name -> (content, encoding), only the latest content is kept
+        self.queue_depth = 0  # save requests merged into the pending write
+        self.flush_latency = 0.0  # seconds spent by last flush
+        self.flush_count = 0
+        self.error = None
+        self._condition = threading.Condition()
+        self._last_request = 0.0
+        self._first_request = 0.0
+        self._writing = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='AutoSaver', daemon=True)
+        self._thread.start()
+
+    def save(self, file_name, content, encoding='utf-8'):
+        with self._condition:
+            now = time.monotonic()
+            if not self.pending:
+                self._first_request = now
+            self._last_request = now
+            self.pending[file_name] = (content, encoding)
+            self.queue_depth += 1
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {'queue_depth': self.queue_depth, 'flush_latency': self.flush_latency,
+                    'flush_count': self.flush_count}
+
+    def take_error(self):
+        """last write error since the previous call, or None"""
+        with self._condition:
+            error, self.error = self.error, None
+            return error
+
+    def flush(self, timeout=10.0) -> bool:
+        """write pending content now and wait for it, return False on timeout"""
+        with self._condition:
+            self._first_request = self._last_request = 0.0
+            self._condition.notify_all()
+            return self._condition.wait_for(lambda: not self.pending and not self._writing, timeout)
+
+    def stop(self, timeout=10.0) -> bool:
+        """flush and end the thread, return False if pending content could not be written within timeout"""
+        flushed = self.flush(timeout)
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        return flushed
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self.pending or self._stopped)
+                if self._stopped and not self.pending:
+                    return
+                # debounce: wait until requests stop arriving, but not longer than max_delay
+                while not self._stopped:
+                    now = time.monotonic()
+                    deadline = min(self._last_request + self.delay, self._first_request + self.max_delay)
+                    if now >= deadline:
+                        break
+                    self._condition.wait(deadline - now)
+                pending, self.pending = self.pending, {}
+                self.queue_depth = 0
+                self._writing = True
+            start = time.monotonic()
+            try:
+                for file_name, (content, encoding) in pending.items():
+                    try:
+                        atomic_write(file_name, content, encoding)
+                    except Exception as e:
+                        # e.g. UnicodeEncodeError from the file encoding, the thread must survive it
+                        print("AutoSaver: failed to write", file_name, e)
+                        with self._condition:
+                            self.error = e
+            finally:
+                with self._condition:
+                    self.flush_latency = time.monotonic() - start
+                    self.flush_count += 1
+                    self._writing = False
+                    self._condition.notify_all()
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import html
+from itertools import groupby, zip_longest
+
 from .metric4ann import *
 
 
@@ -37,22 +40,20 @@ def compareBoundary(gold_file, pred_file, out_file_name):
                                                                                                               "\_") + "}" + '\\\\' + '\n')
     out_file.write("File2 color: " + "\colorbox{red!30}{Red}; Dir: \colorbox{red!30}{" + pred_file.replace("_",
                                                                                                            "\_") + "}" + '\\\\' + '\n')
-    final_f = compare_f_measure_by_type(gold_file, pred_file)
-    # print final_f
+    ## score all granularities from the lines read above, the tables are cached for the next comparison
+    statistics = comparison_statistics(load_entity_table(gold_file, lines=gold_lines),
+                                       load_entity_table(pred_file, lines=pred_lines))
     out_file.write("\\begin{table}[!htbp]\n")
     out_file.write("\\centering\n")
     out_file.write("\\caption{Statistics for two annotations, assume File1 as gold standard}\n")
-    out_file.write("\\begin{tabular}{l|l|l}\n")
+    out_file.write("\\begin{tabular}{l|l|l|l}\n")
     out_file.write("\\hline\n")
-    out_file.write("P/R/F (\%)& Entity &Boundary\\\\\n")
+    out_file.write("P/R/F (\%)& Entity &Parent Type &Boundary\\\\\n")
     out_file.write("\\hline\n")
-    for idx in range(len(final_f) - 2):
-        results = final_f[idx].split(':')
-        out_file.write(("%s& %s &--\\\\\n") % (results[0], results[1]))
-    over_entity = final_f[-2].split(":")[1]
-    over_chunk = final_f[-1].split(":")[1]
+    for row in statistics[:-1]:
+        out_file.write(("%s& %s &%s &%s\\\\\n") % row)
     out_file.write("\\hline\n")
-    out_file.write(("Overall& %s &%s\\\\\n") % (over_entity, over_chunk))
+    out_file.write(("%s& %s &%s &%s\\\\\n") % statistics[-1])
     out_file.write("\\hline\n")
     out_file.write("\\end{tabular}\n")
     out_file.write("\\end{table}\n")
@@ -62,21 +63,13 @@ def compareBoundary(gold_file, pred_file, out_file_name):
     out_file.write("\\colorbox{green!30}{Green}: annotated in both files.\\\\\n")
     out_file.write("\\rule{5cm}{0.1em}\\\\\n")
     out_file.write("\\vspace{0.3cm}\\\\\n")
-    remove_seg = False
     for idx in range(sentence_num):
         if idx >= end_line:
             continue
         if idx < start_line:
             continue
         # print gold_lines[idx]
-        gold_enity_list, gold_sentence, gold_bound = get_ner_from_sentence(gold_lines[idx], remove_seg)
-        # print "gold:", gold_enity_list
-        gold_filter_entity = filter_entity(gold_enity_list, 2)
-        # print "gold:", gold_filter_entity
-        pred_entity_list, pred_sentence, pred_bound = get_ner_from_sentence(pred_lines[idx], remove_seg)
-        pred_filter_entity = filter_entity(pred_entity_list, 2)
-        # print "pred:",pred_filter_entity
-        out_latex = generate_latex(gold_sentence, gold_bound, pred_bound)
+        out_latex = segments_latex(line_segments(gold_lines[idx], pred_lines[idx]))
         # out_latex = generate_specific_latex(gold_sentence, gold_enity_list, pred_entity_list).encode('utf-8')å
         out_file.write(out_latex + '\\\\' + '\n')
     write_end(out_file)
@@ -320,151 +313,205 @@ def entity_overlap_span(gold_entity, pred_entity):
         return -1
 
 
-def generate_latex(sentence, gold_bound, pred_bound):
-    sent_length = len(sentence)
-    word_chunk = []
-    color_chunk = []
-    word_segment = ''
-    segment_tag = -2
-    output_string = ''
-    for idx in range(sent_length):
-        word = sentence[idx]
-        if gold_bound[idx] == 1:
-            if pred_bound[idx] == 1:
-                if segment_tag == 2:
-                    word_segment += word
-                else:
-                    if segment_tag != -2:
-                        word_chunk.append(word_segment)
-                        color_chunk.append(segment_tag)
-                    segment_tag = 2
-                    word_segment = word
-                    # print "segment 2:", word_segment
-            else:
-                if segment_tag == 1:
-                    word_segment += word
-                else:
-                    if segment_tag != -2:
-                        word_chunk.append(word_segment)
-                        color_chunk.append(segment_tag)
-                    segment_tag = 1
-                    word_segment = word
-                    # print "segment 1:", word_segment
-        else:
-            # print "".join(sentence)
-            # print gold_bound
-            # print pred_bound
-            # print len(pred_bound),len(gold_bound), len(sentence), idx
-            if pred_bound[idx] == 1:
-                if segment_tag == -1:
-                    word_segment += word
-                else:
-                    if segment_tag != -2:
-                        word_chunk.append(word_segment)
-                        color_chunk.append(segment_tag)
-                    segment_tag = -1
-                    word_segment = word
-                    # print "segment -1:", word_segment
+def comparison_statistics(gold_table, pred_table):
+    """
+    Rows of the statistics table, (type, entity, parent type, boundary) P/R/F strings, the overall row last
+    """
+    scores = score_entity_tables(gold_table, pred_table)
+    rows = []
+    for entity, prf in scores[0][0].items():
+        rows.append((entity, p_r_f_string(*prf), p_r_f_string(*scores[1][0][layer_type(entity, 1)]), "--"))
+    rows.append(("Overall",) + tuple(p_r_f_string(*scores[layer][1]) for layer in (0, 1, 2)))
+    return rows
+
+
+## color tag of a character by whether it is inside an entity of (File1, File2)
+BOUND_TAG = {(1, 1): 2, (1, 0): 1, (0, 1): -1, (0, 0): 0}
+
+
+def bound_segments(sentence, gold_bound, pred_bound):
+    """
+    Split sentence into runs of characters with the same color tag,
+    2: annotated in both files, 1: only in File1, -1: only in File2, 0: not annotated
+    :return: list of (text, tag)
+    """
+    segments = []
+    start = 0
+    pairs = zip_longest(gold_bound, pred_bound[:len(gold_bound)], fillvalue=0)
+    for tag, group in groupby(BOUND_TAG[pair] for pair in pairs):
+        end = start + sum(1 for _ in group)
+        segments.append(("".join(sentence[start:end]), tag))
+        start = end
+    return segments
+
+
+def span_segments(text, gold_spans, pred_spans):
+    """
+    Same as bound_segments, from the outermost spans of each file instead of a bound per character
+    :param gold_spans: spans of File1 in text, sorted and not overlapping, as outermost_spans returns
+    """
+    length = len(text)
+    ## (position, file, +1/-1) where a file enters or leaves an entity, spans of one file never overlap
+    events = []
+    for which, spans in enumerate((gold_spans, pred_spans)):
+        events += [(min(span[0], length), which, 1) for span in spans]
+        events += [(min(span[1], length), which, -1) for span in spans]
+    events.sort()
+    runs = []  # [start, end, tag]
+    inside = [0, 0]
+    last = 0
+    for pos, which, delta in events + [(length, 0, 0)]:
+        if pos > last:
+            tag = BOUND_TAG[inside[0], inside[1]]
+            if runs and runs[-1][2] == tag:
+                runs[-1][1] = pos
             else:
-                if segment_tag == 0:
-                    word_segment += word
-                else:
-                    if segment_tag != -2:
-                        word_chunk.append(word_segment)
-                        color_chunk.append(segment_tag)
-                    segment_tag = 0
-                    word_segment = word
-                    # print "segment 0:", word_segment
-    if segment_tag != -2:
-        word_chunk.append(word_segment)
-        color_chunk.append(segment_tag)
-
-    for idx in range(len(word_chunk)):
-        # print word_chunk[idx], color_chunk[idx]
-        if color_chunk[idx] == 2:
-            output_string += "\colorbox{green!30}{" + word_chunk[idx] + '}'
-        elif color_chunk[idx] == 1:
-            output_string += "\colorbox{blue!30}{" + word_chunk[idx] + '}'
-        elif color_chunk[idx] == 0:
-            output_string += word_chunk[idx]
-        elif color_chunk[idx] == -1:
-            output_string += "\colorbox{red!30}{" + word_chunk[idx] + '}'
+                runs.append([last, pos, tag])
+            last = pos
+        inside[which] += delta
+    return [(text[start:end], tag) for start, end, tag in runs]
+
+
+def line_segments(gold_line, pred_line):
+    """color segments of the text of gold_line, as bound_segments on get_ner_from_sentence(line, False)"""
+    gold_markup = parse_markup(gold_line.strip())
+    pred_markup = parse_markup(pred_line.strip())
+    return span_segments(gold_markup.text, outermost_spans(gold_markup.spans), outermost_spans(pred_markup.spans))
+
+
+LATEX_COLOR = {2: "green!30", 1: "blue!30", -1: "red!30"}
+
+
+def generate_latex(sentence, gold_bound, pred_bound):
+    return segments_latex(bound_segments(sentence, gold_bound, pred_bound))
+
 
+def segments_latex(segments):
+    output_list = []
+    for word_segment, tag in segments:
+        if tag in LATEX_COLOR:
+            output_list += ["\\colorbox{", LATEX_COLOR[tag], "}{", word_segment, "}"]
+        else:
+            output_list.append(word_segment)
+    output_string = "".join(output_list)
     if "%" in output_string:
-        output_string = output_string.replace("%", "\%")
+        output_string = output_string.replace("%", "\\%")
     return output_string
 
 
+HTML_CLASS = {2: "both", 1: "file1", -1: "file2"}
+
+
+def segments_html(segments):
+    output_list = []
+    for word_segment, tag in segments:
+        if tag in HTML_CLASS:
+            output_list += ['<span class="', HTML_CLASS[tag], '">', html.escape(word_segment), '</span>']
+        else:
+            output_list.append(html.escape(word_segment))
+    return "".join(output_list)
+
+
+def compareBoundaryHtml(gold_file, pred_file, out_file_name, page_size=500):
+    """
+    Same comparison as compareBoundary, written as one self-contained HTML file which needs no LaTeX build.
+    Sentences are streamed from both files into pages of page_size sentences, the browser lays out one page at a time.
+    :return: False if two files don't have same sentence number
+    """
+    gold_table = load_entity_table(gold_file)
+    pred_table = load_entity_table(pred_file)
+    if gold_table.sentence_num != pred_table.sentence_num:
+        return False
+    page_num = max(1, -(-gold_table.sentence_num // page_size))
+    with open(gold_file, encoding='utf-8') as gold_lines, open(pred_file, encoding='utf-8') as pred_lines, \
+            open(out_file_name, 'w', encoding='utf-8') as out_file:
+        out_file.write(HTML_HEAD)
+        out_file.write("<h2>Overall Statistics</h2>\n")
+        out_file.write('<p>File1 color: <span class="file1">Blue</span>; Dir: <span class="file1">%s</span><br>\n'
+                       % html.escape(gold_file))
+        out_file.write('File2 color: <span class="file2">Red</span>; Dir: <span class="file2">%s</span></p>\n'
+                       % html.escape(pred_file))
+        out_file.write("<table>\n<caption>Statistics for two annotations, assume File1 as gold standard</caption>\n")
+        out_file.write("<tr><th>P/R/F (%)</th><th>Entity</th><th>Parent Type</th><th>Boundary</th></tr>\n")
+        for row in comparison_statistics(gold_table, pred_table):
+            out_file.write("<tr>" + "".join("<td>" + html.escape(cell) + "</td>" for cell in row) + "</tr>\n")
+        out_file.write("</table>\n")
+        out_file.write("<h2>Detail Content Comparison</h2>\n")
+        out_file.write('<p><span class="file1">Blue</span>: only annotated in File1.<br>\n'
+                       '<span class="file2">Red</span>: only annotated in File2.<br>\n'
+                       '<span class="both">Green</span>: annotated in both files.</p>\n')
+        out_file.write(HTML_PAGER % (page_num, page_num))
+        for idx, (gold_line, pred_line) in enumerate(zip(gold_lines, pred_lines)):
+            if idx % page_size == 0:
+                if idx > 0:
+                    out_file.write("</div>\n")
+                out_file.write('<div class="page"%s>\n' % (" hidden" if idx > 0 else ""))
+            out_file.write('<p>' + segments_html(line_segments(gold_line, pred_line)) + '</p>\n')
+        if gold_table.sentence_num > 0:
+            out_file.write("</div>\n")
+        out_file.write(HTML_END)
+    return True
+
+
+HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Annotation Comparison Report</title>
+<style>
+body { font-family: sans-serif; margin: 2em auto; max-width: 60em; }
+table { border-collapse: collapse; margin: 1em 0; }
+th, td { border: 1px solid #999; padding: 0.2em 0.6em; text-align: left; }
+tr:last-child td { border-top: 2px solid #333; }
+.file1 { background: #b3b3ff; }
+.file2 { background: #ffb3b3; }
+.both { background: #b3ffb3; }
+.page p { white-space: pre-wrap; margin: 0.3em 0; }
+</style>
+</head>
+<body>
+<h1>Annotation Comparison Report</h1>
+"""
+
+HTML_PAGER = """<p class="pager">
+<button onclick="showPage(current - 1)">Previous</button>
+Page <input id="pageInput" type="number" min="1" max="%d" value="1" onchange="showPage(this.value - 1)"> of %d
+<button onclick="showPage(current + 1)">Next</button>
+</p>
+"""
+
+HTML_END = """<script>
+var pages = document.getElementsByClassName("page");
+var current = 0;
+function showPage(idx) {
+    idx = Math.max(0, Math.min(pages.length - 1, Math.floor(idx)));
+    pages[current].hidden = true;
+    pages[idx].hidden = false;
+    current = idx;
+    document.getElementById("pageInput").value = idx + 1;
+}
+</script>
+</body>
+</html>
+"""
+
+
 def get_ner_from_sentence(sentence, remove_seg=True):
     ## remove segmentation space, avoid segmentation changes
     if remove_seg:
         sentence = sentence.strip().replace(' ', '')
     else:
         sentence = sentence.strip()
-    sentence_len = len(sentence)
-    # print sentence
-    entity_start = []
-    words = []
-    words_bound = []
-    last_char = ''
-    entity_type_start = False
-    entity_type = ''
-    word_id = 0
+    markup = parse_markup(sentence)
+    words = list(markup.text)
+    words_bound = [0] * len(words)
     entity_list = []
-    origin_text = ""
-    for idx in range(sentence_len):
-        if sentence[idx] == '[':
-            left_bracket = True
-        elif sentence[idx] == '@' or sentence[idx] == '$':
-            if last_char == '[':
-                entity_start.append(word_id)
-            else:
-                words.append(sentence[idx])
-                word_id += 1
-                words_bound.append(0)
-        elif sentence[idx] == '#':
-            if len(entity_start) > 0:
-                entity_type_start = True
-            else:
-                words.append(sentence[idx])
-                word_id += 1
-                words_bound.append(0)
-        elif sentence[idx] == ']':
-            if last_char == '*':
-                ## remove inside nested entity
-                if len(entity_start) > 1:
-                    entity_start.pop()
-                    entity_type = ''
-                    entity_type_start = False
-                elif len(entity_start) == 1:
-                    entity_info = '[' + str(entity_start[0]) + ',' + str(word_id - 1) + ']:' + entity_type.strip('*')
-                    entity_list.append(entity_info)
-                    entity_type = ''
-                    entity_start = []
-                    entity_type_start = False
-                else:
-                    words.append(sentence[idx])
-                    word_id += 1
-                    words_bound.append(0)
-        else:
-            if entity_type_start:
-                entity_type += sentence[idx]
-            else:
-                words.append(sentence[idx])
-                word_id += 1
-                if entity_start:
-                    words_bound.append(1)
-                else:
-                    words_bound.append(0)
-
-        last_char = sentence[idx]
-    assert (len(words) == len(words_bound))
-    # print entity_list
-    # for idx in range(len(words)):
-    #     print words[idx],'/',words_bound[idx], " ",
-
+    ## gold and recommended entities, remove inside nested entity
+    for start, end, _, label, _ in outermost_spans(markup.spans):
+        entity_info = '[' + str(start) + ',' + str(end - 1) + ']:' + label.strip('*')
+        entity_list.append(entity_info)
+        words_bound[start:end] = [1] * (end - start)
     return entity_list, words, words_bound
-    # print entity_list
 
 
 def calculate_average(input_array):
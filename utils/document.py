@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+import re
+from bisect import bisect_left, bisect_right
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from itertools import accumulate
+from operator import itemgetter
+from typing import List, NamedTuple, Optional, Tuple
+
+from .markup import outermost_spans, parse_markup, render_markup
+
+
+## characters outside the BMP, which Tcl 8.6 counts as two characters (a UTF-16 surrogate pair)
+_NON_BMP = re.compile('[\U00010000-\U0010ffff]')
+_SURROGATE = re.compile('[\ud800-\udfff]')
+
+
+def _surrogate_pair(match) -> str:
+    code = ord(match.group()) - 0x10000
+    return chr(0xD800 | code >> 10) + chr(0xDC00 | code & 0x3FF)
+
+
+def tcl_text(text: str) -> str:
+    """text counted like Tcl does, each non-BMP character replaced by its surrogate pair"""
+    if _NON_BMP.search(text) is None:
+        return text
+    return _NON_BMP.sub(_surrogate_pair, text)
+
+
+def python_text(text: str) -> str:
+    """inverse of tcl_text, for text leaving the Document, e.g. to Tk or to a file"""
+    if _SURROGATE.search(text) is None:
+        return text
+    return text.encode('utf-16-le', 'surrogatepass').decode('utf-16-le', 'replace')
+
+
+class LineOffsets:
+    """
+    Absolute offset of the start of each row. Line lengths (newline included) are kept in blocks of
+    about BLOCK_SIZE rows, with the rows and characters before each block, so a lookup is a bisect over
+    the blocks plus a C-level sum within one block. An edit, even one adding or removing rows, only
+    rewrites the blocks it covers and the block totals after them, O(BLOCK_SIZE + rows / BLOCK_SIZE).
+    """
+    BLOCK_SIZE = 512
+
+    def __init__(self, lines: List[str]):
+        lengths = [len(line) + 1 for line in lines]
+        self.blocks = self._chunk(lengths) or [[]]
+        self.block_sizes = [len(block) for block in self.blocks]  # rows of each block
+        self.block_sums = [sum(block) for block in self.blocks]  # characters of each block
+        self.block_rows = [0]  # rows before each block, then the total
+        self.block_chars = [0]  # characters before each block, then the total
+        self._reindex(0)
+
+    def _chunk(self, lengths: List[int]) -> List[List[int]]:
+        size = self.BLOCK_SIZE
+        return [lengths[idx:idx + size] for idx in range(0, len(lengths), size)]
+
+    def _reindex(self, first: int):
+        """recompute the rows and characters before the blocks after first, from the block totals"""
+        rows, chars = self.block_rows[first], self.block_chars[first]
+        self.block_rows[first + 1:] = [rows + size for size in accumulate(self.block_sizes[first:])]
+        self.block_chars[first + 1:] = [chars + size for size in accumulate(self.block_sums[first:])]
+
+    def _locate(self, row: int) -> (int, int):
+        """block of row, and index of row within it"""
+        block = min(bisect_right(self.block_rows, row - 1), len(self.blocks)) - 1
+        return block, row - 1 - self.block_rows[block]
+
+    def replace(self, first_row: int, last_row: int, lengths: List[int]):
+        """rows first_row..last_row are replaced by rows of the given lengths, newline included"""
+        first_block, first_idx = self._locate(first_row)
+        last_block, last_idx = self._locate(last_row)
+        merged = self.blocks[first_block][:first_idx] + lengths + self.blocks[last_block][last_idx + 1:]
+        ## a replace always leaves at least one row, merged is never empty
+        new_blocks = self._chunk(merged) if len(merged) > 2 * self.BLOCK_SIZE else [merged]
+        self.blocks[first_block:last_block + 1] = new_blocks
+        self.block_sizes[first_block:last_block + 1] = [len(block) for block in new_blocks]
+        self.block_sums[first_block:last_block + 1] = [sum(block) for block in new_blocks]
+        self._reindex(first_block)
+
+    def row_start(self, row: int) -> int:
+        """offset of (row, 0)"""
+        block, idx = self._locate(row)
+        return self.block_chars[block] + sum(self.blocks[block][:idx])
+
+    def find_row(self, offset: int) -> (int, int):
+        """row containing offset, and the offset of its start"""
+        block = bisect_right(self.block_chars, offset) - 1
+        if block >= len(self.blocks):
+            return self.block_rows[-1] + 1, self.block_chars[-1]
+        ends = list(accumulate(self.blocks[block], initial=self.block_chars[block]))
+        idx = bisect_right(ends, offset) - 1
+        return self.block_rows[block] + idx + 1, ends[idx]
+
+
+class Document:
+    """
+    In-memory copy of the annotated text, kept in sync with the Editor widget.
+    Text is stored as a list of lines so an edit only touches the rows it covers.
+    Positions are (row, col) tuples, row starts from 1 and col from 0, same as Tk text index.
+    Text is stored as tcl_text, so a col counts a non-BMP character as two like the Tk index does.
+    Absolute character offsets, e.g. of the whole text, convert to and from positions through line_offsets.
+    """
+
+    def __init__(self, text: str = ''):
+        self.lines = text.split('\n')
+        self.line_offsets = LineOffsets(self.lines)
+
+    def line_count(self) -> int:
+        return len(self.lines)
+
+    def end(self) -> (int, int):
+        """position just after the last character"""
+        return len(self.lines), len(self.lines[-1])
+
+    def text(self) -> str:
+        return '\n'.join(self.lines)
+
+    def offset(self, pos: (int, int)) -> int:
+        """absolute offset of position, counting a newline as one character like Tk `+Nc`"""
+        return self.line_offsets.row_start(pos[0]) + pos[1]
+
+    def position(self, offset: int) -> (int, int):
+        """position of absolute offset, clamped to the document"""
+        if offset <= 0:
+            return 1, 0
+        row, start = self.line_offsets.find_row(offset)
+        if row > len(self.lines):
+            return self.end()
+        return row, offset - start
+
+    def get(self, start: (int, int), end: (int, int)) -> str:
+        (start_row, start_col), (end_row, end_col) = start, end
+        if start_row == end_row:
+            return self.lines[start_row - 1][start_col:end_col]
+        parts = [self.lines[start_row - 1][start_col:]]
+        parts.extend(self.lines[start_row:end_row - 1])
+        parts.append(self.lines[end_row - 1][:end_col])
+        return '\n'.join(parts)
+
+    def replace(self, start: (int, int), end: (int, int), text: str) -> (int, int):
+        """
+        Replace text between start and end
+        :return: position just after the inserted text
+        """
+        (start_row, start_col), (end_row, end_col) = start, end
+        head = self.lines[start_row - 1][:start_col]
+        tail = self.lines[end_row - 1][end_col:]
+        new_lines = (head + text + tail).split('\n')
+        self.line_offsets.replace(start_row, end_row, [len(line) + 1 for line in new_lines])
+        self.lines[start_row - 1:end_row] = new_lines
+        last_row = start_row + len(new_lines) - 1
+        return last_row, len(new_lines[-1]) - len(tail)
+
+
+def _longest_match(limit: int, same) -> int:
+    low, high = 0, limit
+    while low < high:
+        mid = (low + high + 1) // 2
+        if same(mid):
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def common_affix_length(old_text: str, new_text: str) -> (int, int):
+    """
+    Length of common prefix and common suffix (not overlapping with the prefix) of two strings.
+    Binary search on slices, so the comparison runs at C speed even for whole documents.
+    """
+    old_len, new_len = len(old_text), len(new_text)
+    prefix = _longest_match(min(old_len, new_len), lambda n: old_text[:n] == new_text[:n])
+    suffix = _longest_match(min(old_len, new_len) - prefix,
+                            lambda n: old_text[old_len - n:] == new_text[new_len - n:])
+    return prefix, suffix
+
+
+class RowSet:
+    """Set of rows stored as sorted, disjoint (first, last) ranges, cheap for large blocks of rows"""
+
+    def __init__(self):
+        self.ranges = []
+
+    def __len__(self):
+        return sum(last - first + 1 for first, last in self.ranges)
+
+    def __bool__(self):
+        return len(self.ranges) > 0
+
+    def clear(self):
+        self.ranges = []
+
+    def add(self, first: int, last: int):
+        merged = []
+        for start, end in self.ranges:
+            if end < first - 1 or start > last + 1:
+                merged.append((start, end))
+            else:
+                first, last = min(first, start), max(last, end)
+        merged.append((first, last))
+        self.ranges = sorted(merged)
+
+    def take(self, first: int, last: int) -> list:
+        """remove rows within [first, last] and return them as ranges"""
+        taken = []
+        kept = []
+        for start, end in self.ranges:
+            if end < first or start > last:
+                kept.append((start, end))
+                continue
+            if start < first:
+                kept.append((start, first - 1))
+            if end > last:
+                kept.append((last + 1, end))
+            taken.append((max(start, first), min(end, last)))
+        self.ranges = kept
+        return taken
+
+    def edit(self, first: int, old_last: int, new_last: int):
+        """rows first..old_last are replaced by rows first..new_last, shift the rows after them"""
+        delta = new_last - old_last
+        self.take(first, old_last)
+        self.ranges = [(start + delta, end + delta) if start > old_last else (start, end)
+                       for start, end in self.ranges]
+        self.add(first, new_last)
+
+
+class Entity(NamedTuple):
+    start: int  # col of the opening '['
+    end: int  # col just after the closing ']'
+    kind: str  # 'gold' or 'recommend'
+    text: str  # plain text of the entity, nested markup removed
+    label: str
+
+
+ENTITY_KINDS = {'@': 'gold', '$': 'recommend'}
+
+
+class EntityIndex:
+    """
+    Gold and recommended entities of each row, sorted by column.
+    Rows are parsed lazily by parse_markup, the same parser as the lexicon and the standoff model,
+    and re-parsed only when an edit touches them, so a lookup is a binary search within the row.
+    Only the outermost of nested entities is indexed, entities of a row never overlap.
+    """
+
+    def __init__(self):
+        self.document = None
+        self.rows = []
+
+    def reset(self, document: Document):
+        self.document = document
+        self.rows = [None] * document.line_count()
+
+    def edit(self, first: int, old_last: int, new_last: int):
+        """rows first..old_last are replaced by rows first..new_last, forget their parse result"""
+        self.rows[first - 1:old_last] = [None] * (new_last - first + 1)
+
+    def row_entities(self, row: int) -> List[Entity]:
+        entities = self.rows[row - 1]
+        if entities is None:
+            entities = []
+            markup = parse_markup(self.document.lines[row - 1])
+            if any(map(itemgetter(4), markup.spans)):
+                ranges = []
+                render_markup(markup.text, markup.spans, ranges)
+                outermost = set(map(id, outermost_spans(markup.spans)))
+                for span, (markup_start, markup_end) in zip(markup.spans, ranges):
+                    if id(span) in outermost:
+                        start, end, kind, label, _ = span
+                        entities.append(Entity(markup_start, markup_end, ENTITY_KINDS[kind],
+                                               markup.text[start:end], label))
+            else:
+                ## flat markup: each entity shifts the following ones by its `[@`, `#`, label and `*]`
+                shift = 0
+                for start, end, kind, label, _ in markup.spans:
+                    markup_start = start + shift
+                    shift += len(label) + 5
+                    entities.append(Entity(markup_start, end + shift, ENTITY_KINDS[kind],
+                                           markup.text[start:end], label))
+            self.rows[row - 1] = entities
+        return entities
+
+    def next_entity(self, row: int, col: int) -> Optional[Tuple[int, Entity]]:
+        """first entity starting at or after (row, col)"""
+        entities = self.row_entities(row)
+        idx = bisect_left(entities, (col,))
+        if idx < len(entities):
+            return row, entities[idx]
+        for next_row in range(row + 1, len(self.rows) + 1):
+            entities = self.row_entities(next_row)
+            if entities:
+                return next_row, entities[0]
+        return None
+
+    def previous_entity(self, row: int, col: int) -> Optional[Tuple[int, Entity]]:
+        """last entity ending at or before (row, col)"""
+        entities = self.row_entities(row)
+        idx = bisect_left(entities, (col,)) - 1
+        if idx >= 0 and entities[idx].end > col:
+            idx -= 1
+        if idx >= 0:
+            return row, entities[idx]
+        for prev_row in range(row - 1, 0, -1):
+            entities = self.row_entities(prev_row)
+            if entities:
+                return prev_row, entities[-1]
+        return None
+
+    def entities_in_range(self, start: (int, int), end: (int, int)) -> List[Tuple[int, Entity]]:
+        """entities overlapping [start, end)"""
+        found = []
+        for row in range(start[0], end[0] + 1):
+            for entity in self.row_entities(row):
+                if (row, entity.end) > start and (row, entity.start) < end:
+                    found.append((row, entity))
+        return found
+
+    def entity_at(self, row: int, col: int) -> Optional[Tuple[int, Entity]]:
+        """entity strictly containing col, i.e. cursor is inside the brackets"""
+        entities = self.row_entities(row)
+        idx = bisect_left(entities, (col,)) - 1
+        if idx >= 0 and entities[idx].start < col < entities[idx].end:
+            return row, entities[idx]
+        return None
+
+
+@dataclass
+class Action:
+    """edits done by one user action, each edit is (first_row, removed_rows, inserted_rows) of the standoff model"""
+    cursor_before: str
+    cursor_after: str = None
+    edits: list = field(default_factory=list)
+    size: int = 0
+
+
+class EditHistory:
+    """
+    Undo/redo log of edits grouped by user action.
+    Only the rows removed and inserted by each edit are kept, (plain text, spans) tuples of the standoff model,
+    so undo costs time proportional to the change.
+    Oldest actions are dropped once the log holds more than budget characters.
+    """
+
+    def __init__(self, budget: int = 10000000):
+        self.budget = budget
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.size = 0
+        self.recording = True
+        self._current = None
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack = []
+        self.size = 0
+        self._current = None
+
+    @contextmanager
+    def paused(self):
+        recording, self.recording = self.recording, False
+        try:
+            yield
+        finally:
+            self.recording = recording
+
+    @contextmanager
+    def recording_into(self, action: Action):
+        """record following edits as part of an earlier action, so they are undone together"""
+        current, self._current = self._current, action
+        try:
+            yield
+        finally:
+            self._current = current
+
+    def last_action(self) -> Optional[Action]:
+        return self.undo_stack[-1] if self.undo_stack else None
+
+    def begin(self, cursor: str):
+        """start an action, following edits are undone together"""
+        self.end(cursor)
+        self._current = Action(cursor)
+
+    def end(self, cursor: str):
+        if self._current is not None and self._current.edits:
+            self._current.cursor_after = cursor
+        self._current = None
+
+    def record(self, first_row: int, removed: list, inserted: list, cursor_before: str = None,
+               cursor_after: str = None):
+        """
+        Rows removed were replaced by rows inserted from first_row
+        :param cursor_before: cursor of an edit outside an action, e.g. user typing, which is undone on its own
+        """
+        if not self.recording:
+            return
+        if self._current is None:
+            action = Action(cursor_before or f'{first_row}.0')
+            action.cursor_after = cursor_after or f'{first_row}.0'
+        else:
+            action = self._current
+        if not action.edits:
+            self.undo_stack.append(action)
+            self.redo_stack = []
+        size = sum(len(text) + 1 for text, _ in removed) + sum(len(text) + 1 for text, _ in inserted)
+        action.edits.append((first_row, removed, inserted))
+        action.size += size
+        self.size += size
+        while self.size > self.budget and len(self.undo_stack) > 1:
+            self.size -= self.undo_stack.popleft().size
+
+    def undo(self) -> Optional[Action]:
+        if not self.undo_stack:
+            return None
+        self._current = None
+        action = self.undo_stack.pop()
+        self.size -= action.size
+        self.redo_stack.append(action)
+        return action
+
+    def redo(self) -> Optional[Action]:
+        if not self.redo_stack:
+            return None
+        self._current = None
+        action = self.redo_stack.pop()
+        self.undo_stack.append(action)
+        self.size += action.size
+        return action
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+import mmap
+import os
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .markup import outermost_spans, parse_markup, render_markup, split_flat_markup
+
+## flat recommended (group: its words) and gold entities, same syntax as the entities of markup.parse_markup
+_RECOMMEND = re.compile(r'\[\$([^\[#\n]*)#[^\[#\n*]*\*\]')
+_GOLD = re.compile(r'\[@[^\[#\n]*#[^\[#\n*]*\*\]')
+
+
+def guess_segmented(sample):
+    """False for non-segmented Chinese, True for English or Segmented Chinese."""
+    if len(sample) == 0:
+        return True
+    ascii_percent = sum(1 for c in sample if c.isascii()) / len(sample)
+    is_english = (ascii_percent > 0.8)
+    space_percent = sample.count(' ') / len(sample)
+    many_space = (space_percent > 0.2)
+    return is_english or many_space or False
+
+
+def iter_file_lines(ann_file, encoding='utf-8', start=0, end=None):
+    """
+    Yield lines of ann_file between byte offsets start and end through mmap, without reading the
+    whole file. Line ends are normalized to '\\n' as in text mode. Encoding must be ASCII compatible.
+    """
+    with open(ann_file, 'rb') as fp:
+        size = os.fstat(fp.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            mm.seek(start)
+            while mm.tell() < end:
+                line = mm.readline().decode(encoding)
+                if '\r' in line:
+                    yield from line.replace('\r\n', '\n').replace('\r', '\n').splitlines(True)
+                else:
+                    yield line
+
+
+def iter_sequence(lines, segmented=True, tagScheme="BMES", onlyNP=False, keepRecommended=True):
+    """Yield the exported text of each annotated line"""
+    for line in lines:
+        if len(line) <= 2:
+            yield '\n'
+            continue
+        # use null line to separate sentences
+        yield ''.join(getWordTagPairs(line, segmented, tagScheme, onlyNP, keepRecommended)) + '\n'
+
+
+def iter_row_sequence(rows, segmented=True, tagScheme="BMES", onlyNP=False, keepRecommended=True):
+    """iter_sequence of (plain text, spans) rows of the standoff model"""
+    for text, spans in rows:
+        if len(text) <= 1 and not spans:
+            yield '\n'
+            continue
+        yield ''.join(spanWordTagPairs(text, spans, segmented, tagScheme, onlyNP, keepRecommended)) + '\n'
+
+
+def write_buffered(fp, strings, buffer_size=1 << 20):
+    """write strings in chunks of about buffer_size characters, return number of strings"""
+    count = 0
+    buffer = []
+    buffered = 0
+    for string in strings:
+        buffer.append(string)
+        buffered += len(string)
+        count += 1
+        if buffered >= buffer_size:
+            fp.write(''.join(buffer))
+            buffer = []
+            buffered = 0
+    fp.write(''.join(buffer))
+    return count
+
+
+def export_file(ann_file, seq_file, segmented=True, tagScheme="BMES", onlyNP=False, keepRecommended=True,
+                encoding='utf-8', start=0, end=None):
+    """
+    Export one .ann file (or its lines between byte offsets start and end) into sequence format,
+    one `word tag` pair per line, sentences separated by empty line.
+    The file is streamed, memory stays constant whatever the file size.
+    :return: number of lines exported
+    """
+    lines = iter_file_lines(ann_file, encoding, start, end)
+    with open(seq_file, 'w', encoding=encoding) as seqFile:
+        return write_buffered(seqFile, iter_sequence(lines, segmented, tagScheme, onlyNP, keepRecommended))
+
+
+def export_rows(rows, seq_file, segmented=True, tagScheme="BMES", onlyNP=False, keepRecommended=True,
+                encoding='utf-8'):
+    """
+    Export (plain text, spans) rows of the standoff model, e.g. the document open in the Editor, like export_file
+    :param rows: list of rows
+    :return: number of lines exported
+    """
+    ## the empty row after a final newline is not a line of its own, as when the saved file is read back
+    if rows and rows[-1] == ('', ()):
+        rows = rows[:-1]
+    with open(seq_file, 'w', encoding=encoding) as seqFile:
+        return write_buffered(seqFile, iter_row_sequence(rows, segmented, tagScheme, onlyNP, keepRecommended))
+
+
+def shard_offsets(ann_file, shard_num):
+    """split file into at most shard_num byte ranges, each ending at a line end"""
+    size = os.path.getsize(ann_file)
+    if size == 0 or shard_num <= 1:
+        return [(0, size)]
+    bounds = [0]
+    with open(ann_file, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for idx in range(1, shard_num):
+            newline = mm.find(b'\n', max(size * idx // shard_num, bounds[-1]))
+            if newline == -1:
+                break
+            if newline + 1 < size:
+                bounds.append(newline + 1)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def concatenate_parts(seq_file, part_files):
+    with open(seq_file, 'wb') as out:
+        for part_file in part_files:
+            with open(part_file, 'rb') as part:
+                shutil.copyfileobj(part, out, 1 << 20)
+            os.remove(part_file)
+
+
+def _export_job(args):
+    ann_file, seq_file, segmented, tagScheme, onlyNP, keepRecommended, encoding, start, end = args
+    line_num = export_file(ann_file, seq_file, segmented, tagScheme, onlyNP, keepRecommended, encoding, start, end)
+    return ann_file, line_num, end - start
+
+
+def _shard_jobs(ann_file, seq_file, shard_num, options):
+    """export jobs writing each shard into its own part file"""
+    jobs = []
+    for idx, (start, end) in enumerate(shard_offsets(ann_file, shard_num)):
+        jobs.append((ann_file, f'{seq_file}.part{idx}') + options + (start, end))
+    return jobs
+
+
+def export_large_file(ann_file, seq_file, segmented=True, tagScheme="BMES", onlyNP=False, keepRecommended=True,
+                      encoding='utf-8', shard_num=None, workers=None):
+    """
+    Split ann_file into line-range shards, export them in parallel and concatenate the output in order
+    :return: number of lines exported
+    """
+    options = (segmented, tagScheme, onlyNP, keepRecommended, encoding)
+    jobs = _shard_jobs(ann_file, seq_file, shard_num or os.cpu_count() or 1, options)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        line_num = sum(lines for _, lines, _ in executor.map(_export_job, jobs))
+    concatenate_parts(seq_file, [job[1] for job in jobs])
+    return line_num
+
+
+def export_directory(input_dir, output_dir=None, segmented=None, tagScheme="BMES", onlyNP=False,
+                     keepRecommended=True, encoding='utf-8', workers=None, shard_size=64 << 20):
+    """
+    Export every .ann file under input_dir (recursively) through a process pool.
+    Output keeps the relative path, with .ann replaced by the tag scheme, e.g. `a/b.txt.ann` -> `a/b.txt.bmes`.
+    Files larger than shard_size bytes are split into shards exported in parallel.
+    :param segmented: None to guess for each file from its first 100 characters
+    :param shard_size: 0 to export every file as a whole
+    :return: (file number, line number, byte number, seconds)
+    """
+    output_dir = output_dir or input_dir
+    jobs = []
+    sharded = []  # (seq_file, part files)
+    file_num = 0
+    for root, _, files in os.walk(input_dir):
+        for name in sorted(files):
+            if not name.endswith('.ann'):
+                continue
+            file_num += 1
+            ann_file = os.path.join(root, name)
+            seq_file = os.path.join(output_dir, os.path.relpath(ann_file, input_dir))
+            seq_file = seq_file[:-len('.ann')] + '.' + tagScheme.lower()
+            os.makedirs(os.path.dirname(seq_file), exist_ok=True)
+            file_segmented = segmented
+            if file_segmented is None:
+                with open(ann_file, 'r', encoding=encoding) as fp:
+                    file_segmented = guess_segmented(fp.read(100))
+            options = (file_segmented, tagScheme, onlyNP, keepRecommended, encoding)
+            size = os.path.getsize(ann_file)
+            if shard_size <= 0 or size <= shard_size:
+                jobs.append((ann_file, seq_file) + options + (0, size))
+            else:
+                shard_jobs = _shard_jobs(ann_file, seq_file, -(-size // shard_size), options)
+                sharded.append((seq_file, [job[1] for job in shard_jobs]))
+                jobs += shard_jobs
+    start = time.perf_counter()
+    line_num, byte_num = 0, 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for _, lines, size in executor.map(_export_job, jobs, chunksize=max(1, len(jobs) // 256)):
+            line_num += lines
+            byte_num += size
+    for seq_file, part_files in sharded:
+        concatenate_parts(seq_file, part_files)
+    return file_num, line_num, byte_num, time.perf_counter() - start
+
+
+def getWordTagPairs(tagedSentence, segmented=True, tagScheme="BMES", onlyNP=False, keepRecommended=True):
+    """
+    :param keepRecommended: tag recommended entities too, otherwise their words are tagged O
+    :return: list of `word tag\n` of the sentence
+    """
+    sentence = tagedSentence.strip('\n')
+    parts = split_flat_markup(sentence)
+    if parts is not None and (keepRecommended or '[$' not in sentence):
+        ## no nesting: chunks come straight from the split, [plain, kind, entity, label, plain, ...]
+        chunks = [(parts[0], None)]
+        for idx in range(2, len(parts), 4):
+            chunks += ((parts[idx], parts[idx + 1]), (parts[idx + 2], None))
+        return turnFullListToOutputPair(chunks, segmented, tagScheme, onlyNP)
+    markup = parse_markup(sentence)
+    return spanWordTagPairs(markup.text, markup.spans, segmented, tagScheme, onlyNP, keepRecommended)
+
+
+def spanWordTagPairs(text, spans, segmented=True, tagScheme="BMES", onlyNP=False, keepRecommended=True):
+    """
+    getWordTagPairs of plain text annotated with spans, e.g. a row of the standoff model
+    :return: list of `word tag\n` of the sentence
+    """
+    if not keepRecommended:
+        spans = [span for span in spans if span[2] == '@']
+    ## only use the largest span of nested entities
+    spans = outermost_spans(spans)
+    chunks = []  # (chunk_of_words, label), label is None for words not tagged
+    last_end = 0
+    for start, end, _, label, _ in spans:
+        chunks.append((text[last_end:start], None))
+        chunks.append((text[start:end], label))
+        last_end = end
+    chunks.append((text[last_end:], None))
+    return turnFullListToOutputPair(chunks, segmented, tagScheme, onlyNP)
+
+
+def turnFullListToOutputPair(fullList, segmented=True, tagScheme="BMES", onlyNP=False):
+    pair_list = []
+    for chunk_words, label in fullList:
+        if label is not None:
+            plain_words = chunk_words
+            label = label.strip('*')
+            if segmented:
+                plain_words = plain_words.split()
+            if onlyNP:
+                label = "NP"
+            pair_list += outputWithTagScheme(plain_words, label, tagScheme)
+        else:
+            if segmented:
+                words = chunk_words.split()
+            else:
+                words = chunk_words.replace(' ', '')  # actually chars
+            pair_list += [word_or_char + ' O\n' for word_or_char in words]
+    return pair_list
+
+
+def outputWithTagScheme(input_list, label, tagScheme="BMES"):
+    list_length = len(input_list)
+    if list_length == 0:
+        return []
+    if tagScheme == "BMES":
+        if list_length == 1:
+            return [input_list[0] + ' S-' + label + '\n']
+        middle = ' M-' + label + '\n'
+        return ([input_list[0] + ' B-' + label + '\n'] + [word + middle for word in input_list[1:-1]] +
+                [input_list[-1] + ' E-' + label + '\n'])
+    inside = ' I-' + label + '\n'
+    return [input_list[0] + ' B-' + label + '\n'] + [word + inside for word in input_list[1:]]
+
+
+def removeRecommendContent(content):
+    """remove markup of recommended entities, keep their words and gold entities"""
+    if '[$' not in content:
+        return content
+    ## common case, no nested or broken markup: replace each entity by its words in one C-level split
+    parts = _RECOMMEND.split(content)
+    if len(parts) // 2 == content.count('[$') and len(_GOLD.findall(content)) == content.count('[@'):
+        return ''.join(parts)
+    markup = parse_markup(content)
+    return render_markup(markup.text, [span for span in markup.spans if span[2] == '@'])
+
+
+def iter_without_recommend(lines):
+    """Yield lines with the markup of recommended entities removed, unchanged lines are yielded as is"""
+    for line in lines:
+        yield removeRecommendContent(line)
+
+
+def write_without_recommend(src, dst, buffer_size=1 << 20):
+    """
+    Copy file-like src into file-like dst without the markup of recommended entities.
+    Entities never span lines, so the text is stripped line by line and only one line is held at a time.
+    :return: number of lines written
+    """
+    return write_buffered(dst, iter_without_recommend(src), buffer_size)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Tokenizer of the inline entity markup `[@entity#Label*]` (gold) and `[$entity#Label*]` (recommended).
+The text is scanned once by compiled regexes which never backtrack over more than one entity,
+so parsing is linear in the text length whatever the input looks like.
+Entities may be nested, e.g. `[@[@Jie#Person*] Yang#Person*]`, but never span a newline.
+
+An entity is returned as a span tuple (start, end, kind, label, depth):
+start/end are offsets in the plain text, kind is '@' (gold) or '$' (recommend),
+depth is the number of entities containing it, 0 for the outermost.
+"""
+import re
+from itertools import accumulate, repeat
+from operator import itemgetter
+from typing import List, NamedTuple, Optional, Tuple
+
+## entity without nested markup
+_ENTITY = re.compile(r'\[([@$])([^\[#\n]*)#([^\[#\n*]*)\*\]')
+## single markup tokens, for nested or broken markup. `*]` closes the innermost entity even when followed
+## by the `#` of its parent, e.g. `[@a [@b#X*]#Y*]`, unlike the `\*\](?!\#)` of the old patterns
+_TOKEN = re.compile(_ENTITY.pattern + r'|\[[@$]|\*\]|#|\n')
+
+
+class Markup(NamedTuple):
+    text: str  # text with all markup removed
+    spans: List[Tuple[int, int, str, str, int]]  # in the order of the opening markup
+
+
+class _Open:
+    __slots__ = ('kind', 'pos', 'piece', 'start', 'span_num', 'hash_pos', 'hash_piece', 'hash_len')
+
+    def __init__(self, kind, pos, piece, start, span_num):
+        self.kind = kind
+        self.pos = pos  # raw position of the opening `[@`
+        self.piece = piece  # index of the piece beginning with the opening `[@`
+        self.start = start  # plain offset of the opening `[@`
+        self.span_num = span_num  # spans closed before this one opened
+        self.hash_pos = -1  # raw position of the last `#` seen while this entity is innermost
+
+
+def split_flat_markup(text: str) -> Optional[List[str]]:
+    """
+    Split text without nested or broken markup in one C-level pass
+    :return: [plain, kind, entity, label, plain, kind, entity, label, ..., plain],
+             None if some `[@`/`[$` does not start a flat entity
+    """
+    parts = _ENTITY.split(text)
+    if len(parts) // 4 == text.count('[@') + text.count('[$'):
+        return parts
+    return None
+
+
+def parse_markup(text: str) -> Markup:
+    """
+    Split annotated text into plain text and entity spans.
+    Markup which is never closed (no `#` or `*]`, or a newline first) is kept as plain text.
+    """
+    ## common case: every `[@`/`[$` starts a flat entity
+    parts = split_flat_markup(text)
+    if parts is not None:
+        entity_num = len(parts) // 4
+        ## plain offsets are the running length of the parts without kinds and labels, all at C speed
+        kinds, labels = parts[1::4], parts[3::4]
+        parts[1::4] = [''] * entity_num
+        parts[3::4] = [''] * entity_num
+        offsets = list(accumulate(map(len, parts), initial=0))
+        spans = list(zip(offsets[2::4], offsets[3::4], kinds, labels, repeat(0, entity_num)))
+        return Markup(''.join(parts), spans)
+    return _parse_nested(text)
+
+
+def _parse_nested(text: str) -> Markup:
+    pieces = []
+    spans = []  # (start, end, kind, label, depth, raw position of the opening `[@`)
+    stack = []
+    length = 0  # plain length of pieces
+    last = 0  # raw position up to which text is in pieces
+    nested = False
+    for match in _TOKEN.finditer(text):
+        pos = match.start()
+        kind, entity_text, label = match.groups()
+        if kind is not None:
+            if pos > last:
+                piece = text[last:pos]
+                pieces.append(piece)
+                length += len(piece)
+            pieces.append(entity_text)
+            spans.append((length, length + len(entity_text), kind, label, 0, pos))
+            length += len(entity_text)
+            last = match.end()
+            continue
+        token = match.group()
+        if token == '#':
+            if stack:
+                top = stack[-1]
+                piece = text[last:pos]
+                pieces.append(piece)
+                length += len(piece)
+                last = pos
+                top.hash_pos, top.hash_piece, top.hash_len = pos, len(pieces), length
+        elif token == '\n':
+            stack = []
+        elif token[0] == '[':
+            piece = text[last:pos]
+            pieces.append(piece)
+            length += len(piece)
+            last = pos
+            stack.append(_Open(token[1], pos, len(pieces), length, len(spans)))
+        elif stack and stack[-1].hash_pos >= 0:
+            entity = stack.pop()
+            label = text[entity.hash_pos + 1:pos]
+            ## drop `#label` and the opening `[@`, which shifts spans closed inside this entity,
+            ## spans closed after the `#` were part of the label
+            del pieces[entity.hash_piece:]
+            length = entity.hash_len - 2
+            pieces[entity.piece] = pieces[entity.piece][2:]
+            inner = spans[entity.span_num:]
+            if inner:
+                nested = True
+                del spans[entity.span_num:]
+                spans.extend((start - 2, end - 2, inner_kind, inner_label, depth + 1, opened)
+                             for start, end, inner_kind, inner_label, depth, opened in inner
+                             if start <= entity.hash_len)
+            spans.append((entity.start, length, entity.kind, label, 0, entity.pos))
+            last = match.end()
+    pieces.append(text[last:])
+    if nested:
+        ## order of the opening markup, i.e. an entity comes before the ones it contains
+        spans.sort(key=lambda span: span[5])
+    return Markup(''.join(pieces), [span[:5] for span in spans])
+
+
+def outermost_spans(spans: list) -> list:
+    """spans not contained in another one of the given spans, which are ordered as parse_markup returns"""
+    outermost = []
+    for span in spans:
+        if outermost:
+            kept = outermost[-1]
+            ## an empty span at the end of the kept one is inside it when nested deeper
+            if span[0] < kept[1] or span[0] == span[1] == kept[1] and span[4] > kept[4]:
+                continue
+        outermost.append(span)
+    return outermost
+
+
+def render_markup(text: str, spans: list, ranges: list = None) -> str:
+    """
+    Put the markup of spans back into plain text, inverse of parse_markup
+    :param spans: in the order of the opening markup, as returned by parse_markup
+    :param ranges: if given, receives the (start, end) offsets of the markup of each span in the result,
+                   in the order of spans
+    """
+    pieces = []
+    last = 0
+    if ranges is None and not any(map(itemgetter(4), spans)):
+        ## common case: no nested entity, nothing to close but the entity itself
+        for start, end, kind, label, _ in spans:
+            pieces += (text[last:start], '[', kind, text[start:end], '#', label, '*]')
+            last = end
+        pieces.append(text[last:])
+        return ''.join(pieces)
+    size = 0  # length of the result so far, only tracked for ranges
+    stack = []  # open entities, innermost last, with their index in spans
+    for idx, span in enumerate(spans):
+        start, end, kind, _, depth = span
+        ## close entities not containing this one; an entity ending here only contains it when it is empty
+        while stack and (stack[-1][0][4] >= depth or stack[-1][0][1] < start or stack[-1][0][1] == start < end):
+            closed, closed_idx = stack.pop()
+            pieces += [text[last:closed[1]], '#', closed[3], '*]']
+            if ranges is not None:
+                size += closed[1] - last + len(closed[3]) + 3
+                ranges[closed_idx] = (ranges[closed_idx][0], size)
+            last = closed[1]
+        pieces += [text[last:start], '[', kind]
+        if ranges is not None:
+            size += start - last
+            ranges.append((size, None))
+            size += 2
+        last = start
+        stack.append((span, idx))
+    while stack:
+        closed, closed_idx = stack.pop()
+        pieces += [text[last:closed[1]], '#', closed[3], '*]']
+        if ranges is not None:
+            size += closed[1] - last + len(closed[3]) + 3
+            ranges[closed_idx] = (ranges[closed_idx][0], size)
+        last = closed[1]
+    pieces.append(text[last:])
+    return ''.join(pieces)
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import os
+import pickle
 import sys
+from typing import List, NamedTuple
 
 import numpy as np
 
+from .markup import outermost_spans, parse_markup
+from .standoff import parse_rows
+
 
 def lines_to_label_list(input_lines):
     label_list = []
@@ -25,7 +32,11 @@ def compare_files(gold_file, pred_file, up_ignore_layer=0):
     # print "Compare files..."
     # print "Gold file:", gold_file
     # print "Pred file:", pred_file
-    gold_entity, pred_entity, match_entity = get_matched_ner_from_file(gold_file, pred_file, up_ignore_layer)
+    return compare_entity_tables(load_entity_table(gold_file), load_entity_table(pred_file), up_ignore_layer)
+
+
+def compare_entity_tables(gold_table, pred_table, up_ignore_layer=0):
+    gold_entity, pred_entity, match_entity, _ = match_entity_tables(gold_table, pred_table, up_ignore_layer)
 
     match_num = len(match_entity)
     gold_num = len(gold_entity)
@@ -53,159 +64,261 @@ def get_final_score(gold_num, pred_num, match_num):
 
 
 def get_matched_ner_from_file(gold_file, pred_file, up_ignore_layer=0):
-    gold_lines = open(gold_file, encoding='utf-8').readlines()
-    pred_lines = open(pred_file, encoding='utf-8').readlines()
-    sentence_num = len(gold_lines)
-    assert (sentence_num == len(pred_lines))
-    gold_entity = []
-    pred_entity = []
-    match_entity = []
-    start_line = 0
-    end_line = start_line + 1000000
-    for idx in range(sentence_num):
-        if idx >= end_line:
-            continue
-        if idx < start_line:
-            continue
-        # print gold_lines[idx]
-        gold_filter_entity = filter_entity(get_ner_from_sentence(gold_lines[idx]), up_ignore_layer)
-        # print "gold:", gold_filter_entity
-        pred_filter_entity = filter_entity(get_ner_from_sentence(pred_lines[idx]), up_ignore_layer)
-        # print "pred:",pred_filter_entity
-        match = list(set(gold_filter_entity).intersection(set(pred_filter_entity)))
-        gold_entity += gold_filter_entity
-        pred_entity += pred_filter_entity
-        match_entity += match
-    return gold_entity, pred_entity, match_entity
+    """
+    Entities of two files as `[start,end]:Type` strings (end inclusive), as get_ner_from_sentence gives them
+    :return: (gold, pred, match) lists of entity strings, see match_entity_files for the entity arrays
+    """
+    gold_entity, pred_entity, match_entity, type_names = match_entity_files(gold_file, pred_file, up_ignore_layer)
+    return tuple(entity_strings(entities, type_names) for entities in (gold_entity, pred_entity, match_entity))
+
+
+def match_entity_files(gold_file, pred_file, up_ignore_layer=0):
+    """
+    :return: (gold, pred, match) entity arrays and the type names their type ids refer to, as match_entity_tables
+    """
+    return match_entity_tables(load_entity_table(gold_file), load_entity_table(pred_file), up_ignore_layer)
+
+
+def entity_strings(entities, type_names):
+    return ['[' + str(start) + ',' + str(end - 1) + ']:' + type_names[type_id] for start, end, type_id in
+            zip(entities['start'].tolist(), entities['end'].tolist(), entities['type'].tolist())]
+
+
+def match_entity_tables(gold_table, pred_table, up_ignore_layer=0):
+    """
+    Match entities of two tables at the granularity of up_ignore_layer
+    :return: (gold, pred, match) entity arrays and the type names their type ids refer to
+    """
+    assert (gold_table.sentence_num == pred_table.sentence_num)
+    type_ids = {}
+    gold_entity = layer_entities(gold_table, up_ignore_layer, type_ids)
+    pred_entity = layer_entities(pred_table, up_ignore_layer, type_ids)
+    return gold_entity, pred_entity, match_entities(gold_entity, pred_entity), list(type_ids)
+
+
+def match_entities(gold_entity, pred_entity):
+    """Entities found in both arrays, each counted once as with the intersection of per-sentence sets"""
+    keys = entity_keys(gold_entity, pred_entity)
+    if keys is None:
+        return _match_entities_lexsort(gold_entity, pred_entity)
+    gold_keys, pred_keys = keys
+    if len(gold_keys) == 0 or len(pred_keys) == 0:
+        return gold_entity[:0]
+    order = np.argsort(gold_keys, kind='stable')
+    gold_keys = gold_keys[order]
+    first = np.ones(len(gold_keys), dtype=bool)
+    first[1:] = gold_keys[1:] != gold_keys[:-1]
+    gold_keys, order = gold_keys[first], order[first]
+    pred_keys = np.sort(pred_keys)
+    pos = np.searchsorted(pred_keys, gold_keys)
+    pos[pos == len(pred_keys)] = 0
+    return gold_entity[order[pred_keys[pos] == gold_keys]]
+
+
+def entity_keys(gold_entity, pred_entity):
+    """
+    Pack each entity into one int64 which sorts like (sentence, start, end, type),
+    None when the fields of these arrays need more than 63 bits
+    """
+    widths = [max(int(entities[name].max(initial=0)) for entities in (gold_entity, pred_entity)).bit_length()
+              for name in ENTITY_DTYPE.names]
+    if sum(widths) > 63:
+        return None
+    keys = []
+    for entities in (gold_entity, pred_entity):
+        key = np.zeros(len(entities), dtype=np.int64)
+        for name, width in zip(ENTITY_DTYPE.names, widths):
+            key = (key << width) | entities[name]
+        keys.append(key)
+    return keys
+
+
+def _match_entities_lexsort(gold_entity, pred_entity):
+    ## sort both arrays together, equal entities become adjacent with the gold ones first,
+    ## so a match is a gold entity directly followed by an equal pred entity
+    entities = np.concatenate((gold_entity, pred_entity))
+    source = np.repeat(np.array([0, 1], dtype=np.int8), (len(gold_entity), len(pred_entity)))
+    order = np.lexsort((source, entities['type'], entities['end'], entities['start'], entities['sentence']))
+    entities = entities[order]
+    source = source[order]
+    same = source[:-1] < source[1:]
+    for name in ENTITY_DTYPE.names:
+        same &= entities[name][:-1] == entities[name][1:]
+    return entities[:-1][same]
+
+
+def layer_entities(table, up_ignore_layer, type_ids):
+    """
+    Entities of table with type ids of the up_ignore_layer granularity
+    :param type_ids: type name -> id, shared by the tables compared together, extended with new types
+    """
+    codes = []
+    for entity_type in table.types:
+        if entity_type in IGNORE_TYPES:
+            codes.append(-1)
+        else:
+            entity_type = layer_type(RENAME_TYPES.get(entity_type, entity_type), up_ignore_layer)
+            codes.append(type_ids.setdefault(entity_type, len(type_ids)))
+    entities = table.entities.copy()
+    entities['type'] = np.array(codes, dtype=np.int32)[entities['type']]
+    if IGNORE_TYPES:
+        entities = entities[entities['type'] >= 0]
+    return entities
+
+
+## entity tables are cached in memory and on disk, keyed by file path, mtime and size
+ENTITY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'yedda', 'entities')
+ENTITY_CACHE_VERSION = 4
+_entity_tables = {}
+
+## one entity, end is exclusive and type indexes the type names of its table
+ENTITY_DTYPE = np.dtype([('sentence', np.int32), ('start', np.int32), ('end', np.int32), ('type', np.int32)])
+
+
+class EntityTable(NamedTuple):
+    entities: np.ndarray  # ENTITY_DTYPE, ordered by sentence and start
+    types: List[str]  # entity type names, indexed by type id
+    sentence_num: int
+    sentence_length: np.ndarray  # int32, characters of the plain text of each sentence
+
+
+def load_entity_table(ann_file, cache_dir=None, lines=None):
+    """
+    Entities of ann_file, parsed once then reused until the file changes.
+    :param cache_dir: directory of the on-disk cache, default ENTITY_CACHE_DIR, '' to only cache in memory
+    :param lines: lines of ann_file already read by the caller, parsed instead of reading the file on a cache miss
+    :return: EntityTable
+    """
+    if cache_dir is None:
+        cache_dir = ENTITY_CACHE_DIR
+    path = os.path.abspath(ann_file)
+    stat = os.stat(path)
+    key = (ENTITY_CACHE_VERSION, path, stat.st_mtime_ns, stat.st_size)
+    cached = _entity_tables.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    cache_file = None
+    table = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, hashlib.sha1(path.encode('utf-8')).hexdigest() + '.pkl')
+        try:
+            ## the key is pickled on its own before the table, a table of another version is never unpickled
+            with open(cache_file, 'rb') as fp:
+                if pickle.load(fp) == key:
+                    table = pickle.load(fp)
+        except Exception:
+            # missing, truncated or written by an older version, parse again
+            table = None
+    if table is None:
+        table = parse_entity_table(path) if lines is None else entity_table_from_lines(lines)
+        if cache_file:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_file = cache_file + '.%d.tmp' % os.getpid()
+                with open(temp_file, 'wb') as fp:
+                    pickle.dump(key, fp, protocol=pickle.HIGHEST_PROTOCOL)
+                    pickle.dump(table, fp, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(temp_file, cache_file)
+            except OSError as e:
+                print("Entity cache: failed to write", cache_file, e)
+    _entity_tables[path] = (key, table)
+    return table
+
+
+def parse_entity_table(ann_file):
+    with open(ann_file, encoding='utf-8') as fp:
+        return entity_table_from_lines(fp)
+
+
+def entity_table_from_lines(lines):
+    ## same entities as get_ner_from_sentence
+    return entity_table_from_rows(parse_rows(line.strip().replace(' ', ''))[0] for line in lines)
+
+
+def entity_table_from_rows(rows):
+    """
+    EntityTable of (plain text, spans) rows of the standoff model, one sentence per row,
+    gold entities only and the largest of nested ones
+    """
+    entities = []
+    type_ids = {}
+    sentence_length = []
+    for sentence, (text, spans) in enumerate(rows):
+        sentence_length.append(len(text))
+        for start, end, _, label, _ in outermost_spans([span for span in spans if span[2] == '@']):
+            entities.append((sentence, start, end, type_ids.setdefault(label.strip('*'), len(type_ids))))
+    return EntityTable(np.array(entities, dtype=ENTITY_DTYPE), list(type_ids), len(sentence_length),
+                       np.array(sentence_length, dtype=np.int32))
 
 
 def compare_f_measure_by_type(gold_file, pred_file):
-    ## generate entity f score by entity type
-    gold_entity, pred_entity, match_entity = get_matched_ner_from_file(gold_file, pred_file, 0)
-    gold_type_dict = {}
-    pred_type_dict = {}
-    match_type_dict = {}
-    for entity in gold_entity:
-        entity_type = entity.split(':')[1]
-        if entity_type in gold_type_dict:
-            gold_type_dict[entity_type] += 1
-        else:
-            gold_type_dict[entity_type] = 1
-    for entity in pred_entity:
-        entity_type = entity.split(':')[1]
-        if entity_type in pred_type_dict:
-            pred_type_dict[entity_type] += 1
-        else:
-            pred_type_dict[entity_type] = 1
-    for entity in match_entity:
-        entity_type = entity.split(':')[1]
-        if entity_type in match_type_dict:
-            match_type_dict[entity_type] += 1
-        else:
-            match_type_dict[entity_type] = 1
+    ## generate entity f score by entity type, then overall and for chunk
+    scores = score_entity_tables(load_entity_table(gold_file), load_entity_table(pred_file), (0, 2))
+    type_scores, overall = scores[0]
     final_prf = []
-    for entity in sorted(gold_type_dict.keys()):
-        gold_num = gold_type_dict[entity]
-        pred_num = 0
-        match_num = 0
-        if entity in pred_type_dict:
-            pred_num = pred_type_dict[entity]
-        if entity in match_type_dict:
-            match_num = match_type_dict[entity]
-        p, r, f = get_final_score(gold_num, pred_num, match_num)
+    for entity, (p, r, f) in type_scores.items():
         final_prf.append(entity + ":" + p_r_f_string(p, r, f))
-    over_gold_num = len(gold_entity)
-    over_pred_num = len(pred_entity)
-    over_match_num = len(match_entity)
-    p, r, f = get_final_score(over_gold_num, over_pred_num, over_match_num)
-    final_prf.append("Overall" + ":" + p_r_f_string(p, r, f))
-
-    ## get f measure for chunk
-    gold_entity, pred_entity, match_entity = get_matched_ner_from_file(gold_file, pred_file, 2)
-    over_gold_num = len(gold_entity)
-    over_pred_num = len(pred_entity)
-    over_match_num = len(match_entity)
-    p, r, f = get_final_score(over_gold_num, over_pred_num, over_match_num)
-    final_prf.append("Chunk" + ":" + p_r_f_string(p, r, f))
+    final_prf.append("Overall" + ":" + p_r_f_string(*overall))
+    final_prf.append("Chunk" + ":" + p_r_f_string(*scores[2][1]))
     return final_prf
 
 
+def score_entity_tables(gold_table, pred_table, layers=(0, 1, 2)):
+    """
+    Precision, recall and F1 of pred against gold at each granularity, from the tables of one read of each file.
+    Layer 0 compares exact types, 1 parent types and 2 boundaries only.
+    :return: {up_ignore_layer: ({type: (p, r, f)} for the gold types in name order, overall (p, r, f))}
+    """
+    scores = {}
+    for layer in layers:
+        gold_entity, pred_entity, match_entity, type_names = match_entity_tables(gold_table, pred_table, layer)
+        type_num = len(type_names)
+        gold_type_num = np.bincount(gold_entity['type'], minlength=type_num)
+        pred_type_num = np.bincount(pred_entity['type'], minlength=type_num)
+        match_type_num = np.bincount(match_entity['type'], minlength=type_num)
+        type_scores = {}
+        for entity, type_id in sorted((type_names[type_id], type_id) for type_id in np.flatnonzero(gold_type_num)):
+            type_scores[entity] = get_final_score(int(gold_type_num[type_id]), int(pred_type_num[type_id]),
+                                                  int(match_type_num[type_id]))
+        overall = get_final_score(len(gold_entity), len(pred_entity), len(match_entity))
+        scores[layer] = (type_scores, overall)
+    return scores
+
+
 def get_ner_from_sentence(sentence):
     ## remove segmentation space, avoid segmentation changes
-    sentence = sentence.strip().replace(' ', '')
-    sentence_len = len(sentence)
-    # print sentence
-    entity_start = []
-    words = []
-    last_char = ''
-    entity_type_start = False
-    entity_type = ''
-    word_id = 0
+    markup = parse_markup(sentence.strip().replace(' ', ''))
+    ## remove inside nested entity
     entity_list = []
-    for idx in range(sentence_len):
-        if sentence[idx] == '[':
-            left_bracket = True
-        elif sentence[idx] == '@':
-            if last_char == '[':
-                entity_start.append(word_id)
-            else:
-                words.append(sentence[idx])
-                word_id += 1
-        elif sentence[idx] == '#':
-            if len(entity_start) > 0:
-                entity_type_start = True
-            else:
-                words.append(sentence[idx])
-                word_id += 1
-        elif sentence[idx] == ']':
-            if last_char == '*':
-                ## remove inside nested entity
-                if len(entity_start) > 1:
-                    entity_start.pop()
-                    entity_type = ''
-                    entity_type_start = False
-                elif len(entity_start) == 1:
-                    entity_info = '[' + str(entity_start[0]) + ',' + str(word_id - 1) + ']:' + entity_type.strip('*')
-                    entity_list.append(entity_info)
-                    entity_type = ''
-                    entity_start = []
-                    entity_type_start = False
-                else:
-                    words.append(sentence[idx])
-                    word_id += 1
-        else:
-            if entity_type_start:
-                entity_type += sentence[idx]
-            else:
-                words.append(sentence[idx])
-                word_id += 1
-        last_char = sentence[idx]
-    # print entity_list
+    for start, end, _, label, _ in outermost_spans([span for span in markup.spans if span[2] == '@']):
+        entity_info = '[' + str(start) + ',' + str(end - 1) + ']:' + label.strip('*')
+        entity_list.append(entity_info)
     return entity_list
-    # print entity_list
-    # for word in words:
-    #     print word, " ",
+
+
+## ignore entity type when calculate, e.g. {'Fin-Concept'}
+IGNORE_TYPES = set()
+## rename entity type, e.g. {'Person-Name': 'Person'}
+RENAME_TYPES = {}
+
+
+def layer_type(entity_type, up_ignore_layer=0):
+    ## 1: keep the parent type of `Parent-Child` types, 2: ignore the type, only compare boundaries
+    if up_ignore_layer == 1:
+        if '-' in entity_type:
+            entity_type = entity_type.split('-')[0]
+    elif up_ignore_layer == 2:
+        entity_type = "ENTITY"
+    return entity_type
 
 
 def filter_entity(entity_list, up_ignore_layer=0):
-    ## ignore entity type when calculate
-    ignore_type = {}
-    # ignore_type = {'Fin-Concept'}
-    ## rename entity type
-    # rename_type = {'Person-Name':'Person'}
-    rename_type = {}
     filtered_list = []
     for entity in entity_list:
         pair = entity.split(':')
         entity_type = pair[-1]
-        if entity_type not in ignore_type:
-            if entity_type in rename_type:
-                entity_type = rename_type[entity_type]
-            if up_ignore_layer == 1:
-                if '-' in entity_type:
-                    entity_type = entity_type.split('-')[0]
-            elif up_ignore_layer == 2:
-                entity_type = "ENTITY"
+        if entity_type not in IGNORE_TYPES:
+            entity_type = layer_type(RENAME_TYPES.get(entity_type, entity_type), up_ignore_layer)
             filtered_list.append(pair[0] + ':' + entity_type)
     return filtered_list
 
@@ -293,16 +406,31 @@ def simplified_name(file_name):
     return name
 
 
+def compare_pair(gold_file, pred_file, idx=0, idy=0):
+    """
+    Entity and chunk F1 of two files, the cell (idx, idy) of the report matrix.
+    Runs in worker processes of the admin tool, tables come from the on-disk cache when possible.
+    :return: (idx, idy, f, f_chunk)
+    """
+    gold_table = load_entity_table(gold_file)
+    pred_table = load_entity_table(pred_file)
+    p, r, f = compare_entity_tables(gold_table, pred_table, 0)
+    p2, r2, f2 = compare_entity_tables(gold_table, pred_table, 2)
+    return idx, idy, f, f2
+
+
 def generate_report_from_list(file_list):
     file_num = len(file_list)
+    ## parse each file once, all pairs and granularities reuse the tables
+    tables = [load_entity_table(file_name) for file_name in file_list]
     result_matrix = np.ones((file_num, file_num))
     result_matrix_boundary = np.ones((file_num, file_num))
     for idx in range(file_num - 1):
-        gold_file = file_list[idx]
+        gold_table = tables[idx]
         for idy in range(idx + 1, file_num):
-            pred_file = file_list[idy]
-            p, r, f = compare_files(gold_file, pred_file, 0)
-            p2, r2, f2 = compare_files(gold_file, pred_file, 2)
+            pred_table = tables[idy]
+            p, r, f = compare_entity_tables(gold_table, pred_table, 0)
+            p2, r2, f2 = compare_entity_tables(gold_table, pred_table, 2)
             result_matrix[idx][idy] = f
             result_matrix[idy][idx] = f
             result_matrix_boundary[idx][idy] = f2
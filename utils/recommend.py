@@ -4,156 +4,322 @@
 # @Last Modified by:   Jie Yang,     Contact: jieynlp@gmail.com
 # @Last Modified time: 2018-05-01 21:17:27
 
+import queue
 import re
+import threading
+from operator import itemgetter
 
+from .markup import outermost_spans, parse_markup, render_markup
+from .standoff import remove_kind
 
-def maximum_matching(train_text, decode_text, entityRe=r'\[\@.*?\#.*?\*\](?!\#)',
-                     recommendRe=r'\[\$.*?\#.*?\*\](?!\#)'):
+
+class Lexicon:
+    """
+    Gold entities seen in the document with their labels, kept up to date as entities
+    are added, relabeled or removed, so recommendation never re-parses the annotated text.
+    Matching goes through a LexiconMatcher, rebuilt lazily after the lexicon changed.
+    An entity annotated with several labels is recommended with the most frequent one.
+    """
+
+    def __init__(self):
+        self.labels = {}  # entity -> {label: count}
+        self._matcher = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def clear(self):
+        self.labels = {}
+        self._matcher = None
+
+    def add(self, entity, label):
+        if not entity:
+            return
+        counts = self.labels.setdefault(entity, {})
+        # re-insert so the latest label wins ties
+        counts[label] = counts.pop(label, 0) + 1
+        self._matcher = None
+
+    def remove(self, entity, label):
+        counts = self.labels.get(entity)
+        if counts is None or label not in counts:
+            return
+        counts[label] -= 1
+        if counts[label] == 0:
+            del counts[label]
+        if not counts:
+            del self.labels[entity]
+        self._matcher = None
+
+    def add_text(self, text):
+        markup = parse_markup(text)
+        for entity, label in gold_entities([(markup.text, markup.spans)]):
+            self.add(entity, label)
+
+    def update_rows(self, old_rows, new_rows):
+        """(plain text, spans) rows of the standoff model were replaced, nested gold entities included"""
+        old_gold = gold_entities(old_rows)
+        new_gold = gold_entities(new_rows)
+        if old_gold == new_gold:
+            return
+        for entity, label in old_gold:
+            self.remove(entity, label)
+        for entity, label in new_gold:
+            self.add(entity, label)
+
+    def label(self, entity):
+        counts = self.labels[entity]
+        return max(reversed(counts.keys()), key=counts.get)
+
+    def matcher(self):
+        """immutable matcher of the current entities, safe to use from another thread"""
+        if self._matcher is None:
+            self._matcher = LexiconMatcher({entity: self.label(entity) for entity in self.labels})
+        return self._matcher
+
+    def longest_matches(self, text, start=0, end=None):
+        return self.matcher().longest_matches(text, start, end)
+
+
+def gold_entities(rows):
+    """(entity, label) of every gold span of (plain text, spans) rows, the keys of a Lexicon"""
+    return [(text[start:end], label) for text, spans in rows for start, end, kind, label, _ in spans if kind == '@']
+
+
+class LexiconMatcher:
+    """
+    Aho-Corasick automaton over the reversed entities. Scanning the text backwards gives, at every
+    position, the longest entity starting there (the longest entity ending at the automaton state),
+    so forward maximum matching is linear in the text length whatever the entity lengths are.
+    """
+
+    def __init__(self, entity_labels):
+        self.entity_labels = entity_labels  # entity -> recommended label
+        goto = [{}]  # node -> {char: child}
+        depth = [0]
+        terminal = [False]
+        for entity in entity_labels:
+            node = 0
+            for char in reversed(entity):
+                child = goto[node].get(char)
+                if child is None:
+                    child = len(goto)
+                    goto[node][char] = child
+                    goto.append({})
+                    depth.append(depth[node] + 1)
+                    terminal.append(False)
+                node = child
+            terminal[node] = True
+        fail = [0] * len(goto)
+        ## length of the longest entity which is a suffix of the node string, through failure links
+        longest = [0] * len(goto)
+        queue_nodes = list(goto[0].values())
+        for node in queue_nodes:
+            longest[node] = depth[node] if terminal[node] else 0
+        for node in queue_nodes:
+            for char, child in goto[node].items():
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                longest[child] = depth[child] if terminal[child] else longest[fail[child]]
+                queue_nodes.append(child)
+        self.goto = goto
+        self.fail = fail
+        self.longest = longest
+        ## characters ending an entity, from the automaton root; other characters are skipped at C speed
+        self.root_chars = re.compile('[%s]' % ''.join(map(re.escape, goto[0]))) if goto[0] else None
+
+    def __len__(self):
+        return len(self.entity_labels)
+
+    def longest_matches(self, text, start=0, end=None):
+        """
+        Forward maximum matching within text[start:end]: at each position take the longest entity
+        starting there, then continue after it.
+        :return: list of (start, end, label)
+        """
+        return self.segment_matches(text, [(start, len(text) if end is None else end)])
+
+    def segment_matches(self, text, segments):
+        """
+        Forward maximum matching within each of segments, no entity crosses a segment boundary
+        :param segments: sorted, non-overlapping (start, end) ranges of text
+        :return: list of (start, end, label)
+        """
+        if self.root_chars is None or not segments:
+            return []
+        goto, fail, longest = self.goto, self.fail, self.longest
+        candidates = [match.start() for match in self.root_chars.finditer(text, segments[0][0], segments[-1][1])]
+        hits = []  # (position, length of the longest entity starting there), backwards
+        idx = len(candidates) - 1
+        for start, end in reversed(segments):
+            state = 0
+            pos = end - 1
+            while pos >= start:
+                if state == 0:
+                    ## no partial match pending, jump to the previous character which can end an entity
+                    while idx >= 0 and candidates[idx] > pos:
+                        idx -= 1
+                    if idx < 0 or candidates[idx] < start:
+                        break
+                    pos = candidates[idx]
+                char = text[pos]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(char, 0)
+                if longest[state]:
+                    hits.append((pos, longest[state]))
+                pos -= 1
+        matches = []
+        free = 0  # first position not covered by a match
+        for pos, length in reversed(hits):
+            if pos >= free:
+                matches.append((pos, pos + length, self.entity_labels[text[pos:pos + length]]))
+                free = pos + length
+        return matches
+
+
+def maximum_matching(train_text, decode_text, lexicon=None):
     # print "Training data:"
     # print train_text
     # print "Decode data:"
     # print decode_text
     # train_text = train_text.decode('utf-8')
     # decode_text = decode_text.decode('utf-8')
-    extracted_dict = {}
-    max_length = 0
-    for match in re.finditer(entityRe, train_text):
-        recognized_entity = train_text[match.span()[0]:match.span()[1]]
-        [entity, entity_type] = recognized_entity.strip('[@]*').rsplit('#', 1)
-
-        if len(entity) > max_length:
-            max_length = len(entity)
+    if lexicon is None:
+        lexicon = Lexicon()
+        lexicon.add_text(train_text)
+    # print "dict:", lexicon.labels
 
-        extracted_dict[entity] = entity_type
-    # print "dict:", extracted_dict
-
-    if len(extracted_dict) == 0:
+    if len(lexicon) == 0:
         return train_text + decode_text
 
-    ## only recommend following 10 sentences (reduce time)
-    near_sentences = ""
-    far_sentences = ""
+    ## only recommend following 20 sentences (reduce time)
     sentences = decode_text.split('\n')
-    for idx in range(len(sentences)):
-        if idx != len(sentences) - 1:
-            new_string = sentences[idx] + '\n'
-        else:
-            new_string = sentences[idx]
-        if idx > 20:
-            far_sentences += new_string
-        else:
-            near_sentences += new_string
-    decode_text = near_sentences
+    near_sentences = '\n'.join(sentences[:21])
+    far_sentences = '\n'.join(sentences[21:])
+    if len(sentences) > 21:
+        near_sentences += '\n'
+    return train_text + recommend_text(near_sentences, lexicon) + far_sentences
+
+
+def recommend_text(decode_text, lexicon):
+    """
+    recommend entities of lexicon in the whole decode_text
+    :param lexicon: Lexicon, or the LexiconMatcher snapshot of one
+    """
+    markup = parse_markup(decode_text)
+    return render_markup(markup.text, recommend_spans(markup.text, tuple(markup.spans), lexicon))
+
 
+def recommend_spans(text, spans, lexicon, start=0):
+    """
+    Recommend entities of lexicon in plain text annotated with spans, e.g. a row of the standoff model
+    :param lexicon: Lexicon, or the LexiconMatcher snapshot of one
+    :param start: only recommend from this offset, recommended entities before it are kept
+    :return: new spans, in the order of parse_markup
+    """
     ### forward maximum match algorithm with following conditions:
     ### 1. for previous recommend entities, remove them and recommend again
     ### 2. for recognized entities, ignored them (forward process ends at the begining of recognized entity)
+    kept_spans = remove_kind(spans, '$', start)
 
-    ## remove previous recommend entity format
-    decode_no_recommend = ""
-    last_entity_end = 0
-    for match in re.finditer(recommendRe, decode_text):
-        decode_no_recommend += decode_text[last_entity_end:match.span()[0]]
-        recommend_entity = decode_text[match.span()[0]:match.span()[1]]
-        entity = recommend_entity.strip('[$]').rsplit('#', 1)[0]
-        decode_no_recommend += entity
-        last_entity_end = match.span()[1]
-    decode_no_recommend += decode_text[last_entity_end:]
-    # print decode_no_recommend
-    ## ignored annotated entities but record them position (in entity_recognized_list)
-    decode_origin = ""
-    entity_recognized_list = []
-    last_entity_end = 0
-    for match in re.finditer(entityRe, decode_no_recommend):
-        decode_origin += decode_no_recommend[last_entity_end:match.span()[0]]
-        entity_recognized_list += [0] * (match.span()[0] - last_entity_end)
-        recommend_entity = decode_no_recommend[match.span()[0]:match.span()[1]]
-        [entity, recognized_type] = recommend_entity.strip('[@]*').rsplit('#', 1)
-        decode_origin += entity
-        entity_recognized_list += ["B-@-" + recognized_type] + ["I-@-" + recognized_type] * (len(entity) - 1)
-        last_entity_end = match.span()[1]
-    decode_origin += decode_no_recommend[last_entity_end:]
-    entity_recognized_list += [0] * (len(decode_no_recommend) - last_entity_end)
-    assert (len(decode_origin) == len(entity_recognized_list))
-    # print decode_origin
-    # print entity_recognized_list
-
-    ## forward maximum matching (FMM)
-    origin_length = len(decode_origin)
-    FMM_start = 0
-    FMM_end = (FMM_start + max_length) if (FMM_start + max_length) < origin_length - 1 else origin_length - 1
-    entity_recommend_list = []
-    while FMM_start < origin_length:
-
-        if FMM_end == FMM_start:
-            entity_recommend_list += [0]
-            FMM_start += 1
-            FMM_end = (FMM_start + max_length) if (FMM_start + max_length) < origin_length - 1 else origin_length - 1
-        ## recognized span detection: for the following two conditions, it jump when the word is located in recognized entity span
-        elif entity_recognized_list[FMM_start] != 0 or decode_origin[FMM_start] == '\n':
-            entity_recommend_list += [0]
-            FMM_start += 1
-            FMM_end = (FMM_start + max_length) if (FMM_start + max_length) < origin_length - 1 else origin_length - 1
-        elif entity_recognized_list[FMM_end] != 0 or decode_origin[FMM_end] == '\n':
-            FMM_end -= 1
-        ## finish recognized span detection
+    ## forward maximum matching (FMM) over the lexicon trie, within each segment
+    ## between kept entities and newlines
+    outer_spans = outermost_spans(kept_spans) if any(map(itemgetter(4), kept_spans)) else kept_spans
+    segments = []
+    segment_start = start
+    text_end = len(text)
+    for span_start, span_end in zip([span[0] for span in outer_spans] + [text_end],
+                                    [span[1] for span in outer_spans] + [text_end]):
+        if span_end <= start:
+            continue
+        span_start = max(span_start, segment_start)
+        if text.find('\n', segment_start, span_start) < 0:
+            segments.append((segment_start, span_start))
         else:
-            word = decode_origin[FMM_start:FMM_end]
-            if word in extracted_dict:
-                entity_recommend_list += ["B-$-" + extracted_dict[word]] + ["I-$-" + extracted_dict[word]] * (
-                            FMM_end - FMM_start - 1)
-                FMM_start = FMM_end
-                FMM_end = (FMM_start + max_length) if (
-                                                                  FMM_start + max_length) < origin_length - 1 else origin_length - 1
-            else:
-                FMM_end -= 1
-    # print entity_recommend_list
-    assert (len(entity_recommend_list) == len(entity_recognized_list))
-    recommend_decode_text = merge_text_with_entity(decode_origin, entity_recognized_list, entity_recommend_list)
-    return train_text + recommend_decode_text + far_sentences
-
-
-def merge_text_with_entity(origin_text, recognized_list, recommend_list):
-    length = len(origin_text)
-    assert (len(recognized_list) == length)
-    assert (len(recommend_list) == length)
-    combine_list = recommend_list
-    for idx in range(length):
-        if combine_list[idx] == 0 and recognized_list[idx] != 0:
-            combine_list[idx] = recognized_list[idx]
-    new_string = ""
-    entity_string = ""
-    entity_type = "Error"
-    entity_source = "Error"
-    for idx in range(length):
-        if combine_list[idx] == 0:
-            if entity_string:
-                new_string += "[" + entity_source + entity_string + "#" + entity_type + "*]"
-                entity_string = ""
-                entity_type = "Error"
-                entity_source = "Error"
-            # print new_string
-            new_string += origin_text[idx]
-
-        elif combine_list[idx].startswith("B-"):
-            if entity_string:
-                new_string += "[" + entity_source + entity_string + "#" + entity_type + "*]"
-                entity_string = ""
-                entity_type = "Error"
-                entity_source = "Error"
-            entity_string = origin_text[idx]
-            entity_type = combine_list[idx][4:]
-            entity_source = combine_list[idx][2:3]
-        elif combine_list[idx].startswith("I-"):
-            entity_string += origin_text[idx]
-        else:
-            print("merge_text_with_entity error!")
-    if entity_string:
-        new_string += "[" + entity_source + entity_string + "#" + entity_type + "*]"
-        entity_string = ""
-        entity_type = "Error"
-        entity_source = "Error"
-    return new_string
+            for line in text[segment_start:span_start].split('\n'):
+                segments.append((segment_start, segment_start + len(line)))
+                segment_start += len(line) + 1
+        segment_start = span_end
+    matcher = lexicon.matcher() if isinstance(lexicon, Lexicon) else lexicon
+    recommended = [(match_start, match_end, '$', label, 0)
+                   for match_start, match_end, label in matcher.segment_matches(text, segments)]
+    if not recommended:
+        return kept_spans
+    ## both are sorted by start, timsort merges the two runs at C speed, kept first on a tie
+    return tuple(sorted(kept_spans + tuple(recommended), key=itemgetter(0)))
+
+
+class BackgroundRecommender:
+    """
+    Recommend entities for the rest of the document on a worker thread, chunk by chunk.
+    Each result carries the id of the job it belongs to, starting a new job cancels the
+    previous one, and the caller drops results computed from an older document state.
+    """
+
+    def __init__(self, chunk_lines=200):
+        self.chunk_lines = chunk_lines
+        self.results = queue.Queue()
+        self.job_id = 0
+        self._cancel = threading.Event()
+        self._thread = None
+        self._error = None  # exception a job stopped with, raised by poll
+
+    def start(self, first_row, rows, lexicon):
+        """
+        Recommend rows, a snapshot of (plain text, spans) rows of the standoff model from first_row.
+        Results are put into self.results as (job_id, first_row, last_row, recommended rows)
+        for changed chunks only.
+        The worker matches against an immutable snapshot of lexicon, the GUI thread keeps changing the lexicon.
+        :return: id of the new job
+        """
+        self.cancel()
+        self.job_id += 1
+        self._cancel = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='BackgroundRecommender', daemon=True,
+                                        args=(self.job_id, self._cancel, first_row, rows, lexicon.matcher()))
+        self._thread.start()
+        return self.job_id
+
+    def cancel(self):
+        self._cancel.set()
+
+    def busy(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def poll(self):
+        """
+        results arrived so far, never blocks.
+        Once the results of a failed job are taken, raises the exception it stopped with
+        """
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        if not results and self._error is not None:
+            error, self._error = self._error, None
+            raise error
+        return results
+
+    def _run(self, job_id, cancel, first_row, rows, matcher):
+        for offset in range(0, len(rows), self.chunk_lines):
+            if cancel.is_set():
+                return
+            chunk = rows[offset:offset + self.chunk_lines]
+            try:
+                recommended = [(text, recommend_spans(text, spans, matcher)) for text, spans in chunk]
+            except Exception as e:
+                # handed over to the thread calling poll
+                self._error = RuntimeError(f"BackgroundRecommender: failed at row {first_row + offset}")
+                self._error.__cause__ = e
+                return
+            if recommended != chunk:
+                row = first_row + offset
+                self.results.put((job_id, row, row + len(chunk) - 1, recommended))
 
 
 if __name__ == '__main__':
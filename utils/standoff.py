@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Text-plus-standoff model of annotated text, the source of truth of the Editor.
+The plain text lives in a piece table whose buffers are never modified, the entities in a span table
+holding the spans of each row: (start, end, kind, label, depth) tuples in plain columns of the row, the
+same spans parse_markup returns for the row. Inline markup is only rendered, for the widget and the .ann
+file, so labeling, relabeling or removing an entity touches the span table alone, never the text.
+Entities never span rows, like their markup never spans a newline.
+"""
+from bisect import bisect_right
+from itertools import accumulate, groupby, repeat
+from operator import itemgetter, sub
+from typing import List, Optional, Tuple
+
+from .document import LineOffsets
+from .markup import parse_markup, render_markup
+
+
+def parse_rows(text: str) -> List[tuple]:
+    """
+    Rows of annotated text as (plain text, spans) tuples, the text is parsed in one pass
+    and the spans are then bucketed by row
+    """
+    markup = parse_markup(text)
+    texts = markup.text.split('\n')
+    spans = [()] * len(texts)
+    if markup.spans:
+        ## row of each span and its cols within the row, all at C speed
+        starts = list(accumulate((len(row_text) + 1 for row_text in texts), initial=0))
+        span_starts = list(map(itemgetter(0), markup.spans))
+        span_rows = list(map(bisect_right, repeat(starts[1:], len(span_starts)), span_starts))
+        shifts = list(map(starts.__getitem__, span_rows))
+        row_spans = zip(map(sub, span_starts, shifts), map(sub, map(itemgetter(1), markup.spans), shifts),
+                        *list(zip(*markup.spans))[2:])
+        for row, group in groupby(zip(span_rows, row_spans), key=itemgetter(0)):
+            spans[row] = tuple(map(itemgetter(1), group))
+    return list(zip(texts, spans))
+
+
+def add_span(spans: tuple, start: int, end: int, kind: str, label: str) -> Optional[Tuple[tuple, tuple]]:
+    """
+    Add an entity over [start, end), it contains every entity within that range
+    :return: (new spans, new span), or None if it would cross an existing entity
+    """
+    depth = 0
+    new_spans = []
+    for span in spans:
+        if start <= span[0] and span[1] <= end:
+            span = span[:4] + (span[4] + 1,)
+        elif span[0] <= start and end <= span[1]:
+            depth += 1
+        elif span[0] < end and start < span[1]:
+            return None
+        new_spans.append(span)
+    new_span = (start, end, kind, label, depth)
+    new_spans.append(new_span)
+    ## outer entity before the ones it contains, empty entities close before those starting there
+    new_spans.sort(key=lambda span: (span[0], span[4]))
+    return tuple(new_spans), new_span
+
+
+def remove_span(spans: tuple, span: tuple) -> tuple:
+    """remove an entity, the entities it contains move one level up"""
+    idx = spans.index(span)
+    start, end, depth = span[0], span[1], span[4]
+    return tuple(inner[:4] + (inner[4] - 1,) if start <= inner[0] and inner[1] <= end and inner[4] > depth
+                 else inner for inner in spans[:idx] + spans[idx + 1:])
+
+
+def remove_kind(spans: tuple, kind: str, start: int = 0) -> tuple:
+    """remove the entities of kind ('@' or '$') starting at or after start"""
+    if not any(map(itemgetter(4), spans)):
+        ## common case: no nested entity, no depth to fix
+        return tuple(span for span in spans if span[2] != kind or span[0] < start)
+    while True:
+        ## depths change with every removal, look the next one up again
+        span = next((span for span in spans if span[2] == kind and span[0] >= start), None)
+        if span is None:
+            return spans
+        spans = remove_span(spans, span)
+
+
+class PieceTable:
+    """
+    Text as a list of pieces (buffer, start, length) over immutable buffers: the original text and
+    one buffer per inserted string. An edit splits at most two pieces and never copies the text.
+    """
+
+    def __init__(self, text: str = ''):
+        self.buffers = [text]
+        self.pieces = [(0, 0, len(text))] if text else []
+        self.starts = [0] * len(self.pieces)  # offset of each piece in the text
+        self.length = len(text)
+
+    def __len__(self):
+        return self.length
+
+    def _reindex(self, first: int):
+        offset = self.starts[first - 1] + self.pieces[first - 1][2] if first > 0 else 0
+        lengths = [length for _, _, length in self.pieces[first:]]
+        self.starts[first:] = accumulate(lengths[:-1], initial=offset) if lengths else []
+        self.length = offset + sum(lengths)
+
+    def _split(self, offset: int) -> int:
+        """index of the piece starting at offset, splitting the piece containing it if needed"""
+        idx = bisect_right(self.starts, offset) - 1
+        if idx < 0 or offset == self.starts[idx]:
+            return max(idx, 0)
+        buffer, start, length = self.pieces[idx]
+        head = offset - self.starts[idx]
+        if head >= length:
+            return idx + 1
+        self.pieces[idx:idx + 1] = [(buffer, start, head), (buffer, start + head, length - head)]
+        self.starts.insert(idx + 1, offset)
+        return idx + 1
+
+    def get(self, start: int = 0, end: int = None) -> str:
+        end = self.length if end is None else min(end, self.length)
+        if start >= end:
+            return ''
+        parts = []
+        for idx in range(max(bisect_right(self.starts, start) - 1, 0), len(self.pieces)):
+            piece_start = self.starts[idx]
+            if piece_start >= end:
+                break
+            buffer, offset, length = self.pieces[idx]
+            head, tail = max(start - piece_start, 0), min(end - piece_start, length)
+            parts.append(self.buffers[buffer][offset + head:offset + tail])
+        return ''.join(parts)
+
+    def replace(self, start: int, end: int, text: str):
+        """replace text between offsets start and end"""
+        start, end = min(start, self.length), min(end, self.length)
+        first = self._split(start)
+        last = self._split(end)
+        new_pieces = []
+        if text:
+            self.buffers.append(text)
+            new_pieces.append((len(self.buffers) - 1, 0, len(text)))
+        self.pieces[first:last] = new_pieces
+        self._reindex(first)
+        if len(self.buffers) > 2 * len(self.pieces) + 16:
+            self._compact()
+
+    def _compact(self):
+        """drop the buffers no piece refers to any more, e.g. of text replaced since"""
+        used = sorted({buffer for buffer, _, _ in self.pieces})
+        renumber = {buffer: idx for idx, buffer in enumerate(used)}
+        self.buffers = [self.buffers[buffer] for buffer in used]
+        self.pieces = [(renumber[buffer], start, length) for buffer, start, length in self.pieces]
+
+
+class SpanTable:
+    """Entity spans of each row, a tuple per row in the order of their opening markup"""
+
+    def __init__(self, rows: List[tuple]):
+        self.rows = rows
+
+    def __getitem__(self, row: int) -> tuple:
+        return self.rows[row - 1]
+
+    def replace(self, first_row: int, last_row: int, rows: List[tuple]):
+        self.rows[first_row - 1:last_row] = rows
+
+
+class StandoffDocument:
+    """
+    Annotated text as rows of plain text plus entity spans. Rows start from 1 and cols from 0, cols are
+    plain columns, except the `markup` ones which are columns in the rendered row, i.e. in the Editor.
+    Every edit replaces whole rows and is reported to on_change, so the Editor can record it for undo,
+    update the lexicon and render the rows into the widget.
+    """
+
+    def __init__(self, rows: List[tuple] = (('', ()),)):
+        texts = [text for text, _ in rows]
+        self.text = PieceTable('\n'.join(texts))
+        self.line_offsets = LineOffsets(texts)
+        self.spans = SpanTable([spans for _, spans in rows])
+        self.on_change = None  # function(first_row, old rows, new rows), called after every edit
+
+    @classmethod
+    def from_markup(cls, text: str) -> 'StandoffDocument':
+        return cls(parse_rows(text))
+
+    def line_count(self) -> int:
+        return len(self.spans.rows)
+
+    def _row_range(self, first_row: int, last_row: int) -> Tuple[int, int]:
+        """offsets of the start of first_row and of the end of last_row in the plain text"""
+        end = self.line_offsets.row_start(last_row + 1) - 1 if last_row < self.line_count() else len(self.text)
+        return self.line_offsets.row_start(first_row), end
+
+    def row_text(self, row: int) -> str:
+        return self.text.get(*self._row_range(row, row))
+
+    def row(self, row: int) -> tuple:
+        """(plain text, spans) of row"""
+        return self.row_text(row), self.spans[row]
+
+    def rows(self, first_row: int, last_row: int) -> List[tuple]:
+        """(plain text, spans) of rows first_row..last_row, with one read of the piece table"""
+        texts = self.text.get(*self._row_range(first_row, last_row)).split('\n')
+        return list(zip(texts, self.spans.rows[first_row - 1:last_row]))
+
+    def render_row(self, row: int, ranges: list = None) -> str:
+        """inline markup of row, ranges receives the (start, end) markup cols of each span"""
+        return render_markup(self.row_text(row), self.spans[row], ranges)
+
+    def markup(self) -> str:
+        return '\n'.join(render_markup(text, spans) for text, spans in self.rows(1, self.line_count()))
+
+    def replace_rows(self, first_row: int, last_row: int, rows: List[tuple]) -> List[tuple]:
+        """
+        Replace rows first_row..last_row by at least one new (plain text, spans) row
+        :return: the replaced rows
+        """
+        old_rows = self.rows(first_row, last_row)
+        texts = [text for text, _ in rows]
+        ## entity edits leave the text as it is
+        if texts != [text for text, _ in old_rows]:
+            start, end = self._row_range(first_row, last_row)
+            self.text.replace(start, end, '\n'.join(texts))
+            self.line_offsets.replace(first_row, last_row, [len(text) + 1 for text in texts])
+        self.spans.replace(first_row, last_row, [spans for _, spans in rows])
+        if self.on_change is not None:
+            self.on_change(first_row, old_rows, rows)
+        return old_rows
+
+    def replace_spans(self, row: int, spans: tuple):
+        self.replace_rows(row, row, [(self.row_text(row), spans)])
+
+    def annotate(self, row: int, start: int, end: int, label: str, kind: str = '@') -> Optional[tuple]:
+        """label cols [start, end) of row as an entity, None if it would cross an existing one"""
+        text, spans = self.row(row)
+        end = min(end, len(text))
+        if start >= end:
+            return None
+        added = add_span(spans, start, end, kind, label)
+        if added is None:
+            return None
+        self.replace_spans(row, added[0])
+        return added[1]
+
+    def relabel(self, row: int, span: tuple, label: str, kind: str = '@') -> tuple:
+        """change the label of an entity, a recommended one becomes gold"""
+        spans = list(self.spans[row])
+        new_span = (span[0], span[1], kind, label, span[4])
+        spans[spans.index(span)] = new_span
+        self.replace_spans(row, tuple(spans))
+        return new_span
+
+    def remove(self, row: int, span: tuple):
+        self.replace_spans(row, remove_span(self.spans[row], span))
+
+    def offset(self, row: int, col: int) -> int:
+        """offset of (row, col) in the plain text, counting a newline as one character"""
+        return self.line_offsets.row_start(row) + col
+
+    def position(self, offset: int) -> Tuple[int, int]:
+        """(row, col) of offset in the plain text, clamped to the document"""
+        if offset <= 0:
+            return 1, 0
+        row, start = self.line_offsets.find_row(offset)
+        if row > self.line_count():
+            return self.line_count(), len(self.row_text(self.line_count()))
+        return row, offset - start
+
+    def markup_end(self, row: int, span: tuple) -> int:
+        """markup col just after the closing `*]` of span"""
+        ranges = []
+        self.render_row(row, ranges)
+        return ranges[self.spans[row].index(span)][1]
+
+    def markup_col(self, row: int, col: int) -> int:
+        """markup col of plain col, after the markup of entities opening before it or closing before it"""
+        markup_col = col
+        for start, end, _, label, _ in self.spans[row]:
+            if start < col:
+                markup_col += 2
+            if end < col:
+                markup_col += len(label) + 3
+        return markup_col
+
+    def plain_col(self, row: int, markup_col: int) -> int:
+        """plain col of markup col, a col within the markup of an entity is moved out of it"""
+        ranges = []
+        self.render_row(row, ranges)
+        col = markup_col
+        for span, (start, end) in zip(self.spans[row], ranges):
+            close_len = len(span[3]) + 3
+            col -= min(max(markup_col - start, 0), 2) + min(max(markup_col - end + close_len, 0), close_len)
+        return col
+
+    def span_at(self, row: int, markup_start: int, markup_end: int) -> Optional[tuple]:
+        """
+        Innermost entity of row whose markup contains [markup_start, markup_end], e.g. the whole entity
+        is selected or the cursor is inside its brackets
+        """
+        ranges = []
+        self.render_row(row, ranges)
+        found = None
+        for span, (start, end) in zip(self.spans[row], ranges):
+            if start <= markup_start and markup_end <= end and start < markup_end and markup_start < end:
+                if found is None or span[4] > found[4]:
+                    found = span
+        return found